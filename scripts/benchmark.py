@@ -0,0 +1,408 @@
+"""
+Benchmarks the scraper against a local fake Craigslist, without network access.
+
+A server process serves search and post pages synthesized from the sample posts in
+`data/category`, with configurable latency and error rate. Each scenario runs in its own process
+against that server, and reports requests/sec, parse time per page, request latency percentiles
+and peak RSS.
+    python -m scripts.benchmark                         # every scenario
+    python -m scripts.benchmark category --posts 2000 --latency 0.05 --error-rate 0.02
+    python -m scripts.benchmark --engine lxml --json bench.json
+"""
+import argparse
+import asyncio
+import html
+import json
+import multiprocessing
+import random
+import resource
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+
+from aiohttp import web
+
+from src import extract, http_cache, sinks, throttle
+from src.utils import get_project_root
+
+# ========================================== Constants ===========================================
+scenarios = ('category', 'state', 'scrape_post', 'parse')
+
+# sample posts the fake pages are made from
+sample_dir = get_project_root().joinpath('data/category')
+
+# category searched by the scenarios
+category = 'cell phones'
+
+# name of the fake state, and results per search page
+state = 'BENCH'
+page_size = 120
+
+# the server listens on 127.0.0.1, 127.0.0.2, ..., so every fake city is a separate host
+server_port = 8890
+
+# percentiles of request latency to report
+percentiles = (50, 95, 99)
+
+
+# =========================================== Helpers ============================================
+def load_posts(count: int) -> list:
+    """
+    Load sample posts, repeated with new pids until there are `count` of them.
+    :param count: number of posts
+    :return: [post], as written to detail files
+    """
+    posts = {}
+    for fp in sorted(sample_dir.glob('*/*/*/*_DETAIL*')):
+        for post in sinks.read_records(fp):
+            if post.get('description') is not None:
+                posts[post['pid']] = post
+    samples = sorted(posts.values(), key=lambda p: p['pid'])
+    if not samples:
+        raise ValueError(f"No sample posts in: {sample_dir}")
+    result = []
+    for i in range(count):
+        post = dict(samples[i % len(samples)])
+        if i >= len(samples):
+            post['pid'] = str(int(post['pid']) + 10 ** 9 * (i // len(samples)))
+            post['pid_repost'] = None
+        result.append(post)
+    return result
+
+
+def search_row(post: dict) -> str:
+    """ HTML of a search result, with a link relative to the server """
+    repost = f' data-repost-of="{post["pid_repost"]}"' if post['pid_repost'] else ''
+    link = f'/post/{post["pid"]}.html'
+    return (f'<li class="result-row" data-pid="{post["pid"]}"{repost}>'
+            f'<a href="{link}" class="result-image gallery"></a><p class="result-info">'
+            f'<time class="result-date" datetime="{post["time"]}">date</time>'
+            f'<a href="HOST{link}" class="result-title hdrlnk">{html.escape(post["title"])}</a>'
+            f'<span class="result-meta"><span class="result-price">${post["price"]}</span>'
+            f'</span></p></li>')
+
+
+def attribute_span(name: str, value) -> str:
+    """ HTML of a post attribute. Flags have no value, and list values were split on ':' """
+    if value is None:
+        return f'<span><b>{html.escape(name)}</b></span><br>'
+    if isinstance(value, list):
+        value = ':'.join(value)
+    return f'<span>{html.escape(name)}: <b>{html.escape(value)}</b></span><br>'
+
+
+def post_page(post: dict) -> str:
+    """ HTML of a post page, laid out like craigslist's """
+    attributes = ''.join(attribute_span(name, value)
+                         for name, value in (post['attributes'] or {}).items())
+    images = post['images'] or []
+    if len(images) > 1:
+        gallery = ''.join(f'<a class="thumb" data-imgid="{i}" href="{url}"><img src="{url}"></a>'
+                          for i, url in enumerate(images))
+    elif images:
+        gallery = f'<div class="slide first visible"><img src="{images[0]}"></div>'
+    else:
+        gallery = ''
+    return (f'<html><head><title>{html.escape(post["title"])}</title></head><body>'
+            f'<section class="page-container"><section class="body"><h2>title</h2>'
+            f'<section class="userbody"><figure>{gallery}</figure><div class="mapAndAttrs">'
+            f'<p class="attrgroup">{attributes}</p></div><section id="postingbody">'
+            f'<div class="print-qrcode-container">QR code</div>'
+            f'{html.escape(post["description"])}</section></section></section></section>'
+            f'</body></html>')
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def get_json(url: str) -> dict:
+    with urllib.request.urlopen(url) as response:
+        return json.load(response)
+
+
+# =========================================== Server =============================================
+def make_app(posts: list, latency: float, error_rate: float, seed: int = 0) -> web.Application:
+    """
+    Fake craigslist site.
+    :param posts: served by every host, newest first
+    :param latency: mean seconds before responding, exponentially distributed
+    :param error_rate: fraction of requests failing with a 429, a 503 or a dropped connection
+    :param seed: of the random latency and errors
+    """
+    rows = [search_row(p) for p in posts]
+    pages = {p['pid']: post_page(p).encode() for p in posts}
+    rng = random.Random(seed)
+    stats = {'requests': 0, 'errors': 0, 'bytes': 0}
+
+    async def delay_or_fail(request):
+        stats['requests'] += 1
+        if latency:
+            await asyncio.sleep(rng.expovariate(1 / latency))
+        r = rng.random()
+        if r >= error_rate:
+            return None
+        stats['errors'] += 1
+        if r < error_rate / 3:
+            return web.Response(status=429, headers={'Retry-After': '0'})
+        if r < error_rate * 2 / 3:
+            return web.Response(status=503)
+        request.transport.close()
+        return web.Response(status=503)
+
+    async def search(request):
+        error = await delay_or_fail(request)
+        if error is not None:
+            return error
+        offset = int(request.query.get('s', 0))
+        host = f'http://{request.host}'
+        body = ''.join(rows[offset:offset + page_size]).replace('HOST', host)
+        text = (f'<html><body><div class="search-legend"><span class="rangeFrom">{offset + 1}'
+                f'</span><span class="totalcount">{len(rows)}</span></div>'
+                f'<ul class="rows">{body}</ul></body></html>')
+        stats['bytes'] += len(text)
+        return web.Response(text=text, content_type='text/html')
+
+    async def post(request):
+        error = await delay_or_fail(request)
+        if error is not None:
+            return error
+        body = pages.get(request.match_info['pid'])
+        if body is None:
+            return web.Response(status=404)
+        stats['bytes'] += len(body)
+        return web.Response(body=body, content_type='text/html')
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_get('/d/{category}/search/{abbr}', search)
+    app.router.add_get('/post/{pid}.html', post)
+    app.router.add_get('/_stats', get_stats)
+    return app
+
+
+def serve(posts: list, latency: float, error_rate: float, hosts: list, port: int) -> None:
+    web.run_app(make_app(posts, latency, error_rate), host=hosts, port=port, print=None,
+                access_log=None)
+
+
+def start_server(posts: list, latency: float, error_rate: float,
+                 cities: int, port: int = server_port) -> tuple:
+    """
+    Start the fake site in a separate process, so it does not compete with the scraper for the
+    event loop.
+    :return: (process, [base URL of each city])
+    """
+    hosts = [f'127.0.0.{i + 1}' for i in range(cities)]
+    process = multiprocessing.Process(target=serve, args=(posts, latency, error_rate, hosts, port),
+                                      daemon=True)
+    process.start()
+    urls = [f'http://{host}:{port}' for host in hosts]
+    for _ in range(200):
+        try:
+            get_json(f'{urls[0]}/_stats')
+            break
+        except OSError:
+            time.sleep(0.05)
+    else:
+        process.terminate()
+        raise RuntimeError("Benchmark server did not start")
+    return process, urls
+
+
+# ========================================== Scenarios ===========================================
+class Metrics:
+    """ Times every request and every parse in the current process """
+    def __init__(self):
+        self.latencies = []
+        self.parse_times = []
+
+    def install(self) -> None:
+        get, run_parser = throttle.get, extract.run_parser
+
+        async def timed_get(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await get(*args, **kwargs)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+
+        async def timed_run_parser(parser, *args):
+            start = time.perf_counter()
+            try:
+                return await run_parser(parser, *args)
+            finally:
+                self.parse_times.append(time.perf_counter() - start)
+
+        throttle.get, extract.run_parser = timed_get, timed_run_parser
+
+
+async def run_category(urls: list, out_dir: Path) -> int:
+    from src import category_scrape
+    post_overviews, _ = await category_scrape.scrape_category(urls[0], category)
+    return len(post_overviews)
+
+
+async def run_state(urls: list, out_dir: Path) -> int:
+    from src import category_scrape
+    from src.resolver import get_resolver
+    get_resolver().cities[state] = {f'city{i}': url for i, url in enumerate(urls)}
+    results = await category_scrape.scrape_category_state(state, category)
+    return sum(len(overviews) for overviews, _ in results.values())
+
+
+async def run_scrape_post(urls: list, out_dir: Path) -> int:
+    from src import category_scrape, scrape_post
+    # Overview files, as written by a previous crawl of every city.
+    in_dir = out_dir.joinpath('overviews')
+    in_dir.mkdir()
+    post_overviews, _ = await category_scrape.scrape_category(urls[0], category)
+    for i, url in enumerate(urls):
+        overviews = [dict(p, link=p['link'].replace(urls[0], url)) for p in post_overviews]
+        with open(in_dir.joinpath(f'city{i}.json'), 'w') as f:
+            json.dump(overviews, f)
+    results_dir = out_dir.joinpath('details')
+    results_dir.mkdir()
+    await scrape_post.scrape_files(sorted(in_dir.glob('*.json')), results_dir)
+    return len(post_overviews) * len(urls)
+
+
+async def run_parse(urls: list, out_dir: Path) -> int:
+    """ Parse a few pages, and check that every engine gets the same results from them """
+    from src import category_scrape
+    async with throttle.make_session() as session:
+        url = category_scrape.build_url(urls[0], category)
+        search_pages = [await http_cache.fetch(category_scrape.page_url(url, offset), session)
+                        for offset in (0, page_size)]
+        links = [p['link'] for p in extract.parse_search_page(search_pages[0])[0]]
+        post_pages = await asyncio.gather(*[http_cache.fetch(link, session) for link in links])
+    # Only the default engine is timed.
+    results = [await extract.run_parser(extract.parse_search_page, page, extract.default_engine)
+               for page in search_pages]
+    results += [await extract.run_parser(extract.parse_post_page, page, link,
+                                         extract.default_engine)
+                for page, link in zip(post_pages, links)]
+    for engine in extract.engines:
+        other = [extract.parse_search_page(page, engine) for page in search_pages]
+        other += [extract.parse_post_page(page, link, engine)
+                  for page, link in zip(post_pages, links)]
+        if other != results:
+            raise AssertionError(f"Engines disagree: {extract.default_engine}, {engine}")
+    return len(results)
+
+
+scenario_functions = {
+    'category': run_category,
+    'state': run_state,
+    'scrape_post': run_scrape_post,
+    'parse': run_parse,
+}
+
+
+def run_scenario(name: str, urls: list, engine: str, parse_workers: int) -> dict:
+    """
+    Run a scenario in the current process, which should be a fresh one so that peak RSS is its
+    own.
+    :return: {metric: value}
+    """
+    extract.set_engine(engine)
+    if parse_workers:
+        extract.start_process_pool(parse_workers)
+    # The adaptive rate limit would measure itself rather than the scraper, so start every
+    # host at the max rate. The server still throttles with 429s if an error rate is given.
+    for url in urls:
+        throttle.set_rate(urlparse(url).netloc, throttle.max_rate)
+    metrics = Metrics()
+    metrics.install()
+    stats_before = get_json(f'{urls[0]}/_stats')
+    try:
+        with tempfile.TemporaryDirectory() as out_dir:
+            start = time.perf_counter()
+            items = asyncio.run(scenario_functions[name](urls, Path(out_dir)))
+            elapsed = time.perf_counter() - start
+    finally:
+        extract.stop_process_pool()
+    stats = get_json(f'{urls[0]}/_stats')
+    requests = stats['requests'] - stats_before['requests']
+    return {
+        'scenario': name,
+        'items': items,
+        'seconds': round(elapsed, 3),
+        'requests': requests,
+        'requests_per_sec': round(requests / elapsed, 1),
+        'server_errors': stats['errors'] - stats_before['errors'],
+        'parse_ms_mean': round(1000 * sum(metrics.parse_times) / max(1, len(metrics.parse_times)),
+                               3),
+        'parse_ms_p95': round(1000 * percentile(metrics.parse_times, 95), 3),
+        **{f'latency_ms_p{p}': round(1000 * percentile(metrics.latencies, p), 1)
+           for p in percentiles},
+        # kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+# =========================================== Main ===============================================
+def show_results(results: list) -> None:
+    columns = list(results[0])
+    widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in columns]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in results:
+        print('  '.join(str(r[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+def main(args) -> list:
+    posts = load_posts(args.posts)
+    process, urls = start_server(posts, args.latency, args.error_rate, args.cities, args.port)
+    results = []
+    try:
+        for name in args.scenarios or scenarios:
+            # A fresh process per scenario, so peak RSS and module state are its own.
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(run_scenario, name, urls, args.engine,
+                                         args.parse_workers).result()
+            results.append(result)
+    finally:
+        process.terminate()
+        process.join()
+    return results
+
+
+if __name__ == '__main__':
+    desc = 'Benchmark the scraper against a local fake Craigslist'
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('scenarios', nargs='*',
+                        help=f'Scenarios to run, default all of: {", ".join(scenarios)}')
+    parser.add_argument('--posts', type=int, default=1000,
+                        help='Number of posts on each fake city')
+    parser.add_argument('--cities', type=int, default=4,
+                        help='Number of fake cities, for the state and scrape_post scenarios')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Mean seconds the server waits before responding')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests failing with a 429, a 503 or a reset')
+    parser.add_argument('--engine', choices=extract.engines, default=extract.default_engine)
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='Number of processes to parse pages in')
+    parser.add_argument('--port', type=int, default=server_port)
+    parser.add_argument('--json', help='File to write results to, e.g. to compare in CI')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in scenarios:
+            parser.error(f"Invalid scenario: {name}, expected one of {scenarios}")
+
+    results = main(args)
+    show_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if any(r['items'] == 0 for r in results):
+        sys.exit(1)
@@ -0,0 +1,130 @@
+"""
+Check the extraction engines of `src/extract.py` against the sample posts in `data/category`.
+
+Every sample post is rendered as a search result and a post page, as the benchmark's fake server
+does, and each extraction function of each engine is run on them: the overview of every search
+result, and the description, attributes and images of every post page. Their results must be
+equal between engines, and equal to the values stored for the post, so that a bug shared by both
+engines is caught too. Each difference is reported with the post and the field, and the exit
+status is 1 if there is any.
+    python -m scripts.check_extract_parity
+    python -m scripts.check_extract_parity --verbose
+"""
+import argparse
+import sys
+
+from bs4 import BeautifulSoup
+
+from scripts.benchmark import page_size, post_page, sample_dir, search_row
+from src import extract, lxml_extract, sinks
+
+# ========================================== Constants ===========================================
+# host the links of rendered search results point to
+host = 'https://parity.craigslist.org'
+
+# fields of a search result compared with the stored post. The link is rendered on `host`.
+overview_fields = ('title', 'pid', 'pid_repost', 'price', 'time')
+
+# {field of a post page: (soup function, lxml function)}
+post_functions = {
+    'description': (extract.get_description, lxml_extract.get_description),
+    'attributes': (extract.get_attributes, lxml_extract.get_attributes),
+    'images': (extract.get_images, lxml_extract.get_images),
+}
+
+
+# =========================================== Helpers ============================================
+def load_samples() -> list:
+    """
+    Load every sample post that has details, once per pid.
+    :return: [post], as written to detail files, ordered by pid
+    """
+    posts = {}
+    for fp in sorted(sample_dir.glob('*/*/*/*_DETAIL*')):
+        for post in sinks.read_records(fp):
+            if post.get('description') is not None:
+                posts[post['pid']] = post
+    return sorted(posts.values(), key=lambda p: p['pid'])
+
+
+def search_page(posts: list) -> bytes:
+    """ HTML of a search page listing the given posts """
+    rows = ''.join(search_row(post) for post in posts).replace('HOST', host)
+    return (f'<html><body><span class="totalcount">{len(posts)}</span>'
+            f'<ul class="rows">{rows}</ul></body></html>').encode()
+
+
+def stored_value(post: dict, field: str):
+    """
+    Value a post page rendered from a stored post must be parsed to, or None if it cannot be
+    rendered back: `html.parser` collapses a description made only of whitespace.
+    """
+    value = post[field]
+    if field == 'description' and not value.strip():
+        return None
+    return value
+
+
+class Report:
+    def __init__(self, verbose: bool = False):
+        """ Differences found, printed as they are found """
+        self.verbose = verbose
+        self.count = 0
+
+    def compare(self, what: str, field: str, actual, expected) -> None:
+        if actual == expected:
+            return
+        self.count += 1
+        print(f"{what} differs in: {field}")
+        if self.verbose:
+            print(f"    {actual!r}\n    != {expected!r}")
+
+
+# ============================================= Main =============================================
+def check(verbose: bool = False) -> int:
+    """
+    Run every extraction function of every engine on every sample post.
+    :param verbose: print the values that differ
+    :return: number of differences
+    """
+    posts = load_samples()
+    if not posts:
+        raise ValueError(f"No sample posts in: {sample_dir}")
+    report = Report(verbose)
+    for start in range(0, len(posts), page_size):
+        batch = posts[start:start + page_size]
+        page = search_page(batch)
+        soup_overviews, soup_total = extract.parse_search_page(page, 'soup')
+        lxml_overviews, lxml_total = extract.parse_search_page(page, 'lxml')
+        what = f"search page {start // page_size}"
+        report.compare(f"{what}: lxml", 'total count', lxml_total, soup_total)
+        report.compare(f"{what}: soup", 'total count', soup_total, len(batch))
+        report.compare(f"{what}: lxml", 'results', len(lxml_overviews), len(batch))
+        report.compare(f"{what}: soup", 'results', len(soup_overviews), len(batch))
+        for post, soup_overview, lxml_overview in zip(batch, soup_overviews, lxml_overviews):
+            for field in overview_fields:
+                report.compare(f"search result {post['pid']}: lxml", field,
+                               lxml_overview[field], soup_overview[field])
+                report.compare(f"search result {post['pid']}: soup", field,
+                               soup_overview[field], post[field])
+    for post in posts:
+        body = post_page(post).encode()
+        soup, doc = BeautifulSoup(body, 'html.parser'), lxml_extract.parse(body)
+        for field, (soup_function, lxml_function) in post_functions.items():
+            soup_value, lxml_value = soup_function(soup), lxml_function(doc)
+            report.compare(f"post {post['pid']}: lxml", field, lxml_value, soup_value)
+            expected = stored_value(post, field)
+            if expected is not None:
+                report.compare(f"post {post['pid']}: soup", field, soup_value, expected)
+    print(f"checked {len(posts)} posts")
+    return report.count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Print the values that differ')
+    args = parser.parse_args()
+    differences = check(args.verbose)
+    print(f"{differences} differences")
+    sys.exit(1 if differences else 0)
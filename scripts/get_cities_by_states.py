@@ -1,16 +1,26 @@
 """
-Downloads the cities for each state in the US, as recognized by Craiglist.
+Refresh the cities of each state in the US, as recognized by Craiglist, in
+config/city_url_by_state.json.
+
+Every state page is downloaded at once over one pooled session. Each request is conditional on
+the ETag / Last-Modified of the previous refresh, kept in data/city_map_state.json, so a state that
+has not changed costs a bodiless 304 response. The changes are printed as a diff, and the map is
+rewritten atomically, only if it changed. A state that still fails after retries keeps its
+previous cities.
 """
 import json
 import logging
+import os
 import sys
 import argparse
 import re
 import aiohttp
 import asyncio
 from bs4 import BeautifulSoup
-from urllib.parse import urlparse, ParseResult
-from src.utils import update_dict
+from urllib.parse import urljoin, urlparse, ParseResult
+from src import throttle
+from src.throttle import make_session
+from src.utils import get_project_root, update_dict
 
 # ========================================== Constants ===========================================
 states = ["AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DC", "DE", "FL", "GA",
@@ -25,11 +35,27 @@ url_pattern = re.compile(r"[\w]+\.craigslist\.org")
 # base url pattern for listing cities within a state
 base_url_parts = {k: '' for k in ['scheme', 'netloc', 'path', 'params', 'query', 'fragment']}
 base_url_parts.update({
-    'scheme': 'http',
+    'scheme': 'https',
     'netloc': 'geo.craigslist.org',
     'path': '/iso/us/{state}',
 })
 
+# the city map, and the validators of the state pages it was built from
+default_map_path = get_project_root().joinpath('config/city_url_by_state.json')
+default_state_path = get_project_root().joinpath('data/city_map_state.json')
+
+# a state with a single city redirects to it. Other redirects, e.g. to https, are followed, up to
+# `max_redirects` of them.
+redirect_statuses = {301, 302, 303, 307, 308}
+max_redirects = 5
+
+# host of the state pages, which is not a city site
+geo_host = base_url_parts['netloc']
+
+# A refresh is a single burst of ~50 small requests to one host, so it is not paced like a crawl.
+connections = 16
+requests_per_second = throttle.max_rate
+
 
 # =========================================== Helpers ============================================
 def construct_url(state: str) -> str:
@@ -44,30 +70,63 @@ def construct_url(state: str) -> str:
     return url
 
 
-def has_redirect(response: aiohttp.ClientResponse) -> bool:
-    """ Check if a response has a redirect in its history """
-    return any([r.status == 302 for r in response.history])
-
-
-def post_process(results: list) -> dict:
+def site_url(url: str) -> str:
     """
-    Post-process the results. Performs the following:
-        1. Lower-case all city names.
-        2. Package as nested dict by state --> city --> URL.
-    :param results: [ (state, [city, URL] ]
-    :return: {state: {city: URL}}
+    URL of a city, as in the city map, with an https scheme. Cities that are a subarea of a site
+    keep its path.
+    :param url: e.g. http://reno.craigslist.org/ or //newyork.craigslist.org/fct/
+    :return: e.g. https://reno.craigslist.org or https://newyork.craigslist.org/fct/
     """
-    state_city_links = {state: {city.lower(): link for city,link in city_links}
-                        for state,city_links in results}
-    return state_city_links
+    parts = urlparse(url)
+    path = parts.path if parts.path.strip('/') else ''
+    return f'https://{parts.netloc}{path}'
+
+
+def conditional_headers(previous: dict) -> dict:
+    """ Headers to revalidate the page a state was read from in the previous refresh """
+    headers = {}
+    if previous.get('etag'):
+        headers['If-None-Match'] = previous['etag']
+    if previous.get('last_modified'):
+        headers['If-Modified-Since'] = previous['last_modified']
+    return headers
 
 
-def show_results(results: dict) -> None:
+def diff_maps(old: dict, new: dict) -> list:
     """
-    Show results as JSON.
-    :param results: {state: {city: URL}}
+    Compare two city maps.
+    :param old: {state: {city: URL}}
+    :param new: {state: {city: URL}}
+    :return: lines like "+ NV elko https://elko.craigslist.org", "- ..." for removed cities and
+        "~ ..." for changed URLs
     """
-    print(json.dumps(results, indent=4, default=str))
+    lines = []
+    for state in sorted(old.keys() | new.keys()):
+        old_cities, new_cities = old.get(state) or {}, new.get(state) or {}
+        for city in sorted(old_cities.keys() | new_cities.keys()):
+            before, after = old_cities.get(city), new_cities.get(city)
+            if before is None:
+                lines.append(f"+ {state} {city} {after}")
+            elif after is None:
+                lines.append(f"- {state} {city} {before}")
+            elif before != after:
+                lines.append(f"~ {state} {city} {before} -> {after}")
+    return lines
+
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_json_atomic(path, data) -> None:
+    """ Write a JSON file, so that readers see either the old or the new file but never part """
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(data, indent=4) + '\n')
+    os.replace(tmp, path)
 
 
 # =========================================== Core ===============================================
@@ -86,53 +145,134 @@ def extract_city(url: str) -> str:
     return city
 
 
-async def get_city_links(state: str) -> list:
-    # download page for this state
-    url = construct_url(state)
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            # redirect means this state has a single page
-            if has_redirect(response):
-                name = extract_city(str(response.url))
-                return [(name, response.url)]
+def is_city_site(url: str) -> bool:
+    """ Whether a URL is on the site of a city, e.g. https://reno.craigslist.org/ """
+    netloc = urlparse(url).netloc
+    return bool(url_pattern.fullmatch(netloc)) and netloc != geo_host
+
 
-            # otherwise look for the URLs of each city
-            soup = BeautifulSoup(await response.text(), 'html.parser')
-            lines = soup.body.div.section.div.ul
-            cityname_link = [(a.get_text(), a['href']) for a in lines.findAll('a', href=True)]
-            return cityname_link
+def parse_city_links(body: bytes) -> dict:
+    """
+    Parse the list of cities of a state page.
+    :param body: of the page
+    :return: {city: URL}, city names being lower-cased
+    """
+    soup = BeautifulSoup(body, 'html.parser')
+    lines = soup.body.div.section.div.ul
+    return {a.get_text().lower(): site_url(a['href']) for a in lines.findAll('a', href=True)}
 
 
-# =========================================== Main ===============================================
-async def get_city_links_wrapper(state):
-    try:
-        res = await get_city_links(state)
-        return state, res  # add run identifier (state name) to return
-    except Exception:
-        logging.error(f"Error for state: {state}", exc_info=True)
+async def get_city_links(state: str, session: aiohttp.ClientSession,
+                         previous: dict = None) -> dict:
+    """
+    Get the cities of a state.
+    :param state: State abbreviation.
+    :param session: HTTP session to use
+    :param previous: as returned by the previous refresh. If given, the state page is only
+        downloaded if it changed since.
+    :return: {cities: {city: URL}, etag, last_modified, modified}, modified being False if the
+        previous cities were reused
+    """
+    url = construct_url(state)
+    headers = conditional_headers(previous) if previous else {}
+    for _ in range(max_redirects + 1):
+        status, response_headers, body = await throttle.get(url, session, headers,
+                                                            allow_redirects=False)
+        if status not in redirect_statuses:
+            break
+        url = urljoin(url, response_headers['Location'])
+        # a redirect to the site of a city means this state has a single page
+        if is_city_site(url):
+            break
+    else:
+        raise ValueError(f"Too many redirects for state: {state}")
+    if status == 304:
+        return dict(previous, modified=False)
+    if status in redirect_statuses:
+        cities = {extract_city(url): site_url(url)}
+    else:
+        cities = parse_city_links(body)
+    return {
+        'cities': cities,
+        'etag': response_headers.get('ETag'),
+        'last_modified': response_headers.get('Last-Modified'),
+        'modified': True,
+    }
 
 
-async def main():
-    # schedule the async tasks
-    tasks = [asyncio.create_task(get_city_links_wrapper(s)) for s in states]
-    # wait for all tasks to finish
-    results = await asyncio.gather(*tasks)
-    # post-process results
-    results = post_process(results)
-    # gather results and write to file
-    show_results(results)
+# =========================================== Main ===============================================
+async def refresh(city_map: dict, previous: dict, refresh_states: list = None) -> tuple:
+    """
+    Refresh the cities of every state, or of the given states.
+    :param city_map: {state: {city: URL}} to refresh
+    :param previous: {state: {cities, etag, last_modified}}, as saved by the previous refresh
+    :param refresh_states: State abbreviations. If not given, every state is refreshed.
+    :return: ( new city map, new previous, [state] that failed )
+    """
+    refresh_states = refresh_states or states
+    # Validators are only used while the map still has the cities they validated, e.g. not after
+    # the map was edited by hand.
+    previous = {s: p for s, p in previous.items() if p.get('cities') == city_map.get(s)}
+    async with make_session(limit_per_host=connections) as session:
+        throttle.set_rate(geo_host, requests_per_second)
+        results = await asyncio.gather(
+            *[get_city_links(s, session, previous.get(s)) for s in refresh_states],
+            return_exceptions=True)
+    new_map, new_previous, failed = dict(city_map), dict(previous), []
+    for state, result in zip(refresh_states, results):
+        if isinstance(result, Exception):
+            logging.error(f"Error for state: {state}", exc_info=result)
+            failed.append(state)
+            continue
+        # A page without cities, or listing the state pages themselves, is not trusted over the
+        # cities the map already has.
+        if not result['cities'] or not all(map(is_city_site, result['cities'].values())):
+            logging.error(f"No city sites found for state: {state}: {result['cities']}")
+            failed.append(state)
+            continue
+        new_map[state] = result['cities']
+        new_previous[state] = {k: v for k, v in result.items() if k != 'modified'}
+    unchanged = sum(1 for r in results if isinstance(r, dict) and not r['modified'])
+    print(f"Refreshed {len(refresh_states) - len(failed)} states, {unchanged} not modified, "
+          f"{len(failed)} failed")
+    return new_map, new_previous, failed
 
 
 if __name__ == '__main__':
-    desc = 'Get cities grouped by state, as recognized by Craigslist'
+    desc = 'Refresh the cities grouped by state, as recognized by Craigslist'
     parser = argparse.ArgumentParser(description=desc)
-    parser.add_argument('file', default=False, nargs='?',
-                        help='File to write results to. Otherwise prints to stdout')
+    parser.add_argument('file', nargs='?', default=default_map_path,
+                        help='City map to refresh, by default the one the scrapers read')
+    parser.add_argument('--states', nargs='+', metavar='STATE',
+                        help='State abbreviations to refresh. Others are kept as they are.')
+    parser.add_argument('--state-file', default=default_state_path,
+                        help='Validators of the previous refresh, for conditional requests')
+    parser.add_argument('--diff', metavar='PATH',
+                        help='Also write the changes to this file')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print the changes without writing anything')
     args = parser.parse_args()
 
-    # redirect stdout to file
-    if args.file:
-        sys.stdout = open(args.file, 'w+')
+    refresh_states = [s.upper() for s in args.states] if args.states else None
+    for state in refresh_states or []:
+        if state not in states:
+            parser.error(f"Invalid state abbreviation: {state}")
 
     # run the program
-    asyncio.run(main())
+    city_map = load_json(args.file, {})
+    new_map, new_previous, failed = asyncio.run(
+        refresh(city_map, load_json(args.state_file, {}), refresh_states))
+    changes = diff_maps(city_map, new_map)
+    for line in changes:
+        print(line)
+    if args.diff:
+        with open(args.diff, 'w') as f:
+            f.write(''.join(line + '\n' for line in changes))
+    if not args.dry_run:
+        if changes:
+            write_json_atomic(args.file, new_map)
+            print(f"Saved {len(changes)} changes to:\t {args.file}")
+        os.makedirs(os.path.dirname(os.path.abspath(args.state_file)), exist_ok=True)
+        write_json_atomic(args.state_file, new_previous)
+    # A state that failed kept its previous cities; report it to cron or CI.
+    sys.exit(1 if failed else 0)
@@ -4,14 +4,21 @@ and city.
 """
 import asyncio
 import json
-from typing import Tuple
+import logging
+import os
+import re
+from typing import AsyncIterator, Optional, Tuple
 
 import aiohttp
 
-from bs4 import BeautifulSoup
-from src.query_post import extract_overview_info
-from src.scrape_post import get_city, get_description, get_attributes, get_images
-from src.utils import get_project_root, get_timestamp, to_valid_filename
+from src import (dedup, extract, http_cache, image_store, journal, metrics, post_store, schema,
+                 search_index, sinks, throttle, watch)
+from src.extract import get_city
+from src.resolver import get_resolver
+from src.throttle import make_session
+from src.post_details import detail_fields, get_post_details_or_error
+from src.utils import (get_project_root, get_timestamp, run_bounded, split_site_url,
+                       to_valid_filename)
 
 # ========================================== CONSTANTS ===========================================
 # root directory
@@ -23,159 +30,428 @@ out_dir = root_dir.joinpath('data/category')
 # base URL for search by "for sale" category
 url_path_template = r'{baseUrl}/d/{catName}/search/{catAbbr}'
 
-# read state,city --> URL mapping
-location_urls = root_dir.joinpath('config/city_url_by_state.json')
-with open(location_urls, 'r') as f:
-    state_city_to_url = json.load(f)
+# query parameter holding the offset of the first result on a search page
+offset_param = 's'
 
-# read category names and abbreviations
-file_abbreviations = root_dir.joinpath('config/category_abbreviations.json')
-with open(file_abbreviations, 'r') as f:
-    cat_abbr = json.load(f)
+# formats results can be written in: indented JSON at the end of each city, JSON Lines streamed
+# as each post is scraped, or upserted into the SQLite post store
+output_formats = ('json',) + sinks.formats + ('sqlite',)
+
+# default number of cities crawled at the same time by `scrape_category_all`
+default_concurrency = 4
+
+# file names of a run that wrote every post of a city start with its timestamp only, see
+# `get_timestamp`. Files of runs that wrote some posts have a tag after it, e.g. `poll_tag`.
+full_run_pattern = re.compile(r'\d{2}-\d{2}-\d{4}_\d{2}-\d{2}-\d{2}[AP]M')
+
+# tag of the files written by the polls of watch mode after the first one
+poll_tag = 'poll'
 
 # ========================================== HELPERS =============================================
 def build_url(base_url, category):
     """
     Build URL for a given category under the "for sale" section.
     :param category: a category under the "for sale" section of Craigslist
-    :param base_url: URL to specific craiglist loc, e.g "lancaster.craigslist.org"
+    :param base_url: URL to specific craiglist loc, e.g "lancaster.craigslist.org", or to a
+        subarea of one, e.g. "//newyork.craigslist.org/fct/"
     :return: URL string
     """
     # grab category abbreviation
-    abbr = cat_abbr[category]
+    category = get_resolver().resolve_category(category)
+    abbr = get_resolver().categories[category]
     # replace space with `-`
     category = category.replace(' ', '-')
-    url = url_path_template.format(baseUrl=base_url, catName=category, catAbbr=abbr)
+    # a subarea is searched under its site, e.g. newyork.craigslist.org/d/.../search/fct/moa
+    site, subarea = split_site_url(base_url)
+    if subarea:
+        abbr = f'{subarea}/{abbr}'
+    url = url_path_template.format(baseUrl=site, catName=category, catAbbr=abbr)
     return url
 
-def write_data(data, fp):
-    with open(fp, 'w+') as f:
-        json.dump(data, f, indent=2)
-
-async def url_to_soup(url: str, session: aiohttp.ClientSession) -> BeautifulSoup:
-    """ Download webpage, package as BeautifulSoup """
-    async with session.get(url) as response:
-        return BeautifulSoup(await response.text(), 'html.parser')
+def page_url(url: str, offset: int) -> str:
+    """
+    Build URL for the search page starting at the given result offset.
+    :param url: search URL, as returned by `build_url`
+    :param offset: index of the first result on the page
+    :return: URL string
+    """
+    if offset == 0:
+        return url
+    sep = '&' if '?' in url else '?'
+    return f'{url}{sep}{offset_param}={offset}'
 
 
-async def write_results(state: str, city: str, category: str,
-                        post_overviews: list, post_details: list) -> None:
-    """ Write result posts to files. """
+def get_result_dir(state: str, city: str, category: str):
+    """ Get directory that results for the given state, city and category are written to """
     # Ensure all values are compatible with a Path.
     state, city, category = map(to_valid_filename, [state, city, category])
+    return out_dir.joinpath(category, state, city)
+
+
+def load_post_index(state: str, city: str, category: str) -> dict:
+    """
+    Index the posts already scraped for a state, city and category, by reading the detail files
+    of the latest run that wrote every post of the city, and those written since, in any of
+    `output_formats`. Such a run writes the details of all posts it found, reused or not, so older
+    runs only hold posts that have since been taken down, and reading them would make startup
+    grow with the number of runs. Newer files take precedence over older ones.
+    :param state: State abbreviation.
+    :param city: City within above state.
+    :param category: a 'for sale' category, e.g. 'cell phones'
+    :return: {pid: post_detail}, also keyed by the first pid of each repost chain. Posts are
+        `schema.Post`, as the index of a large city is kept in memory for the whole crawl.
+    """
+    result_dir = get_result_dir(state, city, category)
+    if not result_dir.is_dir():
+        return {}
+    files = [fp for fp in result_dir.glob('*_DETAIL*') if fp.suffix != sinks.part_suffix]
+    files.sort(key=lambda fp: fp.stat().st_mtime)
+    # Rotated JSON Lines files of a run follow its first one. Without a full run, e.g. for
+    # the output of `src/distributed.py`, every file is read.
+    runs = [fp.name[:fp.name.index('_DETAIL')] for fp in files]
+    full_runs = [run for run in runs if full_run_pattern.fullmatch(run)]
+    if full_runs:
+        files = files[runs.index(full_runs[-1]):]
+    chains, pids = {}, {}
+    for fp in files:
+        for post in map(schema.Post, sinks.read_records(fp)):
+            chains[post['pid_repost'] or post['pid']] = post
+            pids[post['pid']] = post
+    # Exact pid matches win over repost chain matches.
+    chains.update(pids)
+    return chains
+
+
+def find_previous_details(post_index: dict, post_overview: dict) -> Optional[dict]:
+    """
+    Look up the details of an already scraped post, by its pid or the pid it is a repost of.
+    A post whose title or price has changed since it was scraped is treated as new.
+    :param post_index: as returned by `load_post_index`
+    :param post_overview: as returned by `extract_overview_info`
+    :return: {city, description, ...} of the previous post, or None if it must be scraped
+        again because it is new, changed, or failed last time
+    """
+    previous = post_index.get(post_overview['pid'])
+    if previous is None and post_overview['pid_repost']:
+        previous = post_index.get(post_overview['pid_repost'])
+    if previous is None or previous.get('error'):
+        return None
+    if previous['title'] != post_overview['title'] or previous['price'] != post_overview['price']:
+        return None
+    return {k: previous[k] for k in detail_fields}
+
+
+def write_data(data, fp):
+    with open(fp, 'w+') as f:
+        json.dump(data, f, indent=2, default=schema.to_json)
+
+async def write_results(state: str, city: str, category: str,
+                        post_overviews: list, post_details: list, tag: str = None) -> None:
+    """
+    Write result posts to files.
+    :param tag: added to file names after the timestamp, so that several writers of the same
+        city never write to the same file, see `src/distributed.py`. Tagged files hold only some
+        posts of the city, see `load_post_index`.
+    """
     # Initialize output directories.
-    result_dir = out_dir.joinpath(category, state, city)
+    result_dir = get_result_dir(state, city, category)
     result_dir.mkdir(parents=True, exist_ok=True)
-    # Save post overviews.
-    timestamp = get_timestamp()
-    out_path_overview = result_dir.joinpath(f'{timestamp}_OVERVIEW.json')
-    write_data(post_overviews, out_path_overview)
-    # Save post detailed info.
-    out_path_detail = result_dir.joinpath(f'{timestamp}_DETAIL.json')
-    write_data(post_details, out_path_detail)
+    with metrics.timer('stage_seconds', stage='write_results'):
+        timestamp = get_timestamp() if tag is None else f'{get_timestamp()}_{tag}'
+        out_path_overview = result_dir.joinpath(f'{timestamp}_OVERVIEW.json')
+        out_path_detail = result_dir.joinpath(f'{timestamp}_DETAIL.json')
+        # Both files are written as `.part` and renamed once both are complete, so a failure
+        # leaves no file that looks finished.
+        parts = [fp.with_name(fp.name + sinks.part_suffix)
+                 for fp in (out_path_overview, out_path_detail)]
+        try:
+            # Save post overviews.
+            write_data(post_overviews, parts[0])
+            # Save post detailed info.
+            write_data(post_details, parts[1])
+        except BaseException:
+            for fp in parts:
+                if fp.exists():
+                    fp.unlink()
+            raise
+        os.replace(parts[0], out_path_overview)
+        os.replace(parts[1], out_path_detail)
+    index = search_index.get_index()
+    if index is not None:
+        with metrics.timer('stage_seconds', stage='index'):
+            index.index_file(out_path_detail)
     # Log
     print(f"Saved overviews to:\t {out_path_overview}")
     print(f"Saved details to:\t {out_path_detail}")
 
 # ========================================== WORKERS =============================================
-async def get_post_overviews(url: str, session: aiohttp.ClientSession) -> list:
+async def get_search_page(url: str, session: aiohttp.ClientSession,
+                          revalidate: bool = False) -> Tuple[list, int]:
     """
-    Get post overview information for a given URL.
+    Get post overview information for a single search results page.
+    :param url: Craigslist search result page
+    :param session: HTTP session to use
+    :param revalidate: check with the server even if the page is freshly cached
+    :return: ( [{title, link, ...}] high-level post info, total result count )
+    """
+    with metrics.timer('stage_seconds', stage='search_page'):
+        body = await http_cache.fetch(url, session, revalidate)
+    # Parsing is cpu bound, so it runs in the process pool if one was started. The engine is
+    # passed explicitly since worker processes do not see `extract.set_engine`.
+    return await extract.run_parser(extract.parse_search_page, body, extract.default_engine)
+
+
+async def get_page_overviews(url: str, session: aiohttp.ClientSession) -> list:
+    """
+    Get post overview information for a single search results page.
     :param url: Craigslist search result page
     :param session: HTTP session to use
     :return: [{title, link, ...}] high-level post info
     """
-    soup = await url_to_soup(url, session)
-    posts = soup.find_all('li', class_='result-row')
-    # async version of next step did not affect performance (bc. cpu/mem bound)
-    post_data = [extract_overview_info(p) for p in posts]
+    post_data, _ = await get_search_page(url, session)
     return post_data
 
 
-async def get_post_details(url: str, session: aiohttp.ClientSession) -> dict:
+async def iter_post_overviews(url: str, session: aiohttp.ClientSession) -> AsyncIterator[list]:
     """
-    Extract details from a craigslist post link.
-    :param url: Link to a post
+    Get post overview information for every search results page of a given URL, one page at a
+    time. The first page gives the total result count, after which all remaining pages are
+    downloaded concurrently and yielded in the order they finish.
+    :param url: Craigslist search result page
+    :param session: HTTP session to use
+    :return: async iterator of [{title, link, ...}], one list per page
+    """
+    first_page, total = await get_search_page(url, session)
+    yield first_page
+    page_size = len(first_page)
+    if not page_size or total <= page_size:
+        return
+    # Prefetch the remaining pages.
+    tasks = [asyncio.create_task(get_page_overviews(page_url(url, offset), session))
+             for offset in range(page_size, total, page_size)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            # A page that still fails after retries is skipped rather than losing the others.
+            try:
+                yield await task
+            except Exception:
+                logging.error(f"Error for search page of: {url}", exc_info=True)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def iter_new_post_overviews(url: str, session: aiohttp.ClientSession,
+                                  since_pid: int) -> AsyncIterator[list]:
+    """
+    Get post overview information for the posts newer than a given pid. Results are newest
+    first, so pages are downloaded one at a time and reading stops at the first page with a post
+    that is not new, which is usually the first page.
+    :param url: Craigslist search result page
     :param session: HTTP session to use
-    :return: {title, price, ...}
-    """
-    city = get_city(url)
-    soup = await url_to_soup(url, session)
-    desc = get_description(soup)
-    attributes = get_attributes(soup)
-    images = get_images(soup)
-    pd = {
-        'city': city,
-        'description': desc,
-        'attributes': attributes,
-        'images': images
-    }
-    return pd
+    :param since_pid: newest pid seen so far
+    :return: async iterator of [{title, link, ...}], one list per page
+    """
+    offset = 0
+    while True:
+        page, total = await get_search_page(page_url(url, offset), session, revalidate=True)
+        new_posts = [p for p in page if int(p['pid']) > since_pid]
+        if new_posts:
+            yield new_posts
+        offset += len(page)
+        if len(new_posts) < len(page) or not page or offset >= total:
+            return
+
+
+async def get_post_overviews(url: str, session: aiohttp.ClientSession) -> list:
+    """
+    Get post overview information for a given URL, following every page of search results.
+    :param url: Craigslist search result page
+    :param session: HTTP session to use
+    :return: [{title, link, ...}] high-level post info
+    """
+    post_data = []
+    with metrics.timer('stage_seconds', stage='post_overviews'):
+        async for page in iter_post_overviews(url, session):
+            post_data.extend(page)
+    return post_data
 
 
 # ============================================ API ===============================================
-async def scrape_category(base_url: str, category: str) -> Tuple[list, list]:
+async def get_post_record(post_overview: dict, session: aiohttp.ClientSession, sink=None,
+                          listings: dedup.ListingIndex = None,
+                          city_journal: journal.CityJournal = None) -> Optional[dict]:
+    """
+    Get details of a post and merge them with its overview. A post that fails after retries is
+    recorded with its error instead of raising. If images are enabled, the post's images are
+    downloaded too, see `src/image_store.py`, and listed in its `image_files`.
+    :param post_overview: as returned by `extract_overview_info`
+    :param session: HTTP session to use
+    :param sink: if given, the record is written to it and not returned
+    :param listings: if given, details are downloaded once per listing and shared with every
+        other post of the same repost chain in this run
+    :param city_journal: if given, the record is journaled so a restarted run can reuse it
+    :return: {city, description, ..., title, link, ...} as a `schema.Post`, as it is kept in
+        memory until its city is written, or None if written to sink
+    """
+    url = post_overview['link']
+    if listings is None:
+        post_detail = await get_post_details_or_error(url, session)
+    else:
+        post_detail = await listings.details(post_overview,
+                                             lambda: get_post_details_or_error(url, session))
+        # The details may have been downloaded for the same listing in another city.
+        post_detail['city'] = get_city(url)
+    if not post_detail.get('error'):
+        image_files = await image_store.fetch_post_images(post_detail, session)
+        # The stored files of the images, so they can be joined back to the post by sha256.
+        if image_files:
+            post_detail['image_files'] = image_files
+    post_detail.update(post_overview)
+    if city_journal is not None and not post_detail.get('error'):
+        city_journal.record(post_detail)
+    if sink is None:
+        return schema.Post(post_detail)
+    with metrics.timer('stage_seconds', stage='write_results'):
+        sink.write_details(post_detail)
+
+
+async def scrape_category(base_url: str, category: str, session: aiohttp.ClientSession = None,
+                          post_index: dict = None, sink=None,
+                          listings: dedup.ListingIndex = None, since_pid: int = None,
+                          city_journal: journal.CityJournal = None) -> Tuple[list, list]:
     """
     Scrape all posts in a category, within given base url.
     :param base_url: specific CL link, e.g. lancaster.craigslist.org
     :param category: a 'for sale' category, e.g. 'cell phones'
-    :return: ( [post_overview], [post_detail] )
+    :param session: HTTP session to use. If not given, one is created for this call.
+    :param post_index: already scraped posts, as returned by `load_post_index`. If given, details
+        are only downloaded for posts that are new or changed.
+    :param sink: e.g. `sinks.JsonLinesSink`. If given, each page of overviews and each post
+        detail is written to it as soon as it is available, instead of being returned.
+    :param listings: index of the listings in this run. If given, the details of a listing that
+        shows up in several cities, or as several reposts, are only downloaded once.
+    :param since_pid: if given, only posts with a greater pid are scraped
+    :param city_journal: if given, every downloaded post is journaled to it
+    :return: ( [post_overview], [post_detail] ), post_detail being empty if sink is given.
+        Posts are `schema.Post`, as they are kept in memory until the city is written.
     """
+    if session is None:
+        async with make_session() as session:
+            return await scrape_category(base_url, category, session, post_index, sink,
+                                         listings, since_pid, city_journal)
+
     url = build_url(base_url, category)
     print(f"searching URL: {url}")
 
-    # Reuse single HTTP session.
-    async with aiohttp.ClientSession() as session:
-        # Get search results, which are posts.
-        post_overviews = await get_post_overviews(url, session)
-        # Follow each search result to get post details.
-        tasks = [asyncio.create_task(get_post_details(p['link'], session)) for p in post_overviews]
-        post_details = await asyncio.gather(*tasks)
-
-    # Update each post with details.
-    for i,detail in enumerate(post_details):
-        detail.update(post_overviews[i])
-    # Return results.
+    # Get search results, which are posts. Follow each search result to get post details as
+    # soon as its page arrives, so details download while later pages are still in flight.
+    # The session's connector caps how many of these are in flight at once.
+    post_overviews, post_details, tasks = [], [], []
+    if since_pid is None:
+        pages = iter_post_overviews(url, session)
+    else:
+        pages = iter_new_post_overviews(url, session, since_pid)
+    async for page in pages:
+        # Previous details are looked up before the page is written, since writing it to the
+        # post store updates the title and price it is compared against.
+        for p in page:
+            previous = None
+            # The Bloom filter of the listing index rules out most new posts without a lookup.
+            if post_index and (listings is None or listings.seen_before(p)):
+                previous = find_previous_details(post_index, p)
+            if listings is not None:
+                listings.add(p)
+            if previous is None:
+                previous = asyncio.create_task(
+                    get_post_record(p, session, sink, listings, city_journal))
+                tasks.append(previous)
+            else:
+                previous.update(p)
+                if sink is not None:
+                    with metrics.timer('stage_seconds', stage='write_results'):
+                        sink.write_details(previous)
+                    continue
+                previous = schema.Post(previous)
+            post_details.append(previous)
+        if sink is not None:
+            with metrics.timer('stage_seconds', stage='write_results'):
+                sink.write_overviews(page)
+        post_overviews.extend(schema.compact(page))
+    await asyncio.gather(*tasks)
+    if post_index:
+        metrics.inc('posts_reused_total', len(post_overviews) - len(tasks))
+        print(f"reused {len(post_overviews) - len(tasks)} unchanged posts from: {url}")
+
+    if sink is not None:
+        return post_overviews, []
+    post_details = [d.result() if isinstance(d, asyncio.Task) else d for d in post_details]
     return post_overviews, post_details
 
 
-async def scrape_category_location(state: str, city: str, category: str) -> Tuple[list, list]:
+async def scrape_category_location(state: str, city: str, category: str,
+                                   session: aiohttp.ClientSession = None,
+                                   incremental: bool = False, sink=None,
+                                   listings: dedup.ListingIndex = None,
+                                   since_pid: int = None) -> Tuple[list, list]:
     """
     Scrape all posts in a category within the state and city specified.
     :param state: State abbreviation.
     :param city: City within above state.
     :param category: a 'for sale' category, e.g. 'cell phones'
+    :param session: HTTP session to use. If not given, one is created for this call.
+    :param incremental: only download details of posts not already on disk
+    :param sink: if given, posts are written to it as they are scraped. See `scrape_category`.
+    :param listings: index of the listings in this run. See `scrape_category`.
+    :param since_pid: if given, only posts with a greater pid are scraped
     :return: ( [post_overview], [post_detail] )
     """
-    # Validate input arguments.
-    state, city = state.upper(), city.lower()
-    city_to_url = state_city_to_url.get(state, None)
-    if not city_to_url:
-        raise ValueError(f"Invalid state abbreviation: {state}")
-    base_url = city_to_url.get(city, None)
-    if not base_url:
-        raise ValueError(f"City '{city}' not found in state '{state}'")
-
-    # get base URL
-    base_url = state_city_to_url[state][city]
+    # Validate input arguments, and get base URL
+    resolver = get_resolver()
+    state = resolver.resolve_state(state)
+    city = resolver.resolve_city(state, city)
+    base_url = resolver.city_url(state, city)
+    # index posts already on disk. The post store is indexed already.
+    post_index = None
+    if incremental:
+        if isinstance(sink, post_store.StoreSink):
+            post_index = sink.store
+        else:
+            post_index = load_post_index(state, city, category)
+    # If the run is journaled, posts downloaded by an interrupted attempt of it are reused.
+    city_journal = None
+    run_journal = journal.get_journal()
+    if run_journal is not None:
+        city_journal = post_index = run_journal.city(state, city, post_index)
+        if listings is not None:
+            for post in city_journal.records():
+                listings.add(post)
     # return results
-    return await scrape_category(base_url, category)
+    return await scrape_category(base_url, category, session, post_index, sink, listings,
+                                 since_pid, city_journal)
 
 
-async def scrape_category_state(state: str, category: str) -> dict:
+async def scrape_category_state(state: str, category: str, session: aiohttp.ClientSession = None,
+                                incremental: bool = False) -> dict:
     """
     Scrape all posts in a category within all cities in the given state.
     :param state: State abbreviation.
     :param category: a 'for sale' category, e.g. 'cell phones'
-    :return: {city_name: ( [post_overview], [post_detail] )}
+    :param session: HTTP session to use. If not given, one is created and shared by all cities.
+    :param incremental: only download details of posts not already on disk
+    :return: {city_name: ( [post_overview], [post_detail] )}. Nothing is written to disk, but
+        if the run is journaled, see `src/journal.py`, a restarted run reuses the details of the
+        posts downloaded before it was interrupted.
     """
     # Validate input argument
-    city_to_url = state_city_to_url.get(state, None)
-    if not city_to_url:
-        raise ValueError(f"Invalid state abbreviation: {state}")
+    state = get_resolver().resolve_state(state)
+    if session is None:
+        async with make_session() as session:
+            return await scrape_category_state(state, category, session, incremental)
     # Run for each city
-    cities = list(city_to_url.keys())
-    tasks = [asyncio.create_task(scrape_category_location(state, city, category))
+    cities = list(get_resolver().cities[state])
+    tasks = [asyncio.create_task(
+                 scrape_category_location(state, city, category, session, incremental))
              for city in cities]
     # Package result per-city. From the docs: "The order of result values
     # corresponds to the order of awaitables".
@@ -184,43 +460,381 @@ async def scrape_category_state(state: str, category: str) -> dict:
     return city_result
 
 
-async def scrape_category_all(category: str) -> Tuple[list, list]:
+async def scrape_city(state: str, city: str, category: str,
+                      session: aiohttp.ClientSession = None, incremental: bool = False,
+                      output: str = 'json', listings: dedup.ListingIndex = None) -> int:
+    """
+    Scrape all posts in a category within the state and city specified, and write them to disk.
+    :param state: State abbreviation.
+    :param city: City within above state.
+    :param category: a 'for sale' category, e.g. 'cell phones'
+    :param session: HTTP session to use. If not given, one is created for this call.
+    :param incremental: only download details of posts not already on disk
+    :param output: one of `output_formats`. JSON Lines and SQLite are written post by post.
+    :param listings: index of the listings in this run. See `scrape_category`.
+    :return: number of posts written
+    """
+    # A journaled run skips the cities written by an interrupted attempt of it.
+    run_journal = journal.get_journal()
+    if run_journal is not None and run_journal.is_finished(state.upper(), city.lower()):
+        print(f"skipping finished city: {city}, {state}")
+        return run_journal.finished[(state.upper(), city.lower())]
+    # The city stays pending if it fails at any step, so the journal is not deleted without it.
+    if run_journal is not None:
+        run_journal.start_city(state.upper(), city.lower())
+    post_overviews = await scrape_city_posts(state, city, category, session, incremental, output,
+                                             listings)
+    if run_journal is not None:
+        run_journal.finish_city(state.upper(), city.lower(), len(post_overviews))
+    return len(post_overviews)
+
+
+async def scrape_city_posts(state: str, city: str, category: str,
+                            session: aiohttp.ClientSession = None, incremental: bool = False,
+                            output: str = 'json', listings: dedup.ListingIndex = None,
+                            since_pid: int = None) -> list:
+    """
+    Same as `scrape_city`, returning the posts written.
+    :param since_pid: if given, only posts with a greater pid are scraped, and nothing is
+        written if there are none
+    :return: [post_overview]
+    """
+    if output not in output_formats:
+        raise ValueError(f"Invalid output format: {output}, expected one of {output_formats}")
+    with metrics.span('city', state=state, city=city):
+        post_overviews = await write_city_posts(state, city, category, session, incremental,
+                                                output, listings, since_pid)
+    metrics.inc('posts_total', len(post_overviews), state=state, city=city)
+    return post_overviews
+
+
+async def write_city_posts(state: str, city: str, category: str,
+                           session: aiohttp.ClientSession, incremental: bool, output: str,
+                           listings: dedup.ListingIndex, since_pid: Optional[int]) -> list:
+    """ Scrape and write the posts of a city, see `scrape_city_posts` """
+    if output == 'json':
+        post_overviews, post_details = await scrape_category_location(
+            state, city, category, session, incremental, listings=listings, since_pid=since_pid)
+        if post_overviews or since_pid is None:
+            await write_results(state, city, category, post_overviews, post_details,
+                                None if since_pid is None else poll_tag)
+        return post_overviews
+    if output == 'sqlite':
+        store = post_store.get_store()
+        sink, destination = store.sink(state, city, category), store.path
+    else:
+        destination = get_result_dir(state, city, category)
+        timestamp = get_timestamp() if since_pid is None else f'{get_timestamp()}_{poll_tag}'
+        sink = sinks.JsonLinesSink(destination, timestamp, output)
+    with sink:
+        post_overviews, _ = await scrape_category_location(state, city, category, session,
+                                                           incremental, sink, listings, since_pid)
+    if post_overviews or since_pid is None:
+        print(f"Saved posts to:\t {destination}")
+    return post_overviews
+
+
+async def scrape_category_all(category: str, concurrency: int = default_concurrency,
+                              session: aiohttp.ClientSession = None, incremental: bool = False,
+                              output: str = 'json', states: list = None,
+                              listings: dedup.ListingIndex = None) -> dict:
     """
-    TODO due to memory limitations, this should not return all results at once.
-    Scrape all posts in a category within all of the US.
+    Scrape all posts in a category within all of the US, or within the given states.
+    Cities are fed through a bounded queue to a fixed number of workers. Each city's results are
+    written to disk as soon as that city finishes, so memory does not grow with the number of
+    cities crawled.
     :param category: a 'for sale' category, e.g. 'cell phones'
-    :return: ( [post_overview], [post_detail] )
+    :param concurrency: number of cities to crawl at the same time
+    :param session: HTTP session to use. If not given, one is created and shared by all cities.
+    :param incremental: only download details of posts not already on disk
+    :param output: one of `output_formats`
+    :param states: State abbreviations. If not given, every state is searched.
+    :param listings: index of the listings in this run. See `scrape_category`.
+    :return: {state: {city: number of posts written}}
+    """
+    if concurrency < 1:
+        raise ValueError(f"Concurrency must be at least 1, got: {concurrency}")
+    resolver = get_resolver()
+    states = [resolver.resolve_state(s) for s in states] if states else resolver.states()
+    if session is None:
+        async with make_session() as session:
+            return await scrape_category_all(category, concurrency, session, incremental,
+                                             output, states, listings)
+    counts = {state: {} for state in states}
+
+    async def scrape(location):
+        state, city = location
+        counts[state][city] = await scrape_city(state, city, category, session, incremental,
+                                                output, listings)
+
+    await run_bounded(((state, city) for state in states for city in resolver.cities[state]),
+                      scrape, concurrency, lambda loc: f"city: {loc[1]}, {loc[0]}")
+    return counts
+
+
+async def watch_city(state: str, city: str, category: str, session: aiohttp.ClientSession,
+                     schedule: watch.PollSchedule, limiter: asyncio.Semaphore,
+                     incremental: bool = False, output: str = 'json',
+                     listings: dedup.ListingIndex = None) -> None:
     """
-    pass
+    Poll a city forever, writing only the posts that are new since the previous poll. The first
+    poll scrapes every post, like `scrape_city`.
+    :param state: State abbreviation.
+    :param city: City within above state.
+    :param category: a 'for sale' category, e.g. 'cell phones'
+    :param session: HTTP session to use
+    :param schedule: when to poll the city
+    :param limiter: bounds the number of cities polled at the same time
+    :param incremental: on the first poll, only download details of posts not already on disk
+    :param output: one of `output_formats`
+    :param listings: index of the listings in this run. See `scrape_category`.
+    """
+    since_pid = None
+    while True:
+        await schedule.wait()
+        async with limiter:
+            try:
+                post_overviews = await scrape_city_posts(state, city, category, session,
+                                                         incremental and since_pid is None,
+                                                         output, listings, since_pid)
+            except Exception:
+                logging.error(f"Error for city: {city}, {state}", exc_info=True)
+                schedule.update(0)
+                continue
+        if post_overviews:
+            since_pid = max([since_pid or 0] + [int(p['pid']) for p in post_overviews])
+        elif since_pid is None:
+            # no posts at all, so anything found later is new
+            since_pid = 0
+        interval = schedule.update(len(post_overviews))
+        if post_overviews:
+            print(f"{len(post_overviews)} new posts in: {city}, {state}. "
+                  f"Next poll in {interval:.0f}s")
+
+
+async def watch_category(category: str, concurrency: int = default_concurrency,
+                         session: aiohttp.ClientSession = None, incremental: bool = False,
+                         output: str = 'json', states: list = None, cities: list = None,
+                         listings: dedup.ListingIndex = None,
+                         min_interval: float = watch.min_interval,
+                         max_interval: float = watch.max_interval) -> None:
+    """
+    Keep scraping new posts in a category, until cancelled. Each city is polled on its own
+    schedule, which adapts to how often new posts appear there. See `src/watch.py`.
+    :param category: a 'for sale' category, e.g. 'cell phones'
+    :param concurrency: number of cities polled at the same time
+    :param session: HTTP session to use. If not given, one is created and shared by all cities.
+    :param incremental: on the first poll, only download details of posts not already on disk
+    :param output: one of `output_formats`
+    :param states: State abbreviations. If not given, every state is watched.
+    :param cities: names of the cities to watch, if there is a single state. If not given,
+        every city is watched.
+    :param listings: index of the listings in this run. See `scrape_category`.
+    :param min_interval: shortest number of seconds between polls of a city
+    :param max_interval: longest number of seconds between polls of a city
+    """
+    if concurrency < 1:
+        raise ValueError(f"Concurrency must be at least 1, got: {concurrency}")
+    resolver = get_resolver()
+    states = [resolver.resolve_state(s) for s in states] if states else resolver.states()
+    if cities and len(states) != 1:
+        raise ValueError("Cities can only be given for a single state")
+    if session is None:
+        async with make_session() as session:
+            return await watch_category(category, concurrency, session, incremental, output,
+                                        states, cities, listings, min_interval, max_interval)
+    limiter = asyncio.Semaphore(concurrency)
+    tasks = []
+    for state in states:
+        for city in cities or resolver.cities[state]:
+            schedule = watch.PollSchedule(min_interval, max_interval)
+            tasks.append(asyncio.create_task(watch_city(
+                state, resolver.resolve_city(state, city), category, session, schedule, limiter,
+                incremental, output, listings)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 # ============================================ MAIN ==============================================
-async def main(state, city, category):
-    # If city is given, search only that city
-    if city:
-        # Get posts for this city.
-        results = await scrape_category_location(state, city, category)
-        city_results = {city: results}
-    # Otherwise city is not given. Search all cities within the state.
-    else:
-        # Get posts for each city.
-        city_results = await scrape_category_state(state, category)
-
-    # Write results. NOTE: Performance hit of this step is insignificant
-    # compared to previous step, so we do not need aiofiles.
-    for city,(post_overviews, post_details) in city_results.items():
-        await write_results(state, city, category, post_overviews, post_details)
+async def main(state, city, category, concurrency=default_concurrency,
+               limit=throttle.default_connection_limit,
+               limit_per_host=throttle.default_limit_per_host,
+               incremental=False, output='json', listings=None, watch_intervals=None,
+               metrics_port=None):
+    # Serve metrics for the whole run, e.g. to scrape them with Prometheus while watching.
+    runner = await metrics.start_server(metrics_port) if metrics_port else None
+    try:
+        # One connection pool is shared by every city in the run.
+        async with make_session(limit, limit_per_host) as session:
+            # In watch mode, keep polling the city, or every city within the state, until stopped.
+            if watch_intervals:
+                states = None if state.upper() == 'ALL' else [state]
+                await watch_category(category, concurrency, session, incremental, output, states,
+                                     [city] if city else None, listings, *watch_intervals)
+            # If city is given, search only that city
+            elif city:
+                await scrape_city(state, city, category, session, incremental, output, listings)
+            # Otherwise search all cities within the state, or every state if state is 'ALL'.
+            # Results are written as each city finishes.
+            else:
+                states = None if state.upper() == 'ALL' else [state]
+                await scrape_category_all(category, concurrency, session, incremental, output,
+                                          states, listings)
+    finally:
+        if listings is not None:
+            print(f"Skipped {listings.duplicates} duplicate listings")
+            listings.save()
+        if runner is not None:
+            await runner.cleanup()
 
 
 if __name__ == '__main__':
     import argparse
     desc = "Scrape posts under a 'for sale' category, within a city."
     parser = argparse.ArgumentParser(description=desc)
-    parser.add_argument('state', help='State abbreviation')
+    parser.add_argument('state', help="State abbreviation, or 'ALL' to search every state")
     parser.add_argument('city', nargs='?', help='City name within given state.'
         ' If excluded, will search all cities in state.')
     parser.add_argument('category', help="A 'for sale' category, e.g. 'electronics'")
+    parser.add_argument('--concurrency', '-c', type=int, default=default_concurrency,
+        help='Number of cities to search at the same time')
+    parser.add_argument('--max-connections', type=int, default=throttle.default_connection_limit,
+        help='Max number of open connections across all hosts, 0 for no limit')
+    parser.add_argument('--max-per-host', type=int, default=throttle.default_limit_per_host,
+        help='Max number of open connections to a single host, 0 for no limit')
+    parser.add_argument('--incremental', action='store_true',
+        help='Only download details of posts that are new or changed since previous runs')
+    parser.add_argument('--output', '-o', choices=output_formats, default='json',
+        help='Format of output files. JSON Lines and SQLite are written post by post.')
+    parser.add_argument('--db', default=post_store.default_db,
+        help='SQLite database to write to with --output sqlite')
+    parser.add_argument('--dedup', action='store_true',
+        help='Download each listing once per run, even if it shows up in several cities')
+    parser.add_argument('--bloom', nargs='?', const=dedup.default_bloom_path,
+        help='Remember listings across runs in a Bloom filter file, to skip post index lookups'
+             ' of new posts with --incremental. Implies --dedup.')
+    parser.add_argument('--watch', action='store_true',
+        help='Keep polling search pages and scrape only new posts, until interrupted')
+    parser.add_argument('--min-interval', type=float, default=watch.min_interval,
+        help='Shortest number of seconds between polls of a city with --watch')
+    parser.add_argument('--max-interval', type=float, default=watch.max_interval,
+        help='Longest number of seconds between polls of a city with --watch')
+    parser.add_argument('--journal', nargs='?', const='', metavar='PATH',
+        help='Journal progress so that running the same command again after a crash resumes'
+             ' instead of starting over (default: data/Journal/<category>_<state>[_<city>].jsonl)')
+    parser.add_argument('--images', nargs='?', const=image_store.default_size,
+        choices=image_store.sizes,
+        help='Download the images of every post, in the given size (default: %(const)s)')
+    parser.add_argument('--image-dir', default=image_store.default_image_dir,
+        help='Directory to store images in with --images')
+    parser.add_argument('--index', nargs='?', const=search_index.default_index_path,
+        metavar='PATH',
+        help='Add the posts written to the full-text search index, see src/search_index.py'
+             ' (default: %(const)s)')
+    parser.add_argument('--export', action='store_true',
+        help='Export new detail files to the Parquet dataset when done, see src/export_parquet.py')
+    parser.add_argument('--cache', action='store_true',
+        help='Cache responses on disk, revalidating them once older than --cache-ttl')
+    parser.add_argument('--cache-dir', default=http_cache.default_cache_dir,
+        help='Directory to cache responses in')
+    parser.add_argument('--cache-ttl', type=float, default=http_cache.default_ttl,
+        help='Seconds a cached response is used without revalidation')
+    parser.add_argument('--offline', action='store_true',
+        help='Serve every request from the response cache, e.g. to replay parser changes')
+    parser.add_argument('--engine', choices=extract.engines, default=extract.default_engine,
+        help='HTML extraction engine. lxml is several times faster than soup.')
+    parser.add_argument('--parse-workers', type=int, default=0,
+        help='Number of processes to parse pages in, 0 to parse on the event loop')
+    parser.add_argument('--metrics-report', metavar='PATH',
+        help='Write timings and counters of the run to a JSON file when done')
+    parser.add_argument('--metrics-port', type=int, nargs='?', const=metrics.default_port,
+        help='Serve metrics in Prometheus format at http://localhost:PORT/metrics during the run'
+             ' (default: %(const)s)')
+    parser.add_argument('--trace', action='store_true',
+        help='Add a span per download, parse and write to the metrics report, which'
+             ' chrome://tracing can open')
     args = parser.parse_args()
 
+    if args.trace and not args.metrics_report:
+        parser.error('--trace requires --metrics-report')
+    if args.journal is not None and args.watch:
+        parser.error('--journal cannot be used with --watch')
+    if args.index and args.output == 'sqlite':
+        parser.error('--index indexes output files, which --output sqlite does not write')
+    # Names are matched loosely, e.g. 'pa', 'Muscle Shoals' or 'cell-phones', and replaced by
+    # those of the config, which output paths and journals are named after. Misspelled names are
+    # rejected rather than corrected, since a typo could name another city.
+    resolver = get_resolver()
+    resolver.fuzzy = False
+    try:
+        args.category = resolver.resolve_category(args.category)
+        if args.state.upper() != 'ALL':
+            args.state = resolver.resolve_state(args.state)
+            if args.city:
+                args.city = resolver.resolve_city(args.state, args.city)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.metrics_report or args.metrics_port:
+        metrics.enable_metrics(tracing=args.trace)
+
+    extract.set_engine(args.engine)
+    if args.parse_workers:
+        extract.start_process_pool(args.parse_workers)
+
+    if args.output == 'sqlite':
+        post_store.open_store(args.db)
+    if args.cache or args.offline:
+        http_cache.enable_cache(args.cache_dir, args.cache_ttl, offline=args.offline)
+    if args.images:
+        images = image_store.enable_images(args.image_dir, args.images)
+    if args.index:
+        search_index.enable_index(args.index, out_dir)
+
+    listings = None
+    if args.dedup or args.bloom:
+        listings = dedup.ListingIndex(args.bloom)
+
+    if args.journal is not None:
+        journal_path = args.journal or journal.default_journal_path(args.category, args.state,
+                                                                    args.city)
+        run_journal = journal.enable_journal(journal_path)
+        if run_journal.finished or run_journal.resumed:
+            print(f"Resuming from journal: {len(run_journal.finished)} cities done, "
+                  f"{run_journal.resumed} posts reused:\t {journal_path}")
+
     # run the program
-    asyncio.run(main(args.state, args.city, args.category))
+    complete = False
+    try:
+        asyncio.run(main(args.state, args.city, args.category, args.concurrency,
+                         args.max_connections, args.max_per_host, args.incremental,
+                         args.output, listings,
+                         (args.min_interval, args.max_interval) if args.watch else None,
+                         args.metrics_port))
+        complete = True
+    finally:
+        extract.stop_process_pool()
+        post_store.close_store()
+        # The journal is kept for the next attempt unless every city was written.
+        journal.disable_journal(complete)
+        if args.images:
+            print(f"Downloaded {images.downloaded} images, reused {images.reused}, to:\t "
+                  f"{args.image_dir}")
+            image_store.disable_images()
+        if args.index:
+            # JSON Lines files are only complete once their city is written, so they are indexed
+            # now, along with any file that earlier runs did not index.
+            count = search_index.get_index().update()
+            print(f"Indexed {count} more posts to:\t {args.index}")
+            search_index.disable_index()
+        if args.metrics_report:
+            metrics.write_report(args.metrics_report)
+            print(f"Saved metrics to:\t {args.metrics_report}")
+
+    if args.export:
+        from src import export_parquet
+        paths = export_parquet.export(out_dir=export_parquet.default_out_dir)
+        print(f"Wrote {len(paths)} partitions to:\t {export_parquet.default_out_dir}")
@@ -0,0 +1,141 @@
+"""
+Deduplicate listings across cities and runs.
+
+Craigslist shows the same listing in the search results of neighboring sites, and reposts of a
+listing point to the original with `pid_repost`. `ListingIndex` keys every listing by the first pid
+of its repost chain, so within a run each listing's details are downloaded once and shared by every
+city it shows up in. The index optionally keeps a `BloomFilter` of the listings seen in previous
+runs, persisted to disk, so incremental runs can skip the post index lookup for listings that are
+certainly new.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from src.utils import get_project_root
+
+# ========================================== CONSTANTS ===========================================
+# default file to persist the Bloom filter to
+default_bloom_path = get_project_root().joinpath('data/seen_listings.bloom')
+
+# number of listings the Bloom filter is sized for, and its false positive rate at that size
+default_capacity = 10_000_000
+default_error_rate = 0.001
+
+# number of listings whose details are kept in memory for reuse. Duplicates show up in
+# neighboring cities, which are crawled close together, so older listings are dropped.
+default_max_listings = 20_000
+
+
+def chain_id(post_overview: dict) -> str:
+    """ Id of a listing: the first pid of its repost chain """
+    return post_overview['pid_repost'] or post_overview['pid']
+
+
+# ========================================== BLOOM FILTER ========================================
+class BloomFilter:
+    def __init__(self, capacity: int = default_capacity, error_rate: float = default_error_rate):
+        """
+        Set of strings with no false negatives and `error_rate` false positives, using about
+        1.8 bytes per item at the default error rate.
+        :param capacity: number of items the filter is sized for
+        :param error_rate: false positive rate once `capacity` items are added
+        """
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str) -> None:
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def save(self, path) -> None:
+        """ Write the filter to a file, atomically replacing it """
+        path = Path(path)
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps({'size': self.size, 'hashes': self.hashes}).encode() + b'\n')
+            f.write(self.bits)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path) -> 'BloomFilter':
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            bloom = cls.__new__(cls)
+            bloom.size, bloom.hashes = header['size'], header['hashes']
+            bloom.bits = bytearray(f.read())
+        return bloom
+
+
+# ========================================== LISTING INDEX =======================================
+class ListingIndex:
+    def __init__(self, bloom_path=None, max_listings: int = default_max_listings):
+        """
+        Index of the listings scraped in a run.
+        :param bloom_path: file to load and save the Bloom filter of listings seen in previous
+            runs. If not given, listings are only deduplicated within the run.
+        :param max_listings: number of listings whose details are kept in memory for reuse
+        """
+        self.max_listings = max_listings
+        # {chain id: task getting the details}, least recently used first
+        self._details = OrderedDict()
+        self.bloom_path = bloom_path
+        self.bloom = None
+        if bloom_path is not None:
+            bloom_path = Path(bloom_path)
+            self.bloom = BloomFilter.load(bloom_path) if bloom_path.exists() else BloomFilter()
+        # number of detail downloads saved
+        self.duplicates = 0
+
+    def seen_before(self, post_overview: dict) -> bool:
+        """
+        Check if a listing may have been scraped before. False means it is certainly new, and
+        True is wrong at most `error_rate` of the time. Without a Bloom filter, always True.
+        """
+        if self.bloom is None:
+            return True
+        return post_overview['pid'] in self.bloom or chain_id(post_overview) in self.bloom
+
+    def add(self, post_overview: dict) -> None:
+        """ Mark a listing as seen, for later runs """
+        if self.bloom is not None:
+            self.bloom.add(post_overview['pid'])
+            self.bloom.add(chain_id(post_overview))
+
+    async def details(self, post_overview: dict, fetch: Callable[[], Awaitable[dict]]) -> dict:
+        """
+        Get the details of a listing, downloading them only if no other city of this run did.
+        :param post_overview: as returned by `extract_overview_info`
+        :param fetch: coroutine function downloading the details
+        :return: copy of {city, description, ...}
+        """
+        key = chain_id(post_overview)
+        task = self._details.get(key)
+        if task is None:
+            task = self._details[key] = asyncio.ensure_future(fetch())
+            if len(self._details) > self.max_listings:
+                self._details.popitem(last=False)
+        else:
+            self._details.move_to_end(key)
+            self.duplicates += 1
+        # Shielded, so that one city cancelling does not cancel the download for the others.
+        return dict(await asyncio.shield(task))
+
+    def save(self) -> None:
+        """ Persist the Bloom filter, if any """
+        if self.bloom is not None:
+            self.bloom.save(self.bloom_path)
@@ -0,0 +1,293 @@
+"""
+Split one category crawl across several processes or machines.
+
+A coordinator puts one work item per city into a work queue, see `src/work_queue.py`. Workers
+lease items and scrape them. The item of a city scrapes its first search page, and puts one more
+item in the queue for each of its other pages, so large cities are shared by several workers too.
+Each item is written to `data/category/<category>/<state>/<city>`, like `category_scrape`, with
+the worker and page in the file names, so the output directories of all workers merge into one
+without conflicts, e.g. by copying them onto each other.
+
+Usage, with the queue served over HTTP by the coordinator:
+    export WORK_QUEUE_TOKEN=<secret>                                    # on every machine
+    python -m src.distributed coordinator 'cell phones' --serve --host 0.0.0.0  # on one machine
+    python -m src.distributed worker --queue http://<coordinator>:8899  # on every machine
+"""
+import argparse
+import asyncio
+import logging
+import os
+import socket
+
+import aiohttp
+
+from src import extract, sinks, throttle, work_queue
+from src.category_scrape import (build_url, get_post_record, get_result_dir, get_search_page,
+                                 page_url, write_results)
+from src.resolver import get_resolver, iter_cities
+from src.throttle import make_session
+from src.utils import get_timestamp, to_valid_filename
+
+# ========================================== CONSTANTS ===========================================
+# formats items can be written in, see `category_scrape.output_formats`. Every worker writes
+# files, which merge into one directory; SQLite databases would not.
+output_formats = ('json',) + sinks.formats
+
+# default number of items a worker scrapes at the same time
+default_concurrency = 4
+
+# seconds between checks of the queue by idle workers, and progress reports of the coordinator
+poll_interval = 5
+
+
+# ========================================== HELPERS =============================================
+def item_key(item: dict) -> str:
+    """ Key of a work item, unique within a run, e.g. <run>/cell phones/PA/york/0 """
+    return f"{item['run']}/{item['category']}/{item['state']}/{item['city']}/{item['offset']}"
+
+
+def default_worker_id() -> str:
+    """ Name of this worker, unique across machines: <host>-<process id> """
+    return to_valid_filename(f'{socket.gethostname()}-{os.getpid()}')
+
+
+# ========================================== WORKERS =============================================
+async def scrape_item(item: dict, session: aiohttp.ClientSession, queue, worker: str,
+                      output: str = 'json') -> int:
+    """
+    Scrape the posts of one search page, and write them to disk.
+    :param item: {run, category, state, city, offset}, offset being that of the first post on
+        the page. The first page of a city puts the other pages of the city in the queue.
+    :param session: HTTP session to use
+    :param queue: to put page items in
+    :param worker: name of the worker, added to file names
+    :param output: one of `output_formats`
+    :return: number of posts written
+    """
+    state, city, category, offset = item['state'], item['city'], item['category'], item['offset']
+    url = build_url(get_resolver().city_url(state, city), category)
+    post_overviews, total = await get_search_page(page_url(url, offset), session)
+    page_size = len(post_overviews)
+    if offset == 0 and page_size and total > page_size:
+        pages = [dict(item, offset=o) for o in range(page_size, total, page_size)]
+        await queue.put([(item_key(page), page) for page in pages])
+    tag = f'{worker}-p{offset}'
+    if output == 'json':
+        post_details = await asyncio.gather(*[get_post_record(p, session)
+                                              for p in post_overviews])
+        await write_results(state, city, category, post_overviews, post_details, tag)
+        return page_size
+    destination = get_result_dir(state, city, category)
+    # Other items of the city may be writing to the same directory, so their `.part` files are
+    # left alone. The files of an item that fails are deleted, as another worker redoes the item,
+    # and those of a worker that crashed stay `.part`.
+    sink = sinks.JsonLinesSink(destination, f'{get_timestamp()}_{tag}', output, recover=False)
+    sink.write_overviews(post_overviews)
+    tasks = [asyncio.ensure_future(get_post_record(p, session, sink)) for p in post_overviews]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        sink.discard()
+        raise
+    sink.close()
+    print(f"Saved posts to:\t {destination}")
+    return page_size
+
+
+async def keep_leased(queue, lease: work_queue.Lease, visibility_timeout: float) -> None:
+    """ Extend a lease until cancelled, so a slow item is not leased to another worker """
+    while True:
+        await asyncio.sleep(visibility_timeout / 3)
+        if not await queue.extend(lease, visibility_timeout):
+            logging.warning(f"Lost lease of item: {item_key(lease.item)}")
+            return
+
+
+# ============================================ API ===============================================
+async def enqueue_category(queue, category: str, states: list = None, cities: list = None,
+                           run: str = None) -> int:
+    """
+    Put one work item per city in the queue.
+    :param queue: see `src/work_queue.py`
+    :param category: a 'for sale' category, e.g. 'cell phones'
+    :param states: State abbreviations. If not given, every state is crawled.
+    :param cities: names of cities, if there is a single state. If not given, every city is
+        crawled.
+    :param run: name of the run, so the same cities can be crawled again by a later run.
+        Defaults to the current time.
+    :return: number of items added
+    """
+    category = get_resolver().resolve_category(category)
+    run = run or get_timestamp()
+    items = [{'run': run, 'category': category, 'state': state, 'city': city, 'offset': 0}
+             for state, city, _ in iter_cities(states, cities)]
+    return await queue.put([(item_key(item), item) for item in items])
+
+
+async def run_coordinator(queue, port: int = None, host: str = work_queue.default_host,
+                          token: str = None) -> dict:
+    """
+    Report the progress of the workers until the queue is drained.
+    :param queue: see `src/work_queue.py`
+    :param port: if given, serve the queue on this port to workers on other machines
+    :param host: to serve the queue on, see `work_queue.serve`
+    :param token: shared with the workers, see `work_queue.serve`
+    :return: {status: number of items}
+    """
+    runner = await work_queue.serve(queue, port, host, token) if port else None
+    try:
+        while True:
+            stats = await queue.stats()
+            print(', '.join(f'{n} {status}' for status, n in stats.items()))
+            if not stats['pending'] and not stats['leased']:
+                break
+            await asyncio.sleep(poll_interval)
+        # Keep serving a little longer, so idle workers see that the queue is drained.
+        if runner is not None:
+            await asyncio.sleep(poll_interval * 2)
+        return stats
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+
+async def run_worker(queue, session: aiohttp.ClientSession = None, worker: str = None,
+                     output: str = 'json', concurrency: int = default_concurrency,
+                     visibility_timeout: float = work_queue.default_visibility_timeout) -> int:
+    """
+    Scrape items from the queue until it is drained. An item that fails is given back to the
+    queue, to be retried by any worker.
+    :param queue: see `src/work_queue.py`
+    :param session: HTTP session to use. If not given, one is created for this call.
+    :param worker: name of this worker, unique across machines. Defaults to `default_worker_id`.
+    :param output: one of `output_formats`
+    :param concurrency: number of items scraped at the same time
+    :param visibility_timeout: seconds after which the items of a worker that stopped responding
+        are leased to another one
+    :return: number of items scraped
+    """
+    if output not in output_formats:
+        raise ValueError(f"Invalid output format: {output}, expected one of {output_formats}")
+    if concurrency < 1:
+        raise ValueError(f"Concurrency must be at least 1, got: {concurrency}")
+    if session is None:
+        async with make_session() as session:
+            return await run_worker(queue, session, worker, output, concurrency,
+                                    visibility_timeout)
+    worker = worker or default_worker_id()
+
+    async def slot():
+        done = 0
+        while True:
+            lease = await queue.lease(worker, visibility_timeout)
+            if lease is None:
+                # Leased items may still add pages, or be given back by a crashed worker.
+                stats = await queue.stats()
+                if not stats['pending'] and not stats['leased']:
+                    return done
+                await asyncio.sleep(poll_interval)
+                continue
+            heartbeat = asyncio.create_task(keep_leased(queue, lease, visibility_timeout))
+            try:
+                await scrape_item(lease.item, session, queue, worker, output)
+            except Exception as e:
+                logging.error(f"Error for item: {item_key(lease.item)}", exc_info=True)
+                await queue.fail(lease, f'{type(e).__name__}: {e}')
+            else:
+                if not await queue.complete(lease):
+                    logging.warning(f"Item was leased to another worker while scraping it: "
+                                    f"{item_key(lease.item)}")
+                done += 1
+            finally:
+                heartbeat.cancel()
+
+    return sum(await asyncio.gather(*[slot() for _ in range(concurrency)]))
+
+
+async def main(args) -> None:
+    queue = work_queue.open_queue(args.queue, args.token)
+    try:
+        if args.command == 'coordinator':
+            states = None if args.state.upper() == 'ALL' else [args.state]
+            added = await enqueue_category(queue, args.category, states, args.city, args.run)
+            print(f"Queued {added} cities")
+            await run_coordinator(queue, args.serve, args.host, args.token)
+        elif args.command == 'worker':
+            async with make_session(args.max_connections, args.max_per_host) as session:
+                done = await run_worker(queue, session, args.worker_id, args.output,
+                                        args.concurrency, args.visibility_timeout)
+            print(f"Scraped {done} items")
+        else:
+            print(await queue.stats())
+        for key, error in await queue.failures():
+            print(f"Failed:\t {key}\t {error}")
+    finally:
+        await queue.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Split a category crawl across processes and machines")
+    parser.add_argument('--queue', '-q', default=work_queue.default_queue_path,
+        help='Work queue: a SQLite database path, or http://<host>:<port> of a coordinator')
+    parser.add_argument('--token',
+        help='Token shared by the coordinator serving the queue and its workers, by default the '
+             f'{work_queue.token_env} environment variable')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    coordinator = commands.add_parser('coordinator',
+        help='Queue every city of a crawl, and report progress until it is done')
+    coordinator.add_argument('category', help="A 'for sale' category, e.g. 'electronics'")
+    coordinator.add_argument('state', nargs='?', default='ALL',
+        help="State abbreviation, or 'ALL' to crawl every state")
+    coordinator.add_argument('city', nargs='*',
+        help='City names within given state. If excluded, will crawl all cities in state.')
+    coordinator.add_argument('--run', help='Name of the run, by default the current time')
+    coordinator.add_argument('--serve', type=int, nargs='?', const=work_queue.default_port,
+        help='Serve the queue to workers on other machines on this port (default: %(const)s)')
+    coordinator.add_argument('--host', default=work_queue.default_host,
+        help='Interface to serve the queue on, e.g. 0.0.0.0 for every one, which requires '
+             '--token (default: %(default)s)')
+
+    worker = commands.add_parser('worker', help='Scrape items from the queue until it is done')
+    worker.add_argument('--output', '-o', choices=output_formats, default='json',
+        help='Format of output files')
+    worker.add_argument('--concurrency', '-c', type=int, default=default_concurrency,
+        help='Number of items to scrape at the same time')
+    worker.add_argument('--worker-id', help='Name of this worker, by default <host>-<pid>')
+    worker.add_argument('--visibility-timeout', type=float,
+        default=work_queue.default_visibility_timeout,
+        help='Seconds after which the items of an unresponsive worker are given to another')
+    worker.add_argument('--max-connections', type=int, default=throttle.default_connection_limit,
+        help='Max number of open connections across all hosts, 0 for no limit')
+    worker.add_argument('--max-per-host', type=int, default=throttle.default_limit_per_host,
+        help='Max number of open connections to a single host, 0 for no limit')
+    worker.add_argument('--engine', choices=extract.engines, default=extract.default_engine,
+        help='HTML extraction engine. lxml is several times faster than soup.')
+    worker.add_argument('--parse-workers', type=int, default=0,
+        help='Number of processes to parse pages in, 0 to parse on the event loop')
+
+    commands.add_parser('status', help='Print the number of items by status')
+    args = parser.parse_args()
+
+    if args.command == 'coordinator':
+        # Misspelled names are rejected rather than corrected, since a typo could name another
+        # city.
+        resolver = get_resolver()
+        resolver.fuzzy = False
+        try:
+            args.category = resolver.resolve_category(args.category)
+            list(iter_cities(None if args.state.upper() == 'ALL' else [args.state], args.city))
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.command == 'worker':
+        extract.set_engine(args.engine)
+        if args.parse_workers:
+            extract.start_process_pool(args.parse_workers)
+    try:
+        asyncio.run(main(args))
+    finally:
+        extract.stop_process_pool()
@@ -0,0 +1,265 @@
+"""
+Compact the detail files under `data/category` into a partitioned Parquet dataset:
+    <out_dir>/category=<category>/state=<state>/date=<scrape date>/posts.parquet
+
+Each post is one row with typed columns (pid, price, time, ...), and every post attribute is
+flattened into its own `attr_<name>` string column. Each partition is a single file, holding one
+row group per source file. An export adds the source files that were not exported yet, listed in
+`<out_dir>/_manifest.json`, to their partition's file, which is rewritten with its previous row
+groups first. So the export can run after every crawl, and the dataset stays one file per
+partition. The schema of the whole dataset, i.e. the union of every partition's columns, is kept
+in `<out_dir>/_common_metadata`, so `read_dataset` opens the dataset without reading the footer of
+every file.
+"""
+import argparse
+import datetime
+import json
+import os
+import re
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = ds = pq = None
+
+from src import schema, sinks
+from src.utils import get_project_root
+
+# ========================================== CONSTANTS ===========================================
+# directory for scraped detail files
+in_dir = get_project_root().joinpath('data/category')
+
+# directory for the Parquet dataset
+default_out_dir = get_project_root().joinpath('data/Parquet')
+
+# file name of a detail file, e.g. 16-06-2020_01-25-31AM_DETAIL_1.jsonl.gz, or
+# 16-06-2020_01-25-31AM_<tag>_DETAIL.json if written by a distributed worker
+detail_pattern = re.compile(r'(?P<timestamp>\d\d-\d\d-\d{4}_\d\d-\d\d-\d\d[AP]M)(_[\w-]+?)?'
+                            r'_DETAIL(?P<part>_\d+)?\.(json|jsonl(\.gz|\.zst)?)$')
+
+# format of the timestamp in file names, see `utils.get_timestamp`
+timestamp_format = '%d-%m-%Y_%I-%M-%S%p'
+
+# format of the `time` field of a post
+time_format = '%Y-%m-%d %H:%M'
+
+# prefix of flattened attribute columns
+attr_prefix = 'attr_'
+
+# file of each partition, the exported source files, and the schema of the dataset. Names
+# starting with '_' or '.' are not read as data by `pyarrow.dataset`.
+partition_file = 'posts.parquet'
+manifest_file = '_manifest.json'
+common_metadata_file = '_common_metadata'
+
+# partition columns, from the directory names
+partition_fields = (('category', 'string'), ('state', 'string'), ('date', 'string'))
+
+
+# ========================================== HELPERS =============================================
+def require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError("pyarrow is required for Parquet export: pip install pyarrow")
+
+
+def attr_column(name: str) -> str:
+    """ Column name for a post attribute, e.g. 'delivery available' -> 'attr_delivery_available' """
+    return attr_prefix + re.sub(r'\W+', '_', name.lower()).strip('_')
+
+
+def attr_value(value) -> str:
+    """
+    Attribute values are True for flags (e.g. 'cryptocurrency ok'), see `schema.Attributes`, or
+    None in files written before attributes were normalized. Flags are stored as 'true', so that
+    null means the post does not have the attribute.
+    """
+    if value is None or value is True:
+        return 'true'
+    if isinstance(value, list):
+        return ':'.join(value)
+    return value
+
+
+def parse_int(value):
+    return int(value) if value not in (None, '') else None
+
+
+def parse_time(value):
+    return datetime.datetime.strptime(value, time_format) if value else None
+
+
+def to_table(posts: list, city: str, scraped_at: datetime.datetime):
+    """
+    Convert posts to a table with one row per post.
+    :param posts: as written to a detail file
+    :param city: directory name of the city the posts were scraped from
+    :param scraped_at: time the posts were scraped
+    :return: pyarrow.Table
+    """
+    columns = {
+        'pid': pa.array([parse_int(p.get('pid')) for p in posts], pa.int64()),
+        'pid_repost': pa.array([parse_int(p.get('pid_repost')) for p in posts], pa.int64()),
+        'title': pa.array([p.get('title') for p in posts], pa.string()),
+        'price': pa.array([p.get('price') for p in posts], pa.int64()),
+        'time': pa.array([parse_time(p.get('time')) for p in posts], pa.timestamp('ms')),
+        'link': pa.array([p.get('link') for p in posts], pa.string()),
+        'site': pa.array([p.get('city') for p in posts], pa.string()),
+        'city': pa.array([city] * len(posts), pa.dictionary(pa.int32(), pa.string())),
+        'description': pa.array([p.get('description') for p in posts], pa.string()),
+        'images': pa.array([p.get('images') for p in posts], pa.list_(pa.string())),
+        'image_sha256': pa.array([[i['sha256'] for i in p['image_files']]
+                                  if p.get('image_files') else None for p in posts],
+                                 pa.list_(pa.string())),
+        'error': pa.array([p.get('error') for p in posts], pa.string()),
+        'scraped_at': pa.array([scraped_at] * len(posts), pa.timestamp('ms')),
+    }
+    # Flatten attributes, one column per attribute name. Files written before attributes were
+    # normalized are normalized here, so every file has the same typed columns.
+    attributes = [schema.normalize_attributes(p.get('attributes') or {}) for p in posts]
+    names = sorted({name for a in attributes for name in a})
+    for name in names:
+        values = [attr_value(a[name]) if name in a else None for a in attributes]
+        columns.setdefault(attr_column(name), pa.array(values, pa.string()))
+    return pa.table(columns)
+
+
+def conform(table, target):
+    """ Cast a table to a wider schema, columns it does not have being null """
+    columns = [table.column(f.name) if f.name in table.column_names
+               else pa.nulls(len(table), f.type) for f in target]
+    return pa.Table.from_arrays(columns, schema=target)
+
+
+def write_partition(path: Path, tables: list, keep_existing: bool = True):
+    """
+    Write the tables of a partition to its file, each as one row group, after the row groups
+    already in it. The file is replaced atomically.
+    :param path: of the partition file
+    :param tables: [pyarrow.Table] to add
+    :param keep_existing: keep the row groups already in the file
+    :return: schema of the written file
+    """
+    existing = pq.ParquetFile(path) if keep_existing and path.exists() else None
+    schemas = [existing.schema_arrow] if existing is not None else []
+    unified = pa.unify_schemas(schemas + [t.schema for t in tables])
+    tmp = path.with_name(f'.{path.name}.tmp')
+    with pq.ParquetWriter(tmp, unified, compression='zstd') as writer:
+        if existing is not None:
+            for i in range(existing.num_row_groups):
+                writer.write_table(conform(existing.read_row_group(i), unified))
+        for table in tables:
+            writer.write_table(conform(table, unified))
+    os.replace(tmp, path)
+    return unified
+
+
+def load_manifest(out_dir: Path) -> dict:
+    """ :return: {source file, relative to the exported directory: partition file} """
+    path = out_dir.joinpath(manifest_file)
+    if not path.exists():
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(out_dir: Path, manifest: dict) -> None:
+    path = out_dir.joinpath(manifest_file)
+    tmp = path.with_name(f'.{path.name}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def find_detail_files(root: Path):
+    """
+    Find detail files written by `category_scrape`.
+    :param root: directory laid out as <category>/<state>/<city>/<file>
+    :return: iterator of (path, category, state, city, timestamp)
+    """
+    for fp in sorted(root.glob('*/*/*/*_DETAIL*')):
+        match = detail_pattern.match(fp.name)
+        if not match:
+            continue
+        city_dir = fp.parent
+        yield (fp, city_dir.parent.parent.name, city_dir.parent.name, city_dir.name,
+               match.group('timestamp'))
+
+
+# ============================================ API ===============================================
+def export(root=in_dir, out_dir=default_out_dir, overwrite: bool = False) -> list:
+    """
+    Export detail files to the Parquet dataset.
+    :param root: directory laid out as <category>/<state>/<city>/<file>
+    :param out_dir: dataset directory
+    :param overwrite: export every file again, rewriting their partitions from scratch
+    :return: [path] of written partition files
+    """
+    require_pyarrow()
+    root, out_dir = Path(root), Path(out_dir)
+    manifest = {} if overwrite else load_manifest(out_dir)
+    # {partition file: [(source file, city, scrape time)]}
+    partitions = {}
+    for fp, category, state, city, timestamp in find_detail_files(root):
+        if fp.relative_to(root).as_posix() in manifest:
+            continue
+        scraped_at = datetime.datetime.strptime(timestamp, timestamp_format)
+        partition = out_dir.joinpath(f'category={category}', f'state={state}',
+                                     f'date={scraped_at.date().isoformat()}')
+        partitions.setdefault(partition.joinpath(partition_file), []).append(
+            (fp, city, scraped_at))
+    common_path = out_dir.joinpath(common_metadata_file)
+    schemas = [pq.read_schema(common_path)] if common_path.exists() and not overwrite else []
+    written = []
+    for path, sources in partitions.items():
+        tables = []
+        for fp, city, scraped_at in sources:
+            posts = sinks.read_records(fp)
+            if posts:
+                tables.append(to_table(posts, city, scraped_at))
+        if tables:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            schemas.append(write_partition(path, tables, keep_existing=not overwrite))
+            written.append(path)
+        manifest.update((fp.relative_to(root).as_posix(), path.relative_to(out_dir).as_posix())
+                        for fp, _, _ in sources)
+        # Saved after each partition, so an interrupted export does not add files twice.
+        out_dir.mkdir(parents=True, exist_ok=True)
+        save_manifest(out_dir, manifest)
+    if written:
+        pq.write_metadata(pa.unify_schemas(schemas), common_path)
+    return written
+
+
+def read_dataset(out_dir=default_out_dir):
+    """
+    Open the exported dataset, with the schema of the whole dataset. Partitions without some
+    attribute columns read them as null.
+    :param out_dir: dataset directory
+    :return: pyarrow.dataset.Dataset, with category, state and date partition columns
+    """
+    require_pyarrow()
+    out_dir = Path(out_dir)
+    partitioning = ds.partitioning(
+        pa.schema([(name, getattr(pa, type_)()) for name, type_ in partition_fields]),
+        flavor='hive')
+    common_path = out_dir.joinpath(common_metadata_file)
+    if not common_path.exists():
+        return ds.dataset(out_dir, format='parquet', partitioning=partitioning)
+    schema = pa.unify_schemas([pq.read_schema(common_path), partitioning.schema])
+    return ds.dataset(out_dir, schema=schema, format='parquet', partitioning=partitioning)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Export scraped posts to a partitioned Parquet dataset")
+    parser.add_argument('--input_dir', '-i', default=in_dir,
+                        help='Directory laid out as <category>/<state>/<city>/<file>')
+    parser.add_argument('--out_dir', '-o', default=default_out_dir)
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Export every file again, rewriting their partitions from scratch')
+    args = parser.parse_args()
+
+    paths = export(args.input_dir, args.out_dir, args.overwrite)
+    print(f"Wrote {len(paths)} partitions to:\t {args.out_dir}")
@@ -0,0 +1,205 @@
+"""
+Extract post data from downloaded search and post pages. Two engines produce the same results:
+    soup - BeautifulSoup with `html.parser`, see below and `src/query_post.py`
+    lxml - precompiled XPath selectors over an `lxml.html` tree, see `src/lxml_extract.py`
+
+Parsing is CPU bound. With `start_process_pool`, `run_parser` sends the raw page to a pool of
+worker processes and only the extracted dicts come back, so parsing uses every core and never
+blocks the event loop.
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Tuple
+from urllib.parse import urlparse
+
+from bs4 import BeautifulSoup, NavigableString, Tag
+from src import lxml_extract, metrics
+from src.query_post import extract_overview_info
+
+# ========================================== CONSTANTS ===========================================
+engines = ('soup', 'lxml')
+
+# engine used when none is given
+default_engine = 'soup'
+
+# process pool used by `run_parser`, None to parse on the event loop
+_pool = None
+
+
+def set_engine(engine: str) -> None:
+    """ Set the engine used when none is given """
+    global default_engine
+    if engine not in engines:
+        raise ValueError(f"Invalid engine: {engine}, expected one of {engines}")
+    default_engine = engine
+
+
+def start_process_pool(workers: int = None) -> ProcessPoolExecutor:
+    """
+    Run parsers submitted through `run_parser` in a pool of worker processes.
+    :param workers: number of processes, defaults to the number of CPUs
+    :return: the pool
+    """
+    global _pool
+    stop_process_pool()
+    _pool = ProcessPoolExecutor(max_workers=workers)
+    return _pool
+
+
+def stop_process_pool() -> None:
+    """ Shut down the process pool, if any. Later parsers run on the event loop. """
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+async def run_parser(parser: Callable, *args):
+    """
+    Run a parser, in the process pool if one was started, otherwise in the current thread.
+    :param parser: `parse_search_page`, `parse_post_page` or any other picklable function
+    :param args: to call parser with
+    :return: result of parser
+    """
+    with metrics.timer('parse_seconds', parser=parser.__name__):
+        if _pool is None:
+            return parser(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_pool, parser, *args)
+
+
+# ========================================== SOUP ================================================
+def get_total_count(soup: BeautifulSoup) -> int:
+    """
+    Extract the total number of search results from a search page.
+    :param soup: of search results page
+    :return: total result count, or 0 if the page does not show one
+    """
+    total = soup.find('span', class_='totalcount')
+    if not total:
+        return 0
+    digits = ''.join(c for c in total.get_text() if c.isdigit())
+    return int(digits) if digits else 0
+
+
+def get_post_overviews(soup: BeautifulSoup) -> list:
+    """
+    Extract post overview information from a search results page.
+    :param soup: of search results page
+    :return: [{title, link, ...}] high-level post info
+    """
+    posts = soup.find_all('li', class_='result-row')
+    return [extract_overview_info(p) for p in posts]
+
+
+def get_city(url):
+    """ Extract city information from URL """
+    o = urlparse(url)
+    city = o.netloc.split('.')[0]
+    return city
+
+
+def get_description(soup: BeautifulSoup) -> str:
+    """
+    Extract description from a post.
+    :param soup: of post details page
+    :return: description text
+    """
+    children = soup.body.section.section.section.section.children
+    strings = [c for c in children if isinstance(c, NavigableString)]
+    desc = ''.join(strings)
+    return desc
+
+
+def get_attributes(soup: BeautifulSoup) -> dict:
+    """
+    Extract attributes from a post.
+    :param soup: of post details page
+    :return: {condition, make/manufacturer, mobileOS, ...}
+    """
+    attributes = soup.find_all('p', 'attrgroup')
+    if not attributes:
+        return {}
+    attributes = attributes[0]
+    # extract field,value pairs
+    field_value = {}
+    for attr in attributes:
+        if isinstance(attr, Tag):
+            text = attr.get_text(strip=True)
+            if len(text) == 0:
+                continue
+            parts = text.split(':')
+            if len(parts) == 0:
+                continue
+            if len(parts) == 1:
+                field, value = parts[0], None
+            elif len(parts) == 2:
+                field, value = parts
+            else:
+                field, value = parts[0], parts[1:]
+            field_value[field] = value
+    return field_value
+
+
+def get_images(soup: BeautifulSoup) -> List[str]:
+    """
+    Extract image URLs from a post.
+    :param soup: of post details page
+    :return: [url] if 1 or more images found, otherwise []
+    """
+    # Grab list of images. Only works with posts which have a scrollable
+    # gallery (e.g. 2 or more images)
+    images = soup.find_all('a', {'data-imgid': True})
+    image_urls = [e['href'] for e in images]
+    # If there is no scrollable gallery, there may still be a single image.
+    if not image_urls:
+        first_visible = soup.find('div', {'class': 'slide first visible'})
+        if first_visible:
+            main_image = first_visible.find('img')
+            if main_image:
+                url = main_image.get('src')
+                if url:
+                    image_urls.append(url)
+    return image_urls
+
+
+# ============================================ API ===============================================
+def parse_search_page(body: bytes, engine: str = None) -> Tuple[list, int]:
+    """
+    Extract post overviews from a search results page.
+    :param body: downloaded page
+    :param engine: one of `engines`, defaults to `default_engine`
+    :return: ( [{title, link, ...}], total result count )
+    """
+    if (engine or default_engine) == 'lxml':
+        doc = lxml_extract.parse(body)
+        return lxml_extract.get_post_overviews(doc), lxml_extract.get_total_count(doc)
+    soup = BeautifulSoup(body, 'html.parser')
+    return get_post_overviews(soup), get_total_count(soup)
+
+
+def parse_post_page(body: bytes, url: str, engine: str = None) -> dict:
+    """
+    Extract details from a post page.
+    :param body: downloaded page
+    :param url: of the post
+    :param engine: one of `engines`, defaults to `default_engine`
+    :return: {city, description, attributes, images}, attributes being as scraped. See
+        `schema.Attributes` to normalize them.
+    """
+    if (engine or default_engine) == 'lxml':
+        doc = lxml_extract.parse(body)
+        desc = lxml_extract.get_description(doc)
+        attributes = lxml_extract.get_attributes(doc)
+        images = lxml_extract.get_images(doc)
+    else:
+        soup = BeautifulSoup(body, 'html.parser')
+        desc = get_description(soup)
+        attributes = get_attributes(soup)
+        images = get_images(soup)
+    return {
+        'city': get_city(url),
+        'description': desc,
+        'attributes': attributes,
+        'images': images
+    }
@@ -0,0 +1,212 @@
+"""
+On-disk cache of HTTP responses, keyed by URL.
+
+Responses are stored with their ETag/Last-Modified headers. A cached response younger than the TTL
+is served without touching the network. An older one is revalidated with a conditional GET, which
+costs a bodiless 304 if the page has not changed. The cache is capped in size, evicting the least
+recently used responses first. In offline mode every request is served from the cache, so parser
+changes can be replayed against stored HTML.
+"""
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import NamedTuple, Optional, Tuple
+
+import aiohttp
+
+from src import metrics, throttle
+
+# ========================================== CONSTANTS ===========================================
+# default directory for cached responses
+default_cache_dir = Path(__file__).parent.parent.joinpath('data/Http_Cache')
+
+# seconds a cached response is served without revalidation
+default_ttl = 60 * 60
+
+# max total size of cached responses, in bytes
+default_max_bytes = 1024 ** 3
+
+# fraction of `max_bytes` to evict down to once the cache is full
+evict_to = 0.9
+
+# the cache used by `fetch` and `fetch_sync`, None if caching is disabled
+_cache = None
+
+
+class CachedResponse(NamedTuple):
+    url: str
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+
+
+# ========================================== CACHE ===============================================
+class ResponseCache:
+    def __init__(self, cache_dir=default_cache_dir, ttl: float = default_ttl,
+                 max_bytes: int = default_max_bytes, offline: bool = False):
+        """
+        :param cache_dir: directory to store responses in
+        :param ttl: seconds a cached response is served without revalidation
+        :param max_bytes: max total size of cached responses
+        :param offline: serve every request from the cache, never touching the network
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._size = sum(fp.stat().st_size for fp in self._files())
+
+    def _files(self):
+        return self.cache_dir.glob('*/*.cache')
+
+    def _path(self, url: str) -> Path:
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return self.cache_dir.joinpath(key[:2], f'{key}.cache')
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        """ Get cached response for URL, or None if not cached """
+        fp = self._path(url)
+        try:
+            with open(fp, 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        # Mark as recently used.
+        os.utime(fp)
+        return CachedResponse(body=body, **meta)
+
+    def is_fresh(self, entry: CachedResponse) -> bool:
+        """ Check if a cached response can be served without revalidation """
+        return time.time() - entry.fetched_at < self.ttl
+
+    def put(self, url: str, body: bytes, etag: str = None, last_modified: str = None) -> None:
+        """ Store response for URL, evicting least recently used responses if the cache is full """
+        fp = self._path(url)
+        fp.parent.mkdir(exist_ok=True)
+        meta = {'url': url, 'etag': etag, 'last_modified': last_modified,
+                'fetched_at': time.time()}
+        # Write to a temporary file first, so readers never see a partial response.
+        tmp = fp.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps(meta).encode() + b'\n')
+            f.write(body)
+        old_size = fp.stat().st_size if fp.exists() else 0
+        os.replace(tmp, fp)
+        self._size += fp.stat().st_size - old_size
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def refresh(self, entry: CachedResponse) -> None:
+        """ Restart the TTL of a cached response that was revalidated """
+        self.put(entry.url, entry.body, entry.etag, entry.last_modified)
+
+    def evict(self) -> None:
+        """ Remove least recently used responses until the cache is below its size limit """
+        files = [(fp.stat(), fp) for fp in self._files()]
+        files.sort(key=lambda f: f[0].st_mtime)
+        self._size = sum(st.st_size for st, _ in files)
+        target = self.max_bytes * evict_to
+        for st, fp in files:
+            if self._size <= target:
+                break
+            fp.unlink(missing_ok=True)
+            self._size -= st.st_size
+
+
+# ========================================== HELPERS =============================================
+def enable_cache(cache_dir=default_cache_dir, ttl: float = default_ttl,
+                 max_bytes: int = default_max_bytes, offline: bool = False) -> ResponseCache:
+    """ Cache every response downloaded through `fetch` and `fetch_sync`. See `ResponseCache`. """
+    global _cache
+    _cache = ResponseCache(cache_dir, ttl, max_bytes, offline)
+    return _cache
+
+
+def disable_cache() -> None:
+    global _cache
+    _cache = None
+
+
+def conditional_headers(entry: Optional[CachedResponse]) -> dict:
+    """ Build headers to revalidate a cached response with a conditional GET """
+    headers = {}
+    if entry is None:
+        return headers
+    if entry.etag:
+        headers['If-None-Match'] = entry.etag
+    if entry.last_modified:
+        headers['If-Modified-Since'] = entry.last_modified
+    return headers
+
+
+def lookup(url: str, revalidate: bool = False) -> Tuple[Optional[CachedResponse], bool]:
+    """
+    Look up URL in the cache.
+    :raises LookupError if the cache is offline and URL is not cached
+    :param url: to look up
+    :param revalidate: treat a fresh response as stale, unless the cache is offline
+    :return: (cached response or None, whether it can be served as is)
+    """
+    entry = _cache.get(url)
+    if _cache.offline:
+        if entry is None:
+            raise LookupError(f"URL not in offline cache: {url}")
+        return entry, True
+    return entry, entry is not None and not revalidate and _cache.is_fresh(entry)
+
+
+# ============================================ API ===============================================
+async def fetch(url: str, session: aiohttp.ClientSession, revalidate: bool = False) -> bytes:
+    """
+    Download URL, going through the cache if it is enabled. Failed requests are retried, see
+    `src/throttle.py`.
+    :raises aiohttp.ClientResponseError on a 4xx/5xx response
+    :param url: to download
+    :param session: HTTP session to use
+    :param revalidate: check with the server even if the cached response is fresh, e.g. for
+        search pages polled by watch mode. Unchanged pages still cost only a 304 response.
+    :return: response body
+    """
+    if _cache is None:
+        _, _, body = await throttle.get(url, session)
+        return body
+    entry, fresh = lookup(url, revalidate)
+    if fresh:
+        metrics.inc('cache_requests_total', result='hit')
+        return entry.body
+    status, headers, body = await throttle.get(url, session, conditional_headers(entry))
+    if status == 304 and entry is not None:
+        metrics.inc('cache_requests_total', result='not_modified')
+        _cache.refresh(entry)
+        return entry.body
+    metrics.inc('cache_requests_total', result='miss')
+    if status == 200:
+        _cache.put(url, body, headers.get('ETag'), headers.get('Last-Modified'))
+    return body
+
+
+def fetch_sync(url: str) -> bytes:
+    """
+    Blocking version of `fetch`.
+    :raises requests.HTTPError on a 4xx/5xx response
+    :param url: to download
+    :return: response body
+    """
+    if _cache is None:
+        return throttle.get_sync(url).content
+    entry, fresh = lookup(url)
+    if fresh:
+        return entry.body
+    response = throttle.get_sync(url, conditional_headers(entry))
+    if response.status_code == 304 and entry is not None:
+        _cache.refresh(entry)
+        return entry.body
+    if response.status_code == 200:
+        _cache.put(url, response.content, response.headers.get('ETag'),
+                   response.headers.get('Last-Modified'))
+    return response.content
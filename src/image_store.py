@@ -0,0 +1,312 @@
+"""
+Download the images of scraped posts.
+
+Image URLs encode an image id and a size, e.g.
+    https://images.craigslist.org/00303_98xLfSGDIzq_0jm0t2_600x450.jpg
+Reposts and posts listed in several cities share their images, so `ImageStore` downloads each
+image id once, in the requested size. Files are stored by the SHA-256 of their content, and each
+image gets a 64 bit difference hash (dHash) so near-duplicates, e.g. the same photo re-uploaded or
+re-encoded, can be found with `ImageStore.near_duplicates`. Hashing needs Pillow.
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Optional
+
+import aiohttp
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from src import extract, sinks, throttle
+from src.utils import get_project_root
+
+# ========================================== CONSTANTS ===========================================
+# directory for downloaded images and their index
+default_image_dir = get_project_root().joinpath('data/Images')
+
+# file in the image directory listing every downloaded image, one JSON object per line
+index_name = 'index.jsonl'
+
+# sizes craigslist serves images in, see "Images" in the README
+sizes = ('50x50c', '300x300', '600x450', '1200x900')
+default_size = '600x450'
+
+# number of images downloaded at the same time
+default_concurrency = 16
+
+# image URL, e.g. https://images.craigslist.org/00303_98xLfSGDIzq_0jm0t2_600x450.jpg
+url_pattern = re.compile(
+    r'/(?P<prefix>[^/_]+)_(?P<id>[^/]+)_(?P<size>\d+x\d+c?)\.(?P<ext>\w+)$')
+
+# dHash compares each pixel of a (hash_size + 1) x hash_size grayscale thumbnail to its neighbor
+hash_size = 8
+
+# near-duplicates are found by splitting hashes into this many bands: two hashes that differ in
+# fewer bits than there are bands agree exactly on at least one band
+hash_bands = 4
+
+# the store used by `category_scrape`, None if images are not downloaded
+_store = None
+
+
+# ========================================== HELPERS =============================================
+def parse_image_url(url: str) -> Optional[re.Match]:
+    """ Match an image URL, with groups prefix, id, size and ext. None if it is not one. """
+    return url_pattern.search(url)
+
+
+def size_variant(url: str, size: str) -> str:
+    """ URL of the same image in another size """
+    match = parse_image_url(url)
+    if match is None:
+        return url
+    return url[:match.start('size')] + size + url[match.end('size'):]
+
+
+def dhash(body: bytes) -> Optional[str]:
+    """
+    Difference hash of an image: similar images have hashes that differ in few bits.
+    :param body: image file
+    :return: 16 hex digits, or None if Pillow is not installed or body is not an image
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(body)) as img:
+            # JPEGs are decoded at a fraction of their size, which is much faster.
+            img.draft('L', (hash_size * 4, hash_size * 4))
+            thumbnail = img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+            pixels = list(thumbnail.getdata())
+    except (OSError, ValueError):
+        return None
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            i = row * (hash_size + 1) + col
+            bits = bits << 1 | (pixels[i] > pixels[i + 1])
+    return f'{bits:0{hash_size ** 2 // 4}x}'
+
+
+def hamming(hash_a: str, hash_b: str) -> int:
+    """ Number of bits that differ between two hashes """
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+def write_file(path: Path, body: bytes) -> None:
+    """ Write a file atomically, so a crash never leaves a partial image """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + sinks.part_suffix)
+    with open(tmp, 'wb') as f:
+        f.write(body)
+    os.replace(tmp, path)
+
+
+# ============================================ STORE =============================================
+class ImageStore:
+    def __init__(self, directory=default_image_dir, size: str = default_size,
+                 concurrency: int = default_concurrency):
+        """
+        Content-addressed store of downloaded images, indexed by image id.
+        :param directory: to store images and their index in
+        :param size: one of `sizes`. Images are downloaded in the size given in their URL if
+            craigslist does not have this size.
+        :param concurrency: number of images downloaded at the same time
+        """
+        if size not in sizes:
+            raise ValueError(f"Invalid image size: {size}, expected one of {sizes}")
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.size = size
+        self._limiter = asyncio.Semaphore(concurrency)
+        # {image id: {id, url, sha256, phash, path, bytes}}
+        self.index = {}
+        index_path = self.directory.joinpath(index_name)
+        if index_path.exists():
+            for entry in sinks.read_json_lines(index_path):
+                self.index[entry['id']] = entry
+        self._index_file = open(index_path, 'a')
+        # {image id: task downloading it}, so concurrent requests for an image share a download
+        self._pending = {}
+        # number of downloads, and of images served from the index instead
+        self.downloaded = 0
+        self.reused = 0
+
+    def _path(self, sha256: str, ext: str) -> Path:
+        return self.directory.joinpath(sha256[:2], f'{sha256}.{ext}')
+
+    async def _download(self, image_id: str, url: str, session: aiohttp.ClientSession) -> dict:
+        wanted = size_variant(url, self.size)
+        async with self._limiter:
+            try:
+                _, _, body = await throttle.get(wanted, session)
+                url = wanted
+            except aiohttp.ClientResponseError as e:
+                if e.status != 404 or wanted == url:
+                    raise
+                _, _, body = await throttle.get(url, session)
+        sha256 = hashlib.sha256(body).hexdigest()
+        path = self._path(sha256, parse_image_url(url).group('ext'))
+        # Identical files are stored once, whatever their id.
+        if not path.exists():
+            write_file(path, body)
+        # Decoding is cpu bound, so it runs in the process pool if one was started.
+        entry = {
+            'id': image_id,
+            'url': url,
+            'sha256': sha256,
+            'phash': await extract.run_parser(dhash, body),
+            'path': str(path.relative_to(self.directory)),
+            'bytes': len(body),
+        }
+        self.index[image_id] = entry
+        self._index_file.write(json.dumps(entry) + '\n')
+        self._index_file.flush()
+        self.downloaded += 1
+        return entry
+
+    async def get(self, url: str, session: aiohttp.ClientSession) -> Optional[dict]:
+        """
+        Get an image, downloading it unless an image with the same id was downloaded already.
+        :raises aiohttp.ClientError if the download fails after retries
+        :param url: of the image, in any size
+        :param session: HTTP session to use
+        :return: {id, url, sha256, phash, path, bytes}, path being relative to the store
+            directory, or None if url is not a craigslist image
+        """
+        match = parse_image_url(url)
+        if match is None:
+            return None
+        image_id = match.group('id')
+        entry = self.index.get(image_id)
+        if entry is not None:
+            self.reused += 1
+            return entry
+        task = self._pending.get(image_id)
+        if task is None:
+            task = self._pending[image_id] = asyncio.ensure_future(
+                self._download(image_id, url, session))
+            task.add_done_callback(lambda _: self._pending.pop(image_id, None))
+        else:
+            self.reused += 1
+        return await asyncio.shield(task)
+
+    async def get_post_images(self, post: dict, session: aiohttp.ClientSession) -> list:
+        """
+        Get every image of a post. An image that fails after retries is logged and skipped.
+        :param post: with images, as returned by `get_images`
+        :param session: HTTP session to use
+        :return: [{id, url, sha256, ...}]
+        """
+        async def get(url):
+            try:
+                return await self.get(url, session)
+            except Exception as e:
+                logging.warning(f"Error for image: {url}: {e!r}")
+
+        entries = await asyncio.gather(*[get(url) for url in post.get('images') or []])
+        return [e for e in entries if e is not None]
+
+    def near_duplicates(self, max_distance: int = hash_bands - 1) -> list:
+        """
+        Find pairs of different images that look alike.
+        :param max_distance: max number of differing hash bits. Pairs are only guaranteed to be
+            found if it is less than `hash_bands`.
+        :return: [(image id, image id, distance)], closest first
+        """
+        hashed = [(e['id'], e['sha256'], e['phash']) for e in self.index.values() if e['phash']]
+        width = len(hashed[0][2]) // hash_bands if hashed else 0
+        buckets = {}
+        for i, (_, _, phash) in enumerate(hashed):
+            for band in range(hash_bands):
+                key = (band, phash[band * width:(band + 1) * width])
+                buckets.setdefault(key, []).append(i)
+        pairs = set()
+        for members in buckets.values():
+            for n, i in enumerate(members):
+                for j in members[n + 1:]:
+                    # Images with the same content are exact duplicates, not near ones.
+                    if hashed[i][1] != hashed[j][1]:
+                        pairs.add((min(i, j), max(i, j)))
+        result = []
+        for i, j in pairs:
+            distance = hamming(hashed[i][2], hashed[j][2])
+            if distance <= max_distance:
+                result.append((hashed[i][0], hashed[j][0], distance))
+        return sorted(result, key=lambda pair: pair[2])
+
+    def close(self) -> None:
+        self._index_file.close()
+
+
+# ============================================ API ===============================================
+def enable_images(directory=default_image_dir, size: str = default_size,
+                  concurrency: int = default_concurrency) -> ImageStore:
+    """ Download the images of every post scraped by `category_scrape` """
+    global _store
+    disable_images()
+    _store = ImageStore(directory, size, concurrency)
+    return _store
+
+
+def disable_images() -> None:
+    global _store
+    if _store is not None:
+        _store.close()
+        _store = None
+
+
+async def fetch_post_images(post: dict, session: aiohttp.ClientSession) -> list:
+    """
+    Get every image of a post, if images are enabled.
+    :return: [{id, url, sha256, ...}], empty if images are not enabled
+    """
+    if _store is None:
+        return []
+    return await _store.get_post_images(post, session)
+
+
+async def fetch_all(posts: list, store: ImageStore,
+                    session: aiohttp.ClientSession = None) -> None:
+    """ Get the images of already scraped posts """
+    if session is None:
+        async with throttle.make_session() as session:
+            return await fetch_all(posts, store, session)
+    await asyncio.gather(*[store.get_post_images(post, session) for post in posts])
+
+
+if __name__ == '__main__':
+    from src import export_parquet
+
+    parser = argparse.ArgumentParser("Download the images of scraped posts")
+    parser.add_argument('--input_dir', '-i', default=export_parquet.in_dir,
+                        help='Directory laid out as <category>/<state>/<city>/<file>')
+    parser.add_argument('--out_dir', '-o', default=default_image_dir)
+    parser.add_argument('--size', choices=sizes, default=default_size)
+    parser.add_argument('--concurrency', '-c', type=int, default=default_concurrency,
+                        help='Number of images to download at the same time')
+    parser.add_argument('--near-duplicates', action='store_true',
+                        help='List images that look alike instead of downloading')
+    args = parser.parse_args()
+
+    store = ImageStore(args.out_dir, args.size, args.concurrency)
+    try:
+        if args.near_duplicates:
+            for id_a, id_b, distance in store.near_duplicates():
+                print(f"{id_a}\t{id_b}\t{distance}")
+        else:
+            posts = [post for fp, *_ in export_parquet.find_detail_files(Path(args.input_dir))
+                     for post in sinks.read_records(fp)]
+            asyncio.run(fetch_all(posts, store))
+            print(f"Downloaded {store.downloaded} images, reused {store.reused}, to:\t "
+                  f"{args.out_dir}")
+    finally:
+        store.close()
@@ -0,0 +1,163 @@
+"""
+Run journal, so an interrupted crawl resumes where it stopped.
+
+The journal is a JSON Lines file appended to as the crawl goes: one line per post whose details
+were downloaded, and one line per city whose results were written to disk. Each line is flushed
+as it is written, so a killed process loses at most the posts in flight. A restarted run with the
+same journal skips the cities already written, and reuses the details of every post journaled for
+the others, so only the search pages of those cities are downloaded again. Once every city of the
+run is written, the journal is deleted.
+"""
+import json
+from pathlib import Path
+from typing import Optional
+
+from src import schema, sinks
+from src.utils import get_project_root, to_valid_filename
+
+# ========================================== CONSTANTS ===========================================
+# directory for journals of runs in progress
+default_journal_dir = get_project_root().joinpath('data/Journal')
+
+# the journal used by `category_scrape`, None if runs are not journaled
+_journal = None
+
+
+# ========================================== HELPERS =============================================
+def default_journal_path(category: str, state: str, city: str = None) -> Path:
+    """ Journal of a run, e.g. data/Journal/cell-phones_PA_lancaster.jsonl """
+    parts = [category, state] + ([city] if city else [])
+    return default_journal_dir.joinpath('_'.join(map(to_valid_filename, parts)) + '.jsonl')
+
+
+# ========================================== JOURNAL =============================================
+class CityJournal:
+    def __init__(self, journal: 'RunJournal', state: str, city: str, posts: dict,
+                 fallback=None):
+        """
+        The posts journaled for one city. It is used as the city's post index, see
+        `category_scrape.find_previous_details`: journaled posts are found first, then posts of
+        the fallback index.
+        :param journal: the run journal to append posts to
+        :param state: State abbreviation.
+        :param city: City within above state.
+        :param posts: {pid: post}, journaled by an earlier attempt of the run
+        :param fallback: index of posts already on disk, e.g. with `--incremental`
+        """
+        self.journal = journal
+        self.state = state
+        self.city = city
+        self.posts = posts
+        self.fallback = fallback
+
+    def __bool__(self):
+        return bool(self.posts) or bool(self.fallback)
+
+    def get(self, pid: str) -> Optional[dict]:
+        post = self.posts.get(pid)
+        if post is None and self.fallback:
+            post = self.fallback.get(pid)
+        return post
+
+    def records(self) -> list:
+        """ Posts journaled by an earlier attempt of the run, once each """
+        return list({id(post): post for post in self.posts.values()}.values())
+
+    def record(self, post: dict) -> None:
+        """ Journal a post whose details were downloaded """
+        self.journal.write({'state': self.state, 'city': self.city, 'post': post})
+
+
+class RunJournal:
+    def __init__(self, path):
+        """
+        Open a journal, reading the progress of an earlier attempt of the run if there is one.
+        :param path: journal file, created if missing
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # {(state, city): number of posts written}
+        self.finished = {}
+        # {(state, city): {pid: `schema.Post`}} of cities not finished yet
+        self._posts = {}
+        if self.path.exists():
+            for entry in sinks.read_json_lines(self.path):
+                key = (entry['state'], entry['city'])
+                if 'done' in entry:
+                    self.finished[key] = entry['done']
+                    self._posts.pop(key, None)
+                else:
+                    post = schema.Post(entry['post'])
+                    posts = self._posts.setdefault(key, {})
+                    posts[post['pid_repost'] or post['pid']] = post
+                    posts[post['pid']] = post
+        # cities started in this attempt and not finished yet
+        self.pending = set()
+        self._file = open(self.path, 'a')
+
+    @property
+    def resumed(self) -> int:
+        """ Number of posts journaled for unfinished cities by an earlier attempt """
+        return sum(len({id(p) for p in posts.values()}) for posts in self._posts.values())
+
+    def write(self, entry: dict) -> None:
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+
+    def is_finished(self, state: str, city: str) -> bool:
+        return (state, city) in self.finished
+
+    def start_city(self, state: str, city: str) -> None:
+        """
+        Record that a city is scheduled, before any of its work, so the journal is kept if the
+        city fails before its posts are journaled.
+        """
+        self.pending.add((state, city))
+
+    def city(self, state: str, city: str, fallback=None) -> CityJournal:
+        """
+        Start journaling the posts of a city.
+        :param state: State abbreviation.
+        :param city: City within above state.
+        :param fallback: index of posts already on disk, looked up after the journal
+        :return: the city's journal, to use as its post index
+        """
+        self.start_city(state, city)
+        return CityJournal(self, state, city, self._posts.pop((state, city), {}), fallback)
+
+    def finish_city(self, state: str, city: str, posts: int) -> None:
+        """ Record that the results of a city were written to disk """
+        self.write({'state': state, 'city': city, 'done': posts})
+        self.finished[(state, city)] = posts
+        self.pending.discard((state, city))
+
+    def close(self, complete: bool = False) -> None:
+        """
+        :param complete: the run ended without error. The journal is deleted if every city it
+            started was finished, and kept for the next attempt otherwise.
+        """
+        self._file.close()
+        if complete and not self.pending:
+            self.path.unlink()
+
+
+# ============================================ API ===============================================
+def enable_journal(path) -> RunJournal:
+    """ Journal the cities and posts scraped by `category_scrape`, resuming from path """
+    global _journal
+    disable_journal()
+    _journal = RunJournal(path)
+    return _journal
+
+
+def get_journal() -> Optional[RunJournal]:
+    """ Get the journal used by `category_scrape`, None if runs are not journaled """
+    return _journal
+
+
+def disable_journal(complete: bool = False) -> None:
+    """ Close the journal, deleting it if complete, see `RunJournal.close` """
+    global _journal
+    if _journal is not None:
+        _journal.close(complete)
+        _journal = None
@@ -1,33 +1,169 @@
-import pathlib
-import requests
-from lxml import etree
-from datetime import datetime
+"""
+Search posts by keyword across any set of cities, using Craigslist's RSS feed.
+
+The feed (`format=rss`) is a small RDF document with one `item` per post, much smaller and faster
+to parse than the HTML search page. One query is sent to every city at once, a bounded number at
+a time, and the results are merged into a single list without duplicates.
+"""
+import argparse
+import asyncio
 import json
+import logging
+import re
+from urllib.parse import urlencode
+
+import aiohttp
+from lxml import etree
+
+from src import extract, http_cache
+from src.resolver import get_resolver, iter_cities
+from src.throttle import make_session
+from src.utils import get_project_root, get_timestamp, split_site_url, to_valid_filename
+
+# ========================================== CONSTANTS ===========================================
+# directory to write results to
+out_dir = get_project_root().joinpath('data/Query_Response')
+
+# RSS search URL, for a category abbreviation. 'sss' searches everything for sale.
+rss_url_template = r'{baseUrl}/search/{catAbbr}'
+all_for_sale = 'sss'
+
+# default number of cities searched at the same time
+default_concurrency = 16
+
+# pid in a post link, e.g. https://lancaster.craigslist.org/mob/d/lancaster-iphone/7141767734.html
+pid_pattern = re.compile(r'/(\d+)\.html')
+
+
+# ========================================== HELPERS =============================================
+def build_rss_url(base_url: str, query: str, category: str = None) -> str:
+    """
+    Build the RSS search URL for a query.
+    :param base_url: URL to specific craiglist loc, e.g "lancaster.craigslist.org", or to a
+        subarea of one, e.g. "//newyork.craigslist.org/fct/"
+    :param query: keywords to search
+    :param category: a 'for sale' category, e.g. 'cell phones'. If not given, everything for sale
+        is searched.
+    :return: URL string
+    """
+    abbr = get_resolver().category_abbr(category) if category else all_for_sale
+    # a subarea is searched under its site, e.g. newyork.craigslist.org/search/fct/sss
+    site, subarea = split_site_url(base_url)
+    if subarea:
+        abbr = f'{subarea}/{abbr}'
+    params = urlencode({'format': 'rss', 'query': query, 'sort': 'rel'})
+    return rss_url_template.format(baseUrl=site, catAbbr=abbr) + '?' + params
+
+
+def parse_rss(body: bytes) -> list:
+    """
+    Parse an RSS search feed.
+    :param body: feed, as downloaded
+    :return: [{title, link, description, date, ..., pid}], one per post. Namespaces are dropped
+        from field names.
+    """
+    root = etree.fromstring(body)
+    items = []
+    for item in root.iter('{*}item'):
+        entry = {etree.QName(elt).localname: elt.text for elt in item}
+        match = pid_pattern.search(entry.get('link') or '')
+        entry['pid'] = match.group(1) if match else None
+        items.append(entry)
+    return items
+
+
+# ============================================ API ===============================================
+async def search_city(base_url: str, query: str, session: aiohttp.ClientSession,
+                      category: str = None) -> list:
+    """
+    Search posts by keyword within a single city.
+    :param base_url: specific CL link, e.g. lancaster.craigslist.org
+    :param query: keywords to search
+    :param session: HTTP session to use
+    :param category: a 'for sale' category, e.g. 'cell phones'
+    :return: [{title, link, ..., pid}], most relevant first
+    """
+    body = await http_cache.fetch(build_rss_url(base_url, query, category), session)
+    return await extract.run_parser(parse_rss, body)
+
+
+async def search(query: str, states: list = None, cities: list = None, category: str = None,
+                 concurrency: int = default_concurrency,
+                 session: aiohttp.ClientSession = None) -> list:
+    """
+    Search posts by keyword within all of the US, or within the given states or cities.
+    A city that fails after retries is logged and skipped.
+    :param query: keywords to search
+    :param states: State abbreviations. If not given, every state is searched.
+    :param cities: names of cities, if there is a single state. If not given, every city is
+        searched.
+    :param category: a 'for sale' category, e.g. 'cell phones'
+    :param concurrency: number of cities searched at the same time
+    :param session: HTTP session to use. If not given, one is created for this call.
+    :return: [{title, link, ..., pid, state, city}]. A post listed by several nearby cities is
+        only kept once, as found by the first of them.
+    """
+    if concurrency < 1:
+        raise ValueError(f"Concurrency must be at least 1, got: {concurrency}")
+    locations = list(iter_cities(states, cities))
+    if session is None:
+        async with make_session() as session:
+            return await search(query, states, cities, category, concurrency, session)
+    limiter = asyncio.Semaphore(concurrency)
+
+    async def search_location(state, city, base_url):
+        async with limiter:
+            try:
+                return await search_city(base_url, query, session, category)
+            except Exception:
+                logging.error(f"Error for city: {city}, {state}", exc_info=True)
+                return []
+
+    results = await asyncio.gather(*[search_location(*loc) for loc in locations])
+    # Merge results in city order, dropping posts already found by another city.
+    merged, seen = [], set()
+    for (state, city, _), items in zip(locations, results):
+        for item in items:
+            key = item['pid'] or item.get('link')
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(dict(item, state=state, city=city))
+    return merged
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Search posts by keyword across cities")
+    parser.add_argument('query', help='Keywords to search')
+    parser.add_argument('state', nargs='?', default='ALL',
+        help="State abbreviation, or 'ALL' to search every state")
+    parser.add_argument('city', nargs='*',
+        help='City names within given state. If excluded, will search all cities in state.')
+    parser.add_argument('--category', metavar='CATEGORY',
+        help="A 'for sale' category, see config/category_abbreviations.json. If excluded, will"
+             " search everything for sale.")
+    parser.add_argument('--concurrency', '-c', type=int, default=default_concurrency,
+        help='Number of cities to search at the same time')
+    parser.add_argument('--out_dir', '-o', default=out_dir,
+        help='Dir to write results to')
+    args = parser.parse_args()
+
+    # Misspelled names are rejected rather than corrected, since a typo could name another city.
+    resolver = get_resolver()
+    resolver.fuzzy = False
+    states = None if args.state.upper() == 'ALL' else [args.state]
+    try:
+        if args.category:
+            args.category = resolver.resolve_category(args.category)
+        list(iter_cities(states, args.city))
+    except ValueError as e:
+        parser.error(str(e))
+    items = asyncio.run(search(args.query, states, args.city, args.category, args.concurrency))
 
-# directory to write file
-out_dir = r"Data/Query_Response"
-# search string
-query = input('Search: ')
-
-# run query
-url = f'https://lancaster.craigslist.org/search/sss?format=rss&query={query}&sort=rel'
-response = requests.get(url)
-if response.status_code != 200:
-    raise ConnectionError('response code != 200')
-root = etree.fromstring(response.content)
-
-# parse results
-items = []
-for item in root.findall('item', root.nsmap):
-    tags = [elt.tag for elt in item]
-    fields = [t.split('}')[1] for t in tags]
-    values = [elt.text for elt in item]
-    entry = dict(zip(fields, values))
-    items.append(entry)
-
-# write to file
-time = datetime.now().strftime("%d-%m-%Y_%I-%M-%S_%p")
-filename = f"{query}_{time}.json"
-fpath = pathlib.Path(out_dir).joinpath(filename)
-with open(fpath, 'w') as f:
-    json.dump(items, f, indent=True)
+    # write result
+    fpath = get_project_root().joinpath(
+        args.out_dir, f"{to_valid_filename(args.query)}_{get_timestamp()}.json")
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    with open(fpath, 'w') as f:
+        json.dump(items, f, indent=True)
+    print(f"Saved {len(items)} posts to:\t {fpath}")
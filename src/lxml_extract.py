@@ -0,0 +1,161 @@
+"""
+lxml versions of the BeautifulSoup extraction functions in `src/query_post.py` and
+`src/extract.py`. Each function returns the same values as its BeautifulSoup counterpart,
+using precompiled XPath selectors over an `lxml.html` tree, which is several times faster to
+build and search than a `html.parser` soup.
+"""
+from typing import List
+
+import lxml.html
+from lxml.etree import XPath
+
+# ========================================== CONSTANTS ===========================================
+# Craigslist pages are UTF-8. Without this, lxml falls back to latin-1 for pages missing a charset.
+parser = lxml.html.HTMLParser(encoding='utf-8')
+
+
+# ========================================== SELECTORS ===========================================
+def has_class(name: str) -> str:
+    """ XPath predicate matching elements whose class attribute contains the given class """
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# search results page
+select_rows = XPath(f"//li[{has_class('result-row')}]")
+select_title = XPath(".//a[@class='result-title hdrlnk']")
+select_price = XPath(f".//*[{has_class('result-price')}]")
+select_time = XPath(f".//time[{has_class('result-date')}]/@datetime")
+select_total_count = XPath(f"//span[{has_class('totalcount')}]")
+
+# post details page
+select_attributes = XPath(f"//p[{has_class('attrgroup')}]")
+select_gallery = XPath("//a[@data-imgid]")
+select_first_visible = XPath("//div[@class='slide first visible']")
+
+
+# ========================================== HELPERS =============================================
+def parse(body: bytes) -> lxml.html.HtmlElement:
+    """ Parse a downloaded page """
+    return lxml.html.document_fromstring(body, parser=parser)
+
+
+def soup_string(text: str) -> str:
+    """ BeautifulSoup collapses whitespace-only strings to a single newline or space """
+    if text and text.isspace():
+        return '\n' if '\n' in text else ' '
+    return text
+
+
+def get_text(element: lxml.html.HtmlElement, strip=False) -> str:
+    """ Equivalent of BeautifulSoup's `Tag.get_text` """
+    if strip:
+        return ''.join(s.strip() for s in element.itertext())
+    return ''.join(soup_string(s) for s in element.itertext())
+
+
+def first_descendant(element: lxml.html.HtmlElement, tag: str):
+    """ Equivalent of BeautifulSoup's `tag.<name>` shortcut, e.g. `soup.body.section` """
+    return next(element.iterdescendants(tag), None)
+
+
+# ========================================== SEARCH PAGE =========================================
+def get_total_count(doc: lxml.html.HtmlElement) -> int:
+    """
+    Extract the total number of search results from a search page.
+    :param doc: of search results page
+    :return: total result count, or 0 if the page does not show one
+    """
+    total = select_total_count(doc)
+    if not total:
+        return 0
+    digits = ''.join(c for c in get_text(total[0]) if c.isdigit())
+    return int(digits) if digits else 0
+
+
+def extract_overview_info(search_result_post: lxml.html.HtmlElement) -> dict:
+    """
+    Extract overview information from a search result post entry.
+    :param search_result_post: A single post search result
+    :return: {title, link, pid, ...}
+    """
+    title_attr = select_title(search_result_post)[0]
+    price_str = get_text(select_price(search_result_post)[0], strip=True)
+    return {
+        'title': get_text(title_attr),
+        'link': title_attr.attrib['href'],
+        'pid': search_result_post.attrib['data-pid'],
+        'pid_repost': search_result_post.get('data-repost-of'),
+        'price': int(''.join([p for p in price_str if p.isdigit()])),
+        'time': str(select_time(search_result_post)[0]),
+    }
+
+
+def get_post_overviews(doc: lxml.html.HtmlElement) -> list:
+    """
+    Extract post overview information from a search results page.
+    :param doc: of search results page
+    :return: [{title, link, ...}] high-level post info
+    """
+    return [extract_overview_info(row) for row in select_rows(doc)]
+
+
+# ========================================== POST PAGE ===========================================
+def get_description(doc: lxml.html.HtmlElement) -> str:
+    """
+    Extract description from a post.
+    :param doc: of post details page
+    :return: description text
+    """
+    section = doc.body
+    for _ in range(4):
+        section = first_descendant(section, 'section')
+    # Text directly inside the section, i.e. not inside any of its child tags.
+    strings = [section.text or ''] + [c.tail or '' for c in section]
+    return ''.join(soup_string(s) for s in strings)
+
+
+def get_attributes(doc: lxml.html.HtmlElement) -> dict:
+    """
+    Extract attributes from a post.
+    :param doc: of post details page
+    :return: {condition, make/manufacturer, mobileOS, ...}
+    """
+    attributes = select_attributes(doc)
+    if not attributes:
+        return {}
+    # extract field,value pairs
+    field_value = {}
+    for attr in attributes[0]:
+        # skip comments and processing instructions
+        if not isinstance(attr.tag, str):
+            continue
+        text = get_text(attr, strip=True)
+        if len(text) == 0:
+            continue
+        parts = text.split(':')
+        if len(parts) == 1:
+            field, value = parts[0], None
+        elif len(parts) == 2:
+            field, value = parts
+        else:
+            field, value = parts[0], parts[1:]
+        field_value[field] = value
+    return field_value
+
+
+def get_images(doc: lxml.html.HtmlElement) -> List[str]:
+    """
+    Extract image URLs from a post.
+    :param doc: of post details page
+    :return: [url] if 1 or more images found, otherwise []
+    """
+    image_urls = [e.attrib['href'] for e in select_gallery(doc)]
+    # If there is no scrollable gallery, there may still be a single image.
+    if not image_urls:
+        first_visible = select_first_visible(doc)
+        main_image = first_descendant(first_visible[0], 'img') if first_visible else None
+        if main_image is not None:
+            url = main_image.get('src')
+            if url:
+                image_urls.append(url)
+    return image_urls
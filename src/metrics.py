@@ -0,0 +1,322 @@
+"""
+Counters, timing histograms and trace spans for crawl runs.
+
+Everything is off by default: until `enable_metrics` is called, `inc`, `observe`, `timer` and
+`span` return right away, so instrumented code costs a function call. Once enabled, metrics are
+kept in memory and exported either as Prometheus text (`prometheus_text`, or served over HTTP by
+`start_server`) or as a JSON run report (`write_report`). With tracing, the report also holds
+every span in Chrome's trace event format, which chrome://tracing and Perfetto can open.
+
+HTTP connections are timed through an aiohttp `TraceConfig`, see `trace_configs`: DNS lookups,
+waiting for a pooled connection, connection setup (TCP and TLS handshake) and time to response
+headers.
+"""
+import asyncio
+import contextlib
+import json
+import math
+import time
+from types import SimpleNamespace
+
+import aiohttp
+from aiohttp import web
+
+# ========================================== CONSTANTS ===========================================
+# upper bounds of histogram buckets, in seconds
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+           math.inf)
+
+# prefix of exported metric names
+namespace = 'craigslist_'
+
+# default port of the Prometheus endpoint
+default_port = 9108
+
+# shared context manager returned while disabled
+_null = contextlib.nullcontext()
+
+# whether metrics, and trace spans, are recorded
+_enabled = False
+_tracing = False
+
+# {(name, labels): value}
+_counters = {}
+# {(name, labels): Histogram}
+_histograms = {}
+# [trace event]
+_spans = []
+# time the run started, for the report and span timestamps
+_started = time.perf_counter()
+# {task id: lane}, so concurrent spans are drawn on separate rows of the trace
+_lanes = {}
+
+
+# ========================================== HELPERS =============================================
+class Histogram:
+    """ Counts of observations per bucket, like a Prometheus histogram """
+    def __init__(self):
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """ Upper bound of the bucket holding quantile q, capped at the largest observation """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Timer:
+    """ Observes the time spent in a `with` block into a histogram, and traces it as a span """
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        observe(self.name, end - self.start, **self.labels)
+        if _tracing:
+            add_span(self.labels.get('stage', self.name), self.start, end, self.labels)
+
+
+def key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def get_lane() -> int:
+    try:
+        task = id(asyncio.current_task())
+    except RuntimeError:
+        task = None
+    lane = _lanes.get(task)
+    if lane is None:
+        lane = _lanes[task] = len(_lanes)
+    return lane
+
+
+def add_span(name: str, start: float, end: float, attributes: dict) -> None:
+    _spans.append({
+        'name': name,
+        'ph': 'X',
+        'ts': round((start - _started) * 1e6),
+        'dur': round((end - start) * 1e6),
+        'pid': 0,
+        'tid': get_lane(),
+        'args': {k: str(v) for k, v in attributes.items()},
+    })
+
+
+def format_labels(labels: tuple, extra: str = '') -> str:
+    """ Labels of a Prometheus sample, e.g. {status="200",le="0.5"} """
+    escape = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+    parts = [f'{k}="{v.translate(escape)}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+# ========================================== RECORDING ===========================================
+def enabled() -> bool:
+    return _enabled
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """ Add to a counter, e.g. inc('http_requests_total', status=200) """
+    if not _enabled:
+        return
+    k = key(name, labels)
+    _counters[k] = _counters.get(k, 0) + value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """ Record a value, in seconds, in a histogram """
+    if not _enabled:
+        return
+    k = key(name, labels)
+    histogram = _histograms.get(k)
+    if histogram is None:
+        histogram = _histograms[k] = Histogram()
+    histogram.observe(value)
+
+
+def timer(name: str, **labels):
+    """
+    Time a block of code, e.g.
+        with metrics.timer('stage_seconds', stage='parse'):
+            ...
+    :param name: of the histogram
+    :param labels: of the histogram. If tracing, the block is a span named by the stage label.
+    :return: context manager
+    """
+    if not _enabled:
+        return _null
+    return Timer(name, labels)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """ Trace a block of code, without timing it into a histogram """
+    if not _tracing:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(name, start, time.perf_counter(), attributes)
+
+
+def trace_configs() -> list:
+    """
+    Hooks timing the connections of an aiohttp session, if metrics are enabled.
+    :return: [aiohttp.TraceConfig], to pass as the session's trace_configs
+    """
+    if not _enabled:
+        return []
+
+    def started(attribute):
+        async def on_start(session, ctx, params):
+            setattr(ctx, attribute, time.perf_counter())
+        return on_start
+
+    def ended(attribute, name, **labels):
+        async def on_end(session, ctx, params):
+            start = getattr(ctx, attribute, None)
+            if start is not None:
+                observe(name, time.perf_counter() - start, **labels)
+        return on_end
+
+    async def on_dns_cache_hit(session, ctx, params):
+        inc('dns_cache_hits_total')
+
+    async def on_connection_reuseconn(session, ctx, params):
+        inc('connections_reused_total')
+
+    config = aiohttp.TraceConfig(trace_config_ctx_factory=SimpleNamespace)
+    config.on_dns_resolvehost_start.append(started('dns_start'))
+    config.on_dns_resolvehost_end.append(ended('dns_start', 'dns_seconds'))
+    config.on_dns_cache_hit.append(on_dns_cache_hit)
+    # TCP connect and TLS handshake, which aiohttp does not time separately
+    config.on_connection_create_start.append(started('connect_start'))
+    config.on_connection_create_end.append(ended('connect_start', 'connect_seconds'))
+    config.on_connection_reuseconn.append(on_connection_reuseconn)
+    # waiting for a free connection in the pool, once the connection limits are reached
+    config.on_connection_queued_start.append(started('queued_start'))
+    config.on_connection_queued_end.append(ended('queued_start', 'connection_wait_seconds'))
+    # from starting the request to receiving response headers. This includes the above, and
+    # otherwise is time spent waiting on the server.
+    config.on_request_start.append(started('request_start'))
+    config.on_request_end.append(ended('request_start', 'response_headers_seconds'))
+    return [config]
+
+
+# ============================================ EXPORT ============================================
+def prometheus_text() -> str:
+    """ Metrics in the Prometheus text exposition format """
+    lines = []
+    typed = set()
+    for (name, labels), value in sorted(_counters.items()):
+        if name not in typed:
+            lines.append(f'# TYPE {namespace}{name} counter')
+            typed.add(name)
+        lines.append(f'{namespace}{name}{format_labels(labels)} {value}')
+    for (name, labels), histogram in sorted(_histograms.items()):
+        if name not in typed:
+            lines.append(f'# TYPE {namespace}{name} histogram')
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip(buckets, histogram.counts):
+            cumulative += count
+            le = 'le="{}"'.format('+Inf' if bound == math.inf else repr(bound))
+            lines.append(f'{namespace}{name}_bucket{format_labels(labels, le)} {cumulative}')
+        lines.append(f'{namespace}{name}_sum{format_labels(labels)} {histogram.sum}')
+        lines.append(f'{namespace}{name}_count{format_labels(labels)} {histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+
+def report() -> dict:
+    """
+    Metrics of the run so far.
+    :return: {seconds, counters: [{name, labels, value}], histograms: [{name, labels, count,
+        sum, mean, p50, p95, p99, max}], traceEvents: [span]}
+    """
+    return {
+        'seconds': round(time.perf_counter() - _started, 3),
+        'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                     for (name, labels), value in sorted(_counters.items())],
+        'histograms': [{
+            'name': name,
+            'labels': dict(labels),
+            'count': h.count,
+            'sum': round(h.sum, 6),
+            'mean': round(h.sum / h.count, 6) if h.count else 0.0,
+            'p50': h.quantile(0.5),
+            'p95': h.quantile(0.95),
+            'p99': h.quantile(0.99),
+            'max': round(h.max, 6),
+        } for (name, labels), h in sorted(_histograms.items())],
+        'traceEvents': list(_spans),
+    }
+
+
+def write_report(path) -> None:
+    """ Write `report` to a JSON file, which chrome://tracing can also open """
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=2)
+
+
+async def start_server(port: int = default_port) -> web.AppRunner:
+    """
+    Serve `prometheus_text` at http://localhost:<port>/metrics on the running event loop.
+    :return: runner, to stop the server with `await runner.cleanup()`
+    """
+    async def handle(request):
+        return web.Response(text=prometheus_text(), content_type='text/plain')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', port).start()
+    return runner
+
+
+# ============================================ API ===============================================
+def enable_metrics(tracing: bool = False) -> None:
+    """
+    Start recording metrics, clearing any recorded before.
+    :param tracing: also record a span for every timed block
+    """
+    global _enabled, _tracing, _started
+    _enabled, _tracing = True, tracing
+    _counters.clear()
+    _histograms.clear()
+    _spans.clear()
+    _lanes.clear()
+    _started = time.perf_counter()
+
+
+def disable_metrics() -> None:
+    global _enabled, _tracing
+    _enabled = _tracing = False
+
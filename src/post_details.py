@@ -0,0 +1,74 @@
+"""
+Download and parse post detail pages.
+
+This is the detail step shared by `category_scrape` and `scrape_post`. Pages are downloaded
+concurrently over one pooled `aiohttp` session, going through the response cache and retry logic
+of `http_cache.fetch`, and parsed with `extract.run_parser`, in the process pool if one was
+started.
+"""
+import asyncio
+import logging
+
+import aiohttp
+
+from src import extract, http_cache, metrics, throttle
+from src.extract import get_city
+
+# ========================================== CONSTANTS ===========================================
+# fields added to a post overview by the detail step
+detail_fields = ('city', 'description', 'attributes', 'images')
+
+
+# ========================================== HELPERS =============================================
+def failed_post_details(url: str, error: BaseException) -> dict:
+    """
+    Details recorded for a post that could not be downloaded or parsed.
+    :param url: Link to the post
+    :param error: raised while getting details
+    :return: {city, description, ..., error}
+    """
+    details = {k: None for k in detail_fields}
+    details['city'] = get_city(url)
+    details['error'] = f'{type(error).__name__}: {error}'
+    return details
+
+
+# ============================================ API ===============================================
+async def get_post_details(url: str, session: aiohttp.ClientSession) -> dict:
+    """
+    Extract details from a craigslist post link.
+    :param url: Link to a post
+    :param session: HTTP session to use
+    :return: {city, description, attributes, images}
+    """
+    with metrics.timer('stage_seconds', stage='post_details'):
+        body = await http_cache.fetch(url, session)
+    # The engine is passed explicitly since worker processes do not see `extract.set_engine`.
+    return await extract.run_parser(extract.parse_post_page, body, url, extract.default_engine)
+
+
+async def get_post_details_or_error(url: str, session: aiohttp.ClientSession) -> dict:
+    """
+    Same as `get_post_details`, but a post that fails after retries is recorded with its error
+    instead of raising.
+    :return: {city, description, attributes, images}, plus error if it failed
+    """
+    try:
+        return await get_post_details(url, session)
+    except Exception as e:
+        metrics.inc('post_errors_total', error=type(e).__name__)
+        logging.warning(f"Error for post: {url}: {e!r}")
+        return failed_post_details(url, e)
+
+
+async def get_all_post_details(urls: list, session: aiohttp.ClientSession = None) -> list:
+    """
+    Get the details of many posts at once. The session's connector caps how many are in flight.
+    :param urls: Links to posts
+    :param session: HTTP session to use. If not given, one is created for this call.
+    :return: [{city, description, ...}], in the order of urls
+    """
+    if session is None:
+        async with throttle.make_session() as session:
+            return await get_all_post_details(urls, session)
+    return await asyncio.gather(*[get_post_details_or_error(url, session) for url in urls])
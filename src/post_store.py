@@ -0,0 +1,262 @@
+"""
+SQLite store for scraped posts.
+
+Every post is one row of the `posts` table, keyed by pid and indexed by pid_repost, city,
+category and time, so questions like "have I seen pid X" are answered with an index lookup instead
+of scanning every output file. Overviews and details are upserted: a post seen again updates its
+row, and every change of price is recorded in `price_history`. Writes are buffered and committed
+in batches.
+"""
+import datetime
+import json
+import sqlite3
+from pathlib import Path
+from typing import Optional
+
+from src.utils import get_project_root
+
+# ========================================== CONSTANTS ===========================================
+# default database file
+default_db = get_project_root().joinpath('data/posts.db')
+
+# number of rows written per transaction
+default_batch_size = 500
+
+# the store used by `category_scrape`, opened on first use
+_store = None
+
+schema = '''
+CREATE TABLE IF NOT EXISTS posts (
+    pid INTEGER PRIMARY KEY,
+    pid_repost INTEGER,
+    category TEXT NOT NULL,
+    state TEXT NOT NULL,
+    city TEXT NOT NULL,
+    site TEXT,
+    title TEXT,
+    link TEXT,
+    price INTEGER,
+    time TEXT,
+    description TEXT,
+    attributes TEXT,
+    images TEXT,
+    image_files TEXT,
+    error TEXT,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS posts_pid_repost ON posts (pid_repost);
+CREATE INDEX IF NOT EXISTS posts_city ON posts (state, city);
+CREATE INDEX IF NOT EXISTS posts_category ON posts (category);
+CREATE INDEX IF NOT EXISTS posts_time ON posts (time);
+
+CREATE TABLE IF NOT EXISTS price_history (
+    pid INTEGER NOT NULL,
+    price INTEGER,
+    seen_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS price_history_pid ON price_history (pid);
+
+CREATE TRIGGER IF NOT EXISTS posts_price_insert AFTER INSERT ON posts
+BEGIN
+    INSERT INTO price_history (pid, price, seen_at) VALUES (new.pid, new.price, new.last_seen);
+END;
+CREATE TRIGGER IF NOT EXISTS posts_price_update AFTER UPDATE OF price ON posts
+WHEN old.price IS NOT new.price
+BEGIN
+    INSERT INTO price_history (pid, price, seen_at) VALUES (new.pid, new.price, new.last_seen);
+END;
+'''
+
+overview_columns = ('pid', 'pid_repost', 'category', 'state', 'city', 'title', 'link', 'price',
+                    'time', 'first_seen', 'last_seen')
+detail_columns = overview_columns + ('site', 'description', 'attributes', 'images', 'image_files',
+                                     'error')
+
+# columns added since the first version of the table, with their type
+added_columns = {'image_files': 'TEXT'}
+
+
+def upsert_sql(columns: tuple) -> str:
+    """ Insert a post, or update every given column except first_seen if it exists """
+    updates = ', '.join(f'{c} = excluded.{c}' for c in columns if c not in ('pid', 'first_seen'))
+    return (f"INSERT INTO posts ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+            f"ON CONFLICT (pid) DO UPDATE SET {updates}")
+
+
+upsert_overview = upsert_sql(overview_columns)
+upsert_detail = upsert_sql(detail_columns)
+
+
+# ========================================== HELPERS =============================================
+def parse_int(value) -> Optional[int]:
+    return int(value) if value not in (None, '') else None
+
+
+def to_post(row: sqlite3.Row) -> dict:
+    """ Convert a row of the posts table back to the dict written by `category_scrape` """
+    return {
+        'city': row['site'],
+        'description': row['description'],
+        'attributes': json.loads(row['attributes']) if row['attributes'] else None,
+        'images': json.loads(row['images']) if row['images'] else None,
+        **({'image_files': json.loads(row['image_files'])} if row['image_files'] else {}),
+        **({'error': row['error']} if row['error'] else {}),
+        'title': row['title'],
+        'link': row['link'],
+        'pid': str(row['pid']),
+        'pid_repost': str(row['pid_repost']) if row['pid_repost'] else None,
+        'price': row['price'],
+        'time': row['time'],
+    }
+
+
+# ============================================ STORE =============================================
+class PostStore:
+    def __init__(self, path=default_db, batch_size: int = default_batch_size):
+        """
+        :param path: database file, created if missing
+        :param batch_size: number of rows written per transaction
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.executescript(schema)
+        # Databases created before a column was added get it, empty for the posts already there.
+        existing = {row['name'] for row in self.conn.execute('PRAGMA table_info(posts)')}
+        for column, type_ in added_columns.items():
+            if column not in existing:
+                self.conn.execute(f'ALTER TABLE posts ADD COLUMN {column} {type_}')
+        self.batch_size = batch_size
+        # {sql: [row]} waiting to be written
+        self._pending = {upsert_overview: [], upsert_detail: []}
+
+    def _add(self, sql: str, row: tuple) -> None:
+        self._pending[sql].append(row)
+        if len(self._pending[sql]) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Write pending rows in a single transaction """
+        with self.conn:
+            for sql, rows in self._pending.items():
+                if rows:
+                    self.conn.executemany(sql, rows)
+                    rows.clear()
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
+
+    def upsert_overview(self, post: dict, state: str, city: str, category: str,
+                        seen_at: str) -> None:
+        """ Insert or update a post from its overview, as returned by `extract_overview_info` """
+        self._add(upsert_overview, (
+            parse_int(post['pid']), parse_int(post['pid_repost']), category, state, city,
+            post['title'], post['link'], post['price'], post['time'], seen_at, seen_at))
+
+    def upsert_detail(self, post: dict, state: str, city: str, category: str,
+                      seen_at: str) -> None:
+        """ Insert or update a post from its overview merged with its details """
+        self._add(upsert_detail, (
+            parse_int(post['pid']), parse_int(post['pid_repost']), category, state, city,
+            post['title'], post['link'], post['price'], post['time'], seen_at, seen_at,
+            post.get('city'), post.get('description'), json.dumps(post.get('attributes')),
+            json.dumps(post.get('images')),
+            json.dumps(post['image_files']) if post.get('image_files') else None,
+            post.get('error')))
+
+    def get(self, pid) -> Optional[dict]:
+        """
+        Get a post by pid, or else the latest repost of it with details. Only rows already
+        written are looked up, so lookups do not commit the pending batch.
+        :param pid: of the post
+        :return: post, as written by `category_scrape`, or None if not stored
+        """
+        row = self.conn.execute('SELECT * FROM posts WHERE pid = ?', (parse_int(pid),)).fetchone()
+        if row is None:
+            row = self.conn.execute(
+                'SELECT * FROM posts WHERE pid_repost = ? AND description IS NOT NULL '
+                'ORDER BY last_seen DESC LIMIT 1', (parse_int(pid),)).fetchone()
+        if row is None or row['description'] is None and row['error'] is None:
+            # unknown, or only the overview was stored
+            return None
+        return to_post(row)
+
+    def has_pid(self, pid) -> bool:
+        """ Whether a post is stored, looking up only rows already written, as `get` does """
+        query = 'SELECT 1 FROM posts WHERE pid = ?'
+        return self.conn.execute(query, (parse_int(pid),)).fetchone() is not None
+
+    def price_history(self, pid) -> list:
+        """
+        Get the price history of a repost chain, i.e. of a post and all reposts of it.
+        :param pid: of any post in the chain
+        :return: [(pid, price, seen_at)] ordered by seen_at
+        """
+        self.flush()
+        row = self.conn.execute('SELECT pid, pid_repost FROM posts WHERE pid = ?',
+                                (parse_int(pid),)).fetchone()
+        root = (row['pid_repost'] or row['pid']) if row else parse_int(pid)
+        rows = self.conn.execute(
+            'SELECT h.pid, h.price, h.seen_at FROM price_history h '
+            'JOIN posts p ON p.pid = h.pid WHERE p.pid = ? OR p.pid_repost = ? '
+            'ORDER BY h.seen_at', (root, root)).fetchall()
+        return [tuple(r) for r in rows]
+
+    def sink(self, state: str, city: str, category: str) -> 'StoreSink':
+        """ Get a sink that writes the posts of one city to this store """
+        return StoreSink(self, state, city, category)
+
+
+class StoreSink:
+    def __init__(self, store: PostStore, state: str, city: str, category: str):
+        """
+        Write the posts of one city to a `PostStore`. Has the same interface as
+        `sinks.JsonLinesSink`.
+        """
+        self.store = store
+        self.state, self.city, self.category = state.upper(), city.lower(), category
+        self.seen_at = datetime.datetime.now().isoformat(sep=' ', timespec='seconds')
+
+    def write_overviews(self, post_overviews: list) -> None:
+        for post in post_overviews:
+            self.store.upsert_overview(post, self.state, self.city, self.category, self.seen_at)
+
+    def write_details(self, post_detail: dict) -> None:
+        self.store.upsert_detail(post_detail, self.state, self.city, self.category, self.seen_at)
+
+    def close(self) -> None:
+        self.store.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ============================================ API ===============================================
+def open_store(path=default_db, batch_size: int = default_batch_size) -> PostStore:
+    """ Open the store used by `category_scrape` """
+    global _store
+    close_store()
+    _store = PostStore(path, batch_size)
+    return _store
+
+
+def get_store() -> PostStore:
+    """ Get the store used by `category_scrape`, opening the default database on first use """
+    if _store is None:
+        return open_store()
+    return _store
+
+
+def close_store() -> None:
+    global _store
+    if _store is not None:
+        _store.close()
+        _store = None
@@ -1,49 +1,225 @@
 """
-TODO DEPRECATED
-Process the raw scraped data by extracting relevant fields.
+Normalize scraped records in batches: overview and detail records written by `category_scrape`,
+and RSS results written by `keyword_search`.
+
+- title and description: HTML tags and entities removed, whitespace collapsed
+- price: a number, taken from the price field (e.g. 500 or "$1,200"), or else from a "$<amount>"
+  in the title, as RSS titles carry the price
+- time: "YYYY-MM-DD HH:MM" local time, taken from the time field or the RSS date field
+
+Records are processed a column at a time with precompiled regular expressions and string methods
+rather than a BeautifulSoup per string. Prices and times are parsed with vectorized pandas
+operations if pandas is installed. With `--input_dir`, files are processed by a pool of processes.
 """
 import argparse
-import pathlib
+import datetime
+import html
 import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+from src import sinks
+from src.utils import get_project_root
+
+# ========================================== CONSTANTS ===========================================
+# default directory for processed files
+default_out_dir = get_project_root().joinpath('data/Query_Processed')
+
+# elements whose content is not text, and any other tag or comment
+hidden_pattern = re.compile(r'<(script|style)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+tag_pattern = re.compile(r'<!--.*?-->|<[^>]*>', re.DOTALL)
+
+# tags that end a line of text, replaced by a line break before other tags are removed
+break_pattern = re.compile(r'<br\s*/?>|</p\s*>', re.IGNORECASE)
+
+# price in a title, e.g. "iPhone 11 $500" or "$1,200.50"
+price_pattern = re.compile(r'\$\s*(\d[\d,]*(?:\.\d+)?)')
+
+# characters dropped from price fields before parsing them as a number
+price_junk_pattern = re.compile(r'[$,\s]')
+
+# format of normalized times, see `export_parquet.time_format`. Times and RSS dates start with
+# it, e.g. 2020-06-14 14:04 or 2020-06-14T14:04:29-07:00
+time_format = '%Y-%m-%d %H:%M'
+time_length = 16
+
+# extensions of the files processed with `--input_dir`
+extensions = ('json',) + sinks.formats
+
+
+# ========================================== HELPERS =============================================
+def strip_tags(text: str) -> str:
+    """
+    Text of an HTML fragment, with tags, comments and entities removed. Line breaks and ends of
+    paragraphs become new lines.
+    """
+    # Most scraped text is plain already, so the patterns are only run if there can be a match.
+    if '<' in text:
+        text = break_pattern.sub('\n', hidden_pattern.sub(' ', text))
+        text = tag_pattern.sub(' ', text)
+    return html.unescape(text) if '&' in text else text
+
+
+def to_number(value: float):
+    """ int if value is whole, None if it is NaN """
+    if value != value:
+        return None
+    return int(value) if float(value).is_integer() else value
+
 
-from src.utils import strip_html_tags
+def find_files(input_dir: Path) -> list:
+    """ Files of records in a directory, at any depth, or the input itself if it is a file """
+    if not input_dir.is_dir():
+        return [input_dir]
+    return sorted(fp for ext in extensions for fp in input_dir.rglob(f'*.{ext}'))
 
 
-def preprocess(data):
-    for entry in data:
-        entry['price'] = None
+# ========================================== COLUMNS =============================================
+def clean_titles(titles: list) -> list:
+    """ Strip HTML from titles, and collapse whitespace to single spaces """
+    return [' '.join(strip_tags(t).split()) if t else t for t in titles]
+
+
+def clean_descriptions(descriptions: list) -> list:
+    """ Strip HTML from descriptions, keeping line breaks but no blank or indented lines """
+    result = []
+    for d in descriptions:
+        if d:
+            lines = (' '.join(line.split()) for line in strip_tags(d).splitlines())
+            d = '\n'.join(line for line in lines if line)
+        result.append(d)
+    return result
+
+
+def parse_prices(prices: list, titles: list) -> list:
+    """
+    Parse prices as numbers.
+    :param prices: price fields, e.g. 500, "$1,200" or None
+    :param titles: titles to find a price in when the price field has none
+    :return: [int, float or None]
+    """
+    if pd is not None:
+        fields = pd.Series(prices, dtype=object).astype(str).str.replace(price_junk_pattern, '',
+                                                                         regex=True)
+        parsed = pd.to_numeric(fields, errors='coerce')
+        in_title = pd.Series(titles, dtype=object).str.extract(price_pattern, expand=False)
+        parsed = parsed.fillna(pd.to_numeric(in_title.str.replace(',', ''), errors='coerce'))
+        return [to_number(p) for p in parsed.tolist()]
+    result = []
+    for price, title in zip(prices, titles):
+        try:
+            parsed = to_number(float(price_junk_pattern.sub('', str(price))))
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            match = price_pattern.search(title or '')
+            if match:
+                parsed = to_number(float(match.group(1).replace(',', '')))
+        result.append(parsed)
+    return result
+
+
+def parse_times(times: list) -> list:
+    """
+    Normalize times to `time_format`, dropping seconds and UTC offsets.
+    :param times: e.g. "2020-06-14 14:04" or "2020-06-14T14:04:29-07:00"
+    :return: [str or None], None for missing or invalid times
+    """
+    if pd is not None:
+        prefixes = pd.Series(times, dtype=object).str.slice(0, time_length).str.replace('T', ' ')
+        valid = pd.to_datetime(prefixes, format=time_format, errors='coerce').notna()
+        return prefixes.where(valid, None).tolist()
+    result = []
+    for t in times:
+        prefix = t[:time_length].replace('T', ' ') if isinstance(t, str) else None
+        try:
+            datetime.datetime.strptime(prefix, time_format)
+        except (TypeError, ValueError):
+            prefix = None
+        result.append(prefix)
+    return result
+
+
+# ============================================ API ===============================================
+def preprocess(data: list) -> list:
+    """
+    Normalize records, see the module docstring.
+    :param data: [{title, description, price, time, ...}], any of the fields being optional
+    :return: data, normalized in place
+    """
+    if not data:
+        return data
+    titles = clean_titles([entry.get('title') for entry in data])
+    prices = parse_prices([entry.get('price') for entry in data], titles)
+    times = parse_times([entry.get('time') or entry.get('date') for entry in data])
+    has_description = any('description' in entry for entry in data)
+    if has_description:
+        descriptions = clean_descriptions([entry.get('description') for entry in data])
+    for i, entry in enumerate(data):
         if 'title' in entry:
-            title = strip_html_tags(entry['title'])
-            entry['title'] = title
-            if '$' in title:
-                entry['price'] = title.split('$')[1]
-        if 'description' in entry:
-            desc = strip_html_tags(entry['description'])
-            entry['description'] = desc
+            entry['title'] = titles[i]
+        entry['price'] = prices[i]
+        if 'time' in entry or 'date' in entry:
+            entry['time'] = times[i]
+        if has_description and 'description' in entry:
+            entry['description'] = descriptions[i]
     return data
 
 
+def preprocess_file(in_path: Path, out_path: Path) -> int:
+    """
+    Normalize the records of a file, writing them to another file in the same format.
+    :param in_path: .json, .jsonl, .jsonl.gz or .jsonl.zst file
+    :param out_path: file to write
+    :return: number of records
+    """
+    data = preprocess(sinks.read_records(in_path))
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    if out_path.name.endswith('.json'):
+        with open(out_path, 'w') as f:
+            json.dump(data, f, indent=2)
+    else:
+        name, extension = out_path.name.split('.', 1)
+        writer = sinks.JsonLinesWriter(out_path.parent, name, extension, max_bytes=float('inf'))
+        for entry in data:
+            writer.write(entry)
+        writer.close()
+    return len(data)
+
+
+def preprocess_files(input_dir, out_dir=default_out_dir, workers: int = None) -> int:
+    """
+    Normalize every file of records under a directory, one file per process at a time.
+    :param input_dir: directory, searched at any depth, or a single file
+    :param out_dir: to write files to, at the same path relative to input_dir
+    :param workers: number of processes, by default one per CPU
+    :return: number of records
+    """
+    input_dir, out_dir = Path(input_dir), Path(out_dir)
+    files = find_files(input_dir)
+    root = input_dir if input_dir.is_dir() else input_dir.parent
+    out_paths = [out_dir.joinpath(fp.relative_to(root)) for fp in files]
+    if workers == 1 or len(files) < 2:
+        return sum(map(preprocess_file, files, out_paths))
+    with ProcessPoolExecutor(workers or os.cpu_count()) as pool:
+        return sum(pool.map(preprocess_file, files, out_paths))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("Process raw query responses.")
     parser.add_argument('--input_dir', '-i', required=True,
-                        help='Path to JSON files')
-    parser.add_argument('--out_dir', '-o', default='Data/Query_Processed')
+                        help='Directory of JSON or JSON Lines files, or a single file')
+    parser.add_argument('--out_dir', '-o', default=default_out_dir)
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                        help='Number of processes, by default one per CPU')
     args = parser.parse_args()
-    input_dir = pathlib.Path(args.input_dir)
-    out_dir = pathlib.Path(args.out_dir)
-    # folder or single file
-    if input_dir.is_dir():
-        files = input_dir.rglob("*.json")
-    else:
-        files = [input_dir]
-
-    for fpath in files:
-        # read data
-        with open(fpath, 'r') as f:
-            data = json.load(f)
-        # run preprocessing
-        data_ = preprocess(data)
-        # write result
-        out_fpath = out_dir.joinpath(fpath.name)
-        with open(out_fpath, 'w') as f:
-            json.dump(data_, f, indent=2)
+
+    count = preprocess_files(args.input_dir, args.out_dir, args.workers)
+    print(f"Processed {count} records to:\t {args.out_dir}")
@@ -0,0 +1,262 @@
+"""
+Resolve the states, cities and categories given by users to those of the config files.
+
+The config is read on first use, not on import, so processes that never look up a location, e.g.
+workers of `extract`'s process pool, do not read it. Indexes are then built once per process:
+- names without case or punctuation, e.g. "florence muscle shoals" or "Florence/Muscle-Shoals"
+- aliases: each part of a name ("muscle shoals"), the name without a state suffix ("columbus"
+  for "columbus, ga") and the subdomain of the city's site ("sfbay")
+- hostname -> (state, city), the reverse of the city map
+- categories without punctuation ("arts crafts" for "arts+crafts") and their abbreviations
+
+Exact names, as iterated from `cities`, are looked up first, in a single dict lookup. Names that
+match nothing exactly fall back to the closest name, for typos, with a warning since a typo may
+then name another place. A resolver that is not `fuzzy`, as for names typed on the command line,
+rejects them instead and lists the closest names.
+"""
+import difflib
+import json
+import logging
+import re
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+
+from src.utils import get_project_root
+
+# ========================================== CONSTANTS ===========================================
+# state -> city -> URL, and category name -> abbreviation
+default_location_path = get_project_root().joinpath('config/city_url_by_state.json')
+default_category_path = get_project_root().joinpath('config/category_abbreviations.json')
+
+# characters ignored when matching names
+non_alnum_pattern = re.compile(r'[^a-z0-9]+')
+
+# separators of the parts of a city name, e.g. "huntsville / decatur", "gadsden-anniston"
+part_pattern = re.compile(r'\s*[/-]\s*')
+
+# state suffix of a city listed under a neighbouring state, e.g. "memphis, tn"
+state_suffix_pattern = re.compile(r',\s*[a-z/]+$')
+
+# shortest alias, so e.g. "su" of "anchorage / mat-su" does not shadow other names
+min_alias_length = 3
+
+# similarity above which a misspelled name is taken for the closest one, see `difflib`
+fuzzy_cutoff = 0.85
+
+# number of close names listed when a name is rejected
+max_suggestions = 3
+
+# the resolver used by the scrapers
+_resolver = None
+
+
+# ========================================== HELPERS =============================================
+def normalize(name: str) -> str:
+    """ Name without case, spaces or punctuation, e.g. "st louis, mo" -> "stlouismo" """
+    return non_alnum_pattern.sub('', name.lower())
+
+
+def city_aliases(city: str, url: str) -> set:
+    """ Normalized names a city can also be found by, besides its own """
+    base = state_suffix_pattern.sub('', city)
+    names = {base, urlparse(url).netloc.split('.')[0]}
+    names.update(part_pattern.split(base))
+    return {alias for alias in map(normalize, names) if len(alias) >= min_alias_length}
+
+
+def close_matches(key: str, keys: dict) -> list:
+    """
+    Find the names closest to a misspelled one.
+    :param key: normalized name
+    :param keys: {normalized name or alias: name}
+    :return: [name], closest first, without duplicates
+    """
+    matches = difflib.get_close_matches(key, list(keys), n=max_suggestions * 2, cutoff=fuzzy_cutoff)
+    return list(dict.fromkeys(keys[m] for m in matches))[:max_suggestions]
+
+
+def suggest(names: list) -> str:
+    return ', did you mean: ' + ' or '.join(f"'{name}'" for name in names) if names else ''
+
+
+# ========================================== RESOLVER ============================================
+class Resolver:
+    def __init__(self, location_path=default_location_path,
+                 category_path=default_category_path, fuzzy: bool = True):
+        """
+        Locations and categories, loaded on first use.
+        :param location_path: JSON file of {state: {city: URL}}
+        :param category_path: JSON file of {category: abbreviation}
+        :param fuzzy: take a misspelled name for the closest one, logging a warning. Otherwise
+            it is rejected, listing the closest ones.
+        """
+        self.location_path = location_path
+        self.category_path = category_path
+        self.fuzzy = fuzzy
+        self._cities = None
+        self._categories = None
+        # {state: {normalized name or alias: city}}
+        self._city_keys = None
+        # {hostname: (state, city)}
+        self._hosts = None
+        # {normalized name or abbreviation: category}
+        self._category_keys = None
+
+    # Loading
+    @property
+    def cities(self) -> dict:
+        """ {state: {city: URL}}, as in the config file """
+        if self._cities is None:
+            with open(self.location_path, 'r') as f:
+                self._cities = json.load(f)
+        return self._cities
+
+    @property
+    def categories(self) -> dict:
+        """ {category: abbreviation}, as in the config file """
+        if self._categories is None:
+            with open(self.category_path, 'r') as f:
+                self._categories = json.load(f)
+        return self._categories
+
+    def _index_cities(self) -> None:
+        self._city_keys, self._hosts = {}, {}
+        for state, city_to_url in self.cities.items():
+            keys = self._city_keys[state] = {normalize(city): city for city in city_to_url}
+            aliases = {}
+            for city, url in city_to_url.items():
+                for alias in city_aliases(city, url):
+                    aliases.setdefault(alias, set()).add(city)
+                # A site listed under several states belongs to the one not naming another
+                # state, e.g. memphis.craigslist.org to "memphis" of TN, not "memphis, tn" of AR.
+                host = urlparse(url).netloc
+                home = self._hosts.get(host)
+                if home is None or (state_suffix_pattern.search(home[1])
+                                    and not state_suffix_pattern.search(city)):
+                    self._hosts[host] = (state, city)
+            # Aliases shared by several cities of a state are ambiguous, and names win over
+            # aliases.
+            for alias, matches in aliases.items():
+                if len(matches) == 1 and alias not in keys:
+                    keys[alias] = matches.pop()
+
+    def _index_categories(self) -> None:
+        keys = {abbr: category for category, abbr in self.categories.items()}
+        keys.update((normalize(category), category) for category in self.categories)
+        self._category_keys = keys
+
+    # Lookups
+    def states(self) -> list:
+        """ State abbreviations, in the order of the config file """
+        return list(self.cities)
+
+    def resolve_state(self, state: str) -> str:
+        """
+        :param state: State abbreviation, in any case
+        :return: the abbreviation of the config
+        :raises ValueError: if there is no such state
+        """
+        if state in self.cities:
+            return state
+        if state.upper() in self.cities:
+            return state.upper()
+        raise ValueError(f"Invalid state abbreviation: {state}")
+
+    def resolve_city(self, state: str, city: str) -> str:
+        """
+        Find a city by its name, an alias, or a misspelling of them.
+        :param state: State abbreviation.
+        :param city: City within above state, e.g. "Muscle Shoals"
+        :return: the name of the config, e.g. "florence / muscle shoals"
+        :raises ValueError: if no city matches, or only a misspelling does and the resolver is
+            not `fuzzy`
+        """
+        state = self.resolve_state(state)
+        if city in self.cities[state]:
+            return city
+        if self._city_keys is None:
+            self._index_cities()
+        keys = self._city_keys[state]
+        key = normalize(city)
+        if key in keys:
+            return keys[key]
+        matches = close_matches(key, keys)
+        if not matches or not self.fuzzy:
+            raise ValueError(f"City '{city}' not found in state '{state}'{suggest(matches)}")
+        logging.warning(f"Matched city '{city}' to: {matches[0]}, {state}")
+        return matches[0]
+
+    def city_url(self, state: str, city: str) -> str:
+        """ URL of the site of a city, e.g. https://lancaster.craigslist.org """
+        state = self.resolve_state(state)
+        url = self.cities[state].get(city)
+        if url is None:
+            url = self.cities[state][self.resolve_city(state, city)]
+        return url
+
+    def locate(self, url: str) -> Optional[Tuple[str, str]]:
+        """
+        Find the city of a Craigslist URL by its hostname, as `extract.get_city` does. A site
+        listed under several states is found in the state whose city name does not name another
+        state, or else in the first one listed.
+        :param url: e.g. https://lancaster.craigslist.org/mob/d/lancaster-iphone/7141767734.html
+        :return: ( state, city ), or None if the site is not in the config
+        """
+        if self._hosts is None:
+            self._index_cities()
+        return self._hosts.get(urlparse(url).netloc)
+
+    def resolve_category(self, category: str) -> str:
+        """
+        Find a category by its name, without punctuation, or its abbreviation.
+        :param category: e.g. "Cell-Phones", "arts & crafts" or "moa"
+        :return: the name of the config, e.g. "cell phones"
+        :raises ValueError: if no category matches, or only a misspelling does and the resolver
+            is not `fuzzy`
+        """
+        if category in self.categories:
+            return category
+        if self._category_keys is None:
+            self._index_categories()
+        key = normalize(category)
+        if key in self._category_keys:
+            return self._category_keys[key]
+        matches = close_matches(key, self._category_keys)
+        if not matches or not self.fuzzy:
+            raise ValueError(f"Invalid category: {category}{suggest(matches)}")
+        logging.warning(f"Matched category '{category}' to: {matches[0]}")
+        return matches[0]
+
+    def category_abbr(self, category: str) -> str:
+        """ Abbreviation of a category in search URLs, e.g. "moa" for "cell phones" """
+        abbr = self.categories.get(category)
+        if abbr is None:
+            abbr = self.categories[self.resolve_category(category)]
+        return abbr
+
+
+# ============================================ API ===============================================
+def get_resolver() -> Resolver:
+    """ Get the resolver used by the scrapers, created on first use """
+    global _resolver
+    if _resolver is None:
+        _resolver = Resolver()
+    return _resolver
+
+
+def iter_cities(states: list = None, cities: list = None):
+    """
+    List the cities to crawl or search.
+    :param states: State abbreviations. If not given, every state is listed.
+    :param cities: names of cities, if there is a single state. If not given, every city is
+        listed.
+    :return: iterator of (state, city, base URL)
+    """
+    resolver = get_resolver()
+    states = [resolver.resolve_state(s) for s in states] if states else resolver.states()
+    if cities and len(states) != 1:
+        raise ValueError("Cities can only be given for a single state")
+    for state in states:
+        for city in cities or resolver.cities[state]:
+            city = resolver.resolve_city(state, city)
+            yield state, city, resolver.city_url(state, city)
@@ -0,0 +1,232 @@
+"""
+Typed post attributes, and compact post records.
+
+Attributes are scraped as free-form {name: value} pairs, whose values are None for flags (e.g.
+"delivery available"), a string, or a list of strings if the value had colons. Records keep them
+as scraped. `Attributes` holds them, and normalizes them on demand:
+- known attributes become typed fields: condition, make, model, mobile_os and size, with
+  consistent values, e.g. make "apple" for "Apple" and "APPLE", mobile_os "ios" for "apple iOS"
+- flags become True, and other values a string with whitespace collapsed
+
+`Post` holds a post overview or detail record in `__slots__` instead of a dict, with its
+attributes as `Attributes`, and repeated strings (cities, attribute names and values) interned.
+A post is a read-only mapping with the same keys and values as the record it was made from, so it
+is used wherever records are read, and `dict(post)` is the record again.
+"""
+import sys
+from collections.abc import Mapping
+
+# ========================================== CONSTANTS ===========================================
+# scraped attribute name, lower-cased, or typed field name -> typed field name
+typed_attributes = {
+    'condition': 'condition',
+    'make / manufacturer': 'make',
+    'make': 'make',
+    'model name / number': 'model',
+    'model': 'model',
+    'mobile os': 'mobile_os',
+    'mobile_os': 'mobile_os',
+    'size / dimensions': 'size',
+    'size': 'size',
+}
+
+# typed fields, in the order they are listed by `Attributes.normalized`
+typed_fields = ('condition', 'make', 'model', 'mobile_os', 'size')
+
+# values of the condition field
+conditions = ('new', 'like new', 'excellent', 'good', 'fair', 'salvage')
+
+# mobile OS as scraped, lower-cased -> value of the mobile_os field
+mobile_os_values = {'apple ios': 'ios'}
+
+# fields of a post record, in the order they are written: those added by the detail step, see
+# `post_details.detail_fields`, then those of the overview
+post_fields = ('city', 'description', 'attributes', 'images', 'error', 'title', 'link', 'pid',
+               'pid_repost', 'price', 'time')
+
+
+# ========================================== HELPERS =============================================
+def collapse(value: str) -> str:
+    return ' '.join(value.split())
+
+
+def to_text(value) -> str:
+    """ Attribute value as a string, e.g. ["5", "30"] -> "5:30" """
+    if isinstance(value, list):
+        value = ':'.join(value)
+    return collapse(value)
+
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def normalize_value(field: str, value: str) -> str:
+    """ Value of a typed field, e.g. make "APPLE" -> "apple" """
+    if field == 'condition':
+        return intern(value.lower())
+    if field == 'make':
+        return intern(value.casefold())
+    if field == 'mobile_os':
+        value = value.lower()
+        return intern(mobile_os_values.get(value, value))
+    return value
+
+
+# ======================================== ATTRIBUTES ============================================
+def freeze(value):
+    """ Attribute value with its strings interned, and lists as tuples """
+    if isinstance(value, list):
+        return tuple(map(intern, value))
+    return intern(value)
+
+
+class Attributes:
+    __slots__ = ('items',)
+
+    def __init__(self, items: tuple = ()):
+        """
+        Attributes of a post, as scraped.
+        :param items: ( (name, value) ), value being None for flags, a string, or a tuple of
+            strings for values that had colons
+        """
+        self.items = items
+
+    @classmethod
+    def parse(cls, attributes: dict) -> 'Attributes':
+        """ :param attributes: {name: value}, as scraped by `get_attributes` """
+        return cls(tuple((intern(name), freeze(value)) for name, value in attributes.items()))
+
+    def to_dict(self) -> dict:
+        """ :return: {name: value}, as scraped """
+        return {name: list(value) if isinstance(value, tuple) else value
+                for name, value in self.items}
+
+    def normalized(self) -> dict:
+        """
+        :return: {field: value} of the typed fields a post has, then other attributes, flags
+            being True, e.g. {"condition": "like new", "make": "apple", "delivery available": True}
+        """
+        typed, other = {}, {}
+        for name, value in self.items:
+            field = typed_attributes.get(name.lower())
+            if isinstance(value, tuple):
+                value = list(value)
+            if field is not None and isinstance(value, (str, list)):
+                typed[field] = normalize_value(field, to_text(value))
+            elif value is None or value is True:
+                other[name] = True
+            else:
+                other[name] = to_text(value)
+        result = {field: typed[field] for field in typed_fields if field in typed}
+        result.update(other)
+        return result
+
+    # Typed fields, None if the post does not have them
+    @property
+    def condition(self) -> str:
+        """ one of `conditions`, e.g. "like new" """
+        return self.normalized().get('condition')
+
+    @property
+    def make(self) -> str:
+        """ lower-cased, e.g. "apple" """
+        return self.normalized().get('make')
+
+    @property
+    def model(self) -> str:
+        """ e.g. "iPhone 8" """
+        return self.normalized().get('model')
+
+    @property
+    def mobile_os(self) -> str:
+        """ lower-cased, e.g. "ios" or "android" """
+        return self.normalized().get('mobile_os')
+
+    @property
+    def size(self) -> str:
+        """ e.g. '5.7" IPS Touch Screen' """
+        return self.normalized().get('size')
+
+    def __eq__(self, other):
+        return isinstance(other, Attributes) and self.items == other.items
+
+    def __repr__(self):
+        return f'Attributes({self.to_dict()})'
+
+
+def normalize_attributes(attributes: dict) -> dict:
+    """ Normalize scraped attributes, see `Attributes.normalized` """
+    return Attributes.parse(attributes).normalized()
+
+
+# ========================================== RECORDS =============================================
+class Post(Mapping):
+    __slots__ = post_fields + ('extra',)
+
+    def __init__(self, record: dict):
+        """
+        Compact form of a post record. Fields the record does not have are left unset, so they
+        take no memory and are not keys of the post.
+        :param record: {title, link, pid, ...} post overview, or a post detail record
+        """
+        extra = None
+        for key, value in record.items():
+            if key == 'attributes' and isinstance(value, dict):
+                value = Attributes.parse(value)
+            elif key == 'images' and isinstance(value, list):
+                value = tuple(value)
+            elif key == 'city':
+                value = intern(value)
+            if key in post_field_set:
+                setattr(self, key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[intern(key)] = value
+        self.extra = extra
+
+    def __getitem__(self, key):
+        if key not in post_field_set:
+            if self.extra is None:
+                raise KeyError(key)
+            return self.extra[key]
+        try:
+            value = getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+        if isinstance(value, Attributes):
+            return value.to_dict()
+        if isinstance(value, tuple):
+            return list(value)
+        return value
+
+    def __iter__(self):
+        for field in post_fields:
+            if hasattr(self, field):
+                yield field
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'Post({dict(self)})'
+
+
+# fields stored in slots, the others being kept in `Post.extra`
+post_field_set = frozenset(post_fields)
+
+
+# ============================================ API ===============================================
+def compact(records: list) -> list:
+    """ Convert post records to `Post`, e.g. to keep many of them in memory """
+    return [r if isinstance(r, Post) else Post(r) for r in records]
+
+
+def to_json(value):
+    """ `default` of `json.dump` for records that may be `Post` """
+    if isinstance(value, Post):
+        return dict(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
@@ -1,109 +1,70 @@
 import argparse
+import asyncio
 import pathlib
 import json
-from typing import List
-from multiprocessing import Pool
-from urllib.parse import urlparse
-from bs4 import BeautifulSoup, NavigableString, Tag
-from src.utils import make_soup
+from src import extract, post_details
+from src.http_cache import fetch_sync
+# The soup extraction functions live in `extract`, and are re-exported here for compatibility.
+from src.extract import get_attributes, get_city, get_description, get_images  # noqa: F401
+from src.throttle import make_session
+from src.utils import run_bounded
 
+# default number of files scraped at the same time by `scrape_files`
+default_concurrency = 4
 
-def get_city(url):
-    """ Extract city information from URL """
-    o = urlparse(url)
-    city = o.netloc.split('.')[0]
-    return city
 
-
-def get_description(soup: BeautifulSoup) -> str:
+def get_post_details(url: str) -> dict:
     """
-    Extract description from a post.
-    :param soup: of post details page
-    :return: description text
+    Extract details from a craigslist post link. Blocking version of
+    `post_details.get_post_details`.
+    :param url: Link to a post
+    :return: {city, description, attributes, images}
     """
-    children = soup.body.section.section.section.section.children
-    strings = [c for c in children if isinstance(c, NavigableString)]
-    desc = ''.join(strings)
-    return desc
+    return extract.parse_post_page(fetch_sync(url), url)
 
 
-def get_attributes(soup: BeautifulSoup) -> dict:
+async def scrape_all_posts_async(data, session=None) -> list:
     """
-    Extract attributes from a post.
-    :param soup: of post details page
-    :return: {condition, make/manufacturer, mobileOS, ...}
+    Get the details of every post, downloading them concurrently. See `src/post_details.py`.
+    :param data: [{link, ...}] post overviews
+    :param session: HTTP session to use. If not given, one is created for this call.
+    :return: [{city, description, ...}], in the order of data. Posts that failed have an error.
     """
-    attributes = soup.find_all('p', 'attrgroup')
-    if not attributes:
-        return {}
-    attributes = attributes[0]
-    # extract field,value pairs
-    field_value = {}
-    for attr in attributes:
-        if isinstance(attr, Tag):
-            text = attr.get_text(strip=True)
-            if len(text) == 0:
-                continue
-            parts = text.split(':')
-            if len(parts) == 0:
-                continue
-            if len(parts) == 1:
-                field, value = parts[0], None
-            elif len(parts) == 2:
-                field, value = parts
-            else:
-                field, value = parts[0], parts[1:]
-            field_value[field] = value
-    return field_value
+    post_links = [d['link'] for d in data]
+    return await post_details.get_all_post_details(post_links, session)
 
 
-def get_images(soup: BeautifulSoup) -> List[str]:
-    """
-    Extract image URLs from a post.
-    :param soup: of post details page
-    :return: [url] if 1 or more images found, otherwise []
-    """
-    # Grab list of images. Only works with posts which have a scrollable
-    # gallery (e.g. 2 or more images)
-    images = soup.find_all('a', {'data-imgid': True})
-    image_urls = [e['href'] for e in images]
-    # If there is no scrollable gallery, there may still be a single image.
-    if not image_urls:
-        first_visible = soup.find('div', {'class': 'slide first visible'})
-        if first_visible:
-            main_image = first_visible.find('img')
-            if main_image:
-                url = main_image.get('src')
-                if url:
-                    image_urls.append(url)
-    return image_urls
+def scrape_all_posts(data):
+    return asyncio.run(scrape_all_posts_async(data))
 
 
-def get_post_details(url: str) -> dict:
+async def scrape_files(files, out_dir: pathlib.Path,
+                       concurrency: int = default_concurrency) -> None:
     """
-    Extract details from a craigslist post link.
-    :param url: Link to a post
-    :return: {title, price, ...}
+    Scrape the posts of every overview file, and write them merged with their details.
+    Files are fed through a bounded queue to a fixed number of workers, so only the files being
+    scraped are in memory, however many there are.
+    :param files: paths to JSON files of post overviews, e.g. an iterator over a directory tree
+    :param out_dir: to write a file of the same name to, for each input file
+    :param concurrency: number of files to scrape at the same time
     """
-    city = get_city(url)
-    soup = make_soup(url)
-    desc = get_description(soup)
-    attributes = get_attributes(soup)
-    images = get_images(soup)
-    pd = {
-        'city': city,
-        'description': desc,
-        'attributes': attributes,
-        'images': images
-    }
-    return pd
-
+    async def scrape_file(fpath, session):
+        # read data
+        with open(fpath, 'r') as f:
+            data = json.load(f)
+        # run scraping
+        data_ = await scrape_all_posts_async(data, session)
+        # join results
+        data_result = join_data(data, data_)
+        # write result
+        out_fpath = out_dir.joinpath(fpath.name)
+        with open(out_fpath, 'w') as f:
+            json.dump(data_result, f, indent=2)
 
-def scrape_all_posts(data):
-    post_links = [d['link'] for d in data]
-    with Pool() as p:
-        all_post_data = p.map(get_post_details, post_links)
-    return all_post_data
+    # Files share one connection pool.
+    async with make_session() as session:
+        await run_bounded(files, lambda fpath: scrape_file(fpath, session), concurrency,
+                          lambda fpath: f"file: {fpath}")
 
 
 def join_data(dicts1, dicts2):
@@ -118,6 +79,12 @@ if __name__ == '__main__':
     parser.add_argument('--input_dir', '-i', required=True,
                         help='Path to JSON files containing metadata about post')
     parser.add_argument('--out_dir', '-o', default='Data/Posting_Response')
+    parser.add_argument('--engine', choices=extract.engines, default=extract.default_engine,
+                        help='HTML extraction engine. lxml is several times faster than soup.')
+    parser.add_argument('--concurrency', type=int, default=default_concurrency,
+                        help='Number of input files to scrape at the same time')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='Number of processes to parse pages in, 0 to parse on the event loop')
     args = parser.parse_args()
     input_dir = pathlib.Path(args.input_dir)
     out_dir = pathlib.Path(args.out_dir)
@@ -127,15 +94,10 @@ if __name__ == '__main__':
     else:
         files = [input_dir]
 
-    for fpath in files:
-        # read data
-        with open(fpath, 'r') as f:
-            data = json.load(f)
-        # run scraping
-        data_ = scrape_all_posts(data)
-        # join results
-        data_result = join_data(data, data_)
-        # write result
-        out_fpath = out_dir.joinpath(fpath.name)
-        with open(out_fpath, 'w') as f:
-            json.dump(data_result, f, indent=2)
+    extract.set_engine(args.engine)
+    if args.parse_workers:
+        extract.start_process_pool(args.parse_workers)
+    try:
+        asyncio.run(scrape_files(files, out_dir, args.concurrency))
+    finally:
+        extract.stop_process_pool()
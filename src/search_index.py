@@ -0,0 +1,364 @@
+"""
+Full-text search index over the posts scraped to `data/category`.
+
+Posts are kept in a SQLite database with an FTS5 index over their title, description and
+normalized attributes (see `src/schema.py`), and b-tree indexes over location, price and time, so
+a question like "iPhone 11 posts under $400 in NV" is answered from the index instead of reading
+every detail file:
+    python -m src.search_index update
+    python -m src.search_index query 'iphone 11' --state NV --max-price 400
+
+The state, city and category of each post are indexed as words too, so a text query within a
+city only visits the matches of that city. Results are newest first by default: pids grow with
+posting time, so FTS5 yields matches in that order and the query stops at the limit, however
+common the words are. Sorting by relevance or price visits every match instead.
+
+The index is updated incrementally: every detail file indexed is recorded with its modification
+time, and `update` only reads files that are new or changed since. With `category_scrape
+--index`, each JSON detail file is indexed as soon as `write_results` writes it, and files of
+other formats when the run ends. A post found in several files keeps the values of the file
+indexed last, i.e. the newest.
+"""
+import argparse
+import json
+import re
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional
+
+from src import schema, sinks
+from src.resolver import get_resolver, normalize
+from src.utils import get_project_root, to_valid_filename
+
+# ========================================== CONSTANTS ===========================================
+# default index database
+default_index_path = get_project_root().joinpath('data/search_index.db')
+
+# directory of the indexed detail files
+in_dir = get_project_root().joinpath('data/category')
+
+# default number of results of a query
+default_limit = 50
+
+# orders of query results: newest first, by relevance to the query text, or cheapest first
+sort_orders = ('newest', 'rank', 'price')
+
+# words of a query, and a trailing * for prefix matches, e.g. "iphone" "11" "pro*"
+query_word_pattern = re.compile(r'(\w+)(\*?)')
+
+# the index `category_scrape` writes to, None if it does not index
+_index = None
+
+schema_sql = '''
+CREATE TABLE IF NOT EXISTS posts (
+    pid INTEGER PRIMARY KEY,
+    category TEXT NOT NULL,
+    state TEXT NOT NULL,
+    city TEXT NOT NULL,
+    title TEXT,
+    description TEXT,
+    attributes TEXT,
+    place TEXT,
+    price INTEGER,
+    time TEXT,
+    link TEXT
+);
+CREATE INDEX IF NOT EXISTS posts_location ON posts (state, city, time);
+CREATE INDEX IF NOT EXISTS posts_price ON posts (price);
+CREATE INDEX IF NOT EXISTS posts_time ON posts (time);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+    title, description, attributes, place, content='posts', content_rowid='pid',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+    INSERT INTO posts_fts (rowid, title, description, attributes, place)
+    VALUES (new.pid, new.title, new.description, new.attributes, new.place);
+END;
+CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+    INSERT INTO posts_fts (posts_fts, rowid, title, description, attributes, place)
+    VALUES ('delete', old.pid, old.title, old.description, old.attributes, old.place);
+END;
+CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE ON posts BEGIN
+    INSERT INTO posts_fts (posts_fts, rowid, title, description, attributes, place)
+    VALUES ('delete', old.pid, old.title, old.description, old.attributes, old.place);
+    INSERT INTO posts_fts (rowid, title, description, attributes, place)
+    VALUES (new.pid, new.title, new.description, new.attributes, new.place);
+END;
+
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    posts INTEGER NOT NULL
+);
+'''
+
+columns = ('pid', 'category', 'state', 'city', 'title', 'description', 'attributes', 'place',
+           'price', 'time', 'link')
+
+upsert_post = (f"INSERT INTO posts ({', '.join(columns)}) "
+               f"VALUES ({', '.join('?' * len(columns))}) ON CONFLICT (pid) DO UPDATE SET "
+               f"{', '.join(f'{c} = excluded.{c}' for c in columns[1:])}")
+
+# columns of query results
+result_columns = ('pid', 'category', 'state', 'city', 'title', 'price', 'time', 'link')
+
+# FTS5 columns searched by the text of a query
+text_columns = '{title description attributes}'
+
+
+# ========================================== HELPERS =============================================
+def attribute_text(attributes: Optional[dict]) -> str:
+    """ Text indexed for the attributes of a post, e.g. "condition like new make apple" """
+    words = []
+    for name, value in schema.normalize_attributes(attributes or {}).items():
+        words.append(name.replace('_', ' '))
+        if value is not True:
+            words.append(value)
+    return ' '.join(words)
+
+
+def place_words(state: str = None, city: str = None, category: str = None) -> list:
+    """
+    Words indexed for the location and category of a post, each a single token so that e.g.
+    city "columbus" does not match "columbus-ga".
+    :param state: State abbreviation.
+    :param city: directory name of a city within above state, e.g. "las-vegas"
+    :param category: directory name of a category, e.g. "cell-phones"
+    :return: e.g. ['statenv', 'citynvlasvegas', 'categorycellphones']
+    """
+    words = []
+    if state:
+        words.append(f'state{normalize(state)}')
+    if city:
+        words.append(f'city{normalize(state)}{normalize(city)}')
+    if category:
+        words.append(f'category{normalize(category)}')
+    return words
+
+
+def to_row(post: dict, category: str, state: str, city: str) -> tuple:
+    price = post.get('price')
+    return (int(post['pid']), category, state, city, post.get('title'), post.get('description'),
+            attribute_text(post.get('attributes')), ' '.join(place_words(state, city, category)),
+            int(price) if isinstance(price, (int, float)) else None, post.get('time'),
+            post.get('link'))
+
+
+def match_query(text: str) -> str:
+    """
+    FTS5 query matching posts that have every word of a text, in any order.
+    :param text: e.g. "iPhone 11, pro*", a trailing * matching any word starting with the rest
+    :return: e.g. '"iPhone" "11" "pro"*'
+    """
+    words = [f'"{word}"{star}' for word, star in query_word_pattern.findall(text)]
+    if not words:
+        raise ValueError(f"No words to search in: {text!r}")
+    return ' '.join(words)
+
+
+# ========================================== INDEX ===============================================
+class SearchIndex:
+    def __init__(self, path=default_index_path, root=in_dir):
+        """
+        :param path: database file, created if missing
+        :param root: directory of the indexed files, laid out as <category>/<state>/<city>/<file>
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.root = Path(root)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.executescript(schema_sql)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def index_file(self, fp, force: bool = False) -> int:
+        """
+        Index the posts of a detail file, unless it was indexed since it last changed.
+        :param fp: detail file under root, as written by `category_scrape`
+        :param force: index the file even if it did not change
+        :return: number of posts indexed
+        """
+        fp = Path(fp)
+        key = str(fp.relative_to(self.root))
+        mtime = fp.stat().st_mtime
+        if not force:
+            row = self.conn.execute('SELECT mtime FROM files WHERE path = ?', (key,)).fetchone()
+            if row is not None and row['mtime'] == mtime:
+                return 0
+        city_dir = fp.parent
+        category, state, city = city_dir.parent.parent.name, city_dir.parent.name, city_dir.name
+        rows = [to_row(post, category, state, city) for post in sinks.read_records(fp)]
+        with self.conn:
+            self.conn.executemany(upsert_post, rows)
+            self.conn.execute('INSERT OR REPLACE INTO files (path, mtime, posts) VALUES (?, ?, ?)',
+                              (key, mtime, len(rows)))
+        return len(rows)
+
+    def update(self) -> int:
+        """
+        Index every detail file under root that is new or changed, oldest first.
+        :return: number of posts indexed
+        """
+        # imported here, as it imports pyarrow if installed
+        from src.export_parquet import find_detail_files
+        files = [fp for fp, *_ in find_detail_files(self.root)]
+        files.sort(key=lambda fp: fp.stat().st_mtime)
+        return sum(self.index_file(fp) for fp in files)
+
+    def search(self, text: str = None, state: str = None, cities: list = None,
+               category: str = None, min_price: int = None, max_price: int = None,
+               since: str = None, until: str = None, sort: str = 'newest',
+               limit: int = default_limit) -> list:
+        """
+        Find posts. Every given condition must hold.
+        :param text: words the title, description or attributes must all have, see `match_query`
+        :param state: State abbreviation.
+        :param cities: names of cities within above state
+        :param category: a 'for sale' category, e.g. 'cell phones'
+        :param min_price: lowest price, inclusive
+        :param max_price: highest price, inclusive
+        :param since: earliest post time, e.g. "2020-06-14" or "2020-06-14 14:00"
+        :param until: latest post time, exclusive
+        :param sort: one of `sort_orders`
+        :param limit: max number of posts
+        :return: [{pid, category, state, city, title, price, time, link}]
+        """
+        if sort not in sort_orders:
+            raise ValueError(f"Invalid sort order: {sort}, expected one of {sort_orders}")
+        if sort == 'rank' and not text:
+            raise ValueError("Results can only be sorted by rank for a text query")
+        if cities and not state:
+            raise ValueError("Cities can only be given for a single state")
+        # Names are matched loosely, and stored as the directory names of the config's names.
+        resolver = get_resolver()
+        if state:
+            state = to_valid_filename(resolver.resolve_state(state))
+        cities = [to_valid_filename(resolver.resolve_city(state, c)) for c in cities or []]
+        if category:
+            category = to_valid_filename(resolver.resolve_category(category))
+
+        clauses, params = [], []
+        if state:
+            clauses.append('posts.state = ?')
+            params.append(state)
+        if cities:
+            clauses.append(f"posts.city IN ({', '.join('?' * len(cities))})")
+            params.extend(cities)
+        if category:
+            clauses.append('posts.category = ?')
+            params.append(category)
+        for sql, value in (('posts.price >= ?', min_price), ('posts.price <= ?', max_price),
+                           ('posts.time >= ?', since), ('posts.time < ?', until)):
+            if value is not None:
+                clauses.append(sql)
+                params.append(value)
+        if text:
+            # Location and category are matched in the full-text index too, so that FTS5 only
+            # yields the matches within them.
+            query = f'{text_columns} : ({match_query(text)})'
+            places = [place_words(state, city)[-1] for city in cities] or place_words(state)
+            if places:
+                query += f" AND place : ({' OR '.join(places)})"
+            if category:
+                query += f' AND place : {place_words(category=category)[0]}'
+            table = 'posts_fts JOIN posts ON posts.pid = posts_fts.rowid'
+            clauses.insert(0, 'posts_fts MATCH ?')
+            params.insert(0, query)
+            order = {'newest': 'posts_fts.rowid DESC', 'rank': 'posts_fts.rank'}.get(sort)
+        else:
+            table = 'posts'
+            order = 'posts.pid DESC' if sort == 'newest' else None
+        order = order or 'posts.price IS NULL, posts.price'
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        rows = self.conn.execute(
+            f"SELECT {', '.join(f'posts.{c}' for c in result_columns)} FROM {table} {where} "
+            f"ORDER BY {order} LIMIT ?", params + [limit])
+        return [dict(row) for row in rows]
+
+    def stats(self) -> dict:
+        """ :return: {files, posts} indexed """
+        count = lambda table: self.conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        return {'files': count('files'), 'posts': count('posts')}
+
+
+# ============================================ API ===============================================
+def enable_index(path=default_index_path, root=in_dir) -> SearchIndex:
+    """ Index the detail files written by `category_scrape` """
+    global _index
+    disable_index()
+    _index = SearchIndex(path, root)
+    return _index
+
+
+def get_index() -> Optional[SearchIndex]:
+    """ Get the index used by `category_scrape`, None if it does not index """
+    return _index
+
+
+def disable_index() -> None:
+    global _index
+    if _index is not None:
+        _index.close()
+        _index = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Full-text search over scraped posts")
+    parser.add_argument('--db', default=default_index_path, help='Index database')
+    parser.add_argument('--input_dir', '-i', default=in_dir,
+        help='Directory laid out as <category>/<state>/<city>/<file>')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('update', help='Index the detail files that are new or changed')
+
+    query = commands.add_parser('query', help='Find posts')
+    query.add_argument('text', nargs='?',
+        help="Words every post must have, e.g. 'iphone 11'. A trailing * matches prefixes.")
+    query.add_argument('--state', help='State abbreviation')
+    query.add_argument('--city', nargs='+', help='City names within given state')
+    query.add_argument('--category', help="A 'for sale' category, e.g. 'cell phones'")
+    query.add_argument('--min-price', type=int)
+    query.add_argument('--max-price', type=int)
+    query.add_argument('--since', help='Earliest post time, e.g. 2020-06-14 or "2020-06-14 14:00"')
+    query.add_argument('--until', help='Latest post time, exclusive')
+    query.add_argument('--sort', choices=sort_orders, default='newest',
+        help='Order of results. rank and price visit every match, so they are slower for common'
+             ' words. (default: %(default)s)')
+    query.add_argument('--limit', '-n', type=int, default=default_limit)
+    query.add_argument('--json', action='store_true', help='Print results as JSON Lines')
+    args = parser.parse_args()
+    # Misspelled names are rejected rather than corrected, since a typo could name another city.
+    get_resolver().fuzzy = False
+
+    index = SearchIndex(args.db, args.input_dir)
+    try:
+        if args.command == 'update':
+            t = time.perf_counter()
+            count = index.update()
+            print(f"Indexed {count} posts in {time.perf_counter() - t:.1f}s, "
+                  f"{index.stats()['posts']} in total:\t {args.db}")
+        else:
+            t = time.perf_counter()
+            try:
+                results = index.search(args.text, args.state, args.city, args.category,
+                                       args.min_price, args.max_price, args.since, args.until,
+                                       args.sort, args.limit)
+            except ValueError as e:
+                parser.error(str(e))
+            elapsed = time.perf_counter() - t
+            for r in results:
+                if args.json:
+                    print(json.dumps(r))
+                else:
+                    price = '' if r['price'] is None else f"${r['price']}"
+                    print(f"{price:>7}  {r['time'] or '':16}  {r['state']}/{r['city']:16}  "
+                          f"{r['title']}  {r['link']}")
+            print(f"{len(results)} posts in {elapsed * 1000:.1f}ms")
+    finally:
+        index.close()
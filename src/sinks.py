@@ -0,0 +1,220 @@
+"""
+Streaming output for scraped posts.
+
+Instead of collecting every post of a city and dumping it with `json.dump(..., indent=2)`, a sink
+writes each post as soon as it is scraped. `JsonLinesSink` appends one JSON object per line,
+optionally compressed, to files that are written as `<name>.part` and renamed to their final name
+once complete (on rotation or close). Each record is flushed as it is written, so a crash loses
+only the posts still in flight, and `recover_parts` finalizes the files left behind.
+"""
+import gzip
+import io
+import json
+import os
+from pathlib import Path
+from typing import Iterator
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ========================================== CONSTANTS ===========================================
+# formats written by `JsonLinesSink`, i.e. extension of the written files
+formats = ('jsonl', 'jsonl.gz', 'jsonl.zst')
+
+# size after which a file is closed and a new one started
+default_max_bytes = 256 * 1024 ** 2
+
+# suffix of files still being written
+part_suffix = '.part'
+
+# raised when reading a compressed file cut short by a crash
+truncated_errors = (EOFError,) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+# ========================================== HELPERS =============================================
+def open_compressed(fp, mode: str):
+    """
+    Open a file, compressing or decompressing according to its extension.
+    :param fp: path ending in .gz, .zst or anything else for no compression
+    :param mode: 'rb', 'ab' or 'wb'
+    :return: binary file object
+    """
+    name = str(fp).replace(part_suffix, '')
+    if name.endswith('.gz'):
+        return gzip.open(fp, mode)
+    if name.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("zstandard is required for .zst files: pip install zstandard")
+        return zstandard.open(fp, mode)
+    return open(fp, mode)
+
+
+def read_json_lines(fp) -> Iterator[dict]:
+    """
+    Read records written by `JsonLinesWriter`. A truncated last record, left by a crash, is
+    skipped.
+    :param fp: path to a .jsonl, .jsonl.gz or .jsonl.zst file
+    :return: iterator of records
+    """
+    with open_compressed(fp, 'rb') as f:
+        lines = io.TextIOWrapper(f, encoding='utf-8')
+        try:
+            for line in lines:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+        except truncated_errors:
+            return
+
+
+def read_records(fp) -> list:
+    """
+    Read the posts of an output file, in either the indented JSON or the JSON Lines format.
+    :param fp: path to a .json, .jsonl, .jsonl.gz or .jsonl.zst file
+    :return: [post]
+    """
+    if str(fp).endswith('.json'):
+        with open(fp, 'r') as f:
+            return json.load(f)
+    return list(read_json_lines(fp))
+
+
+def recover_parts(directory) -> list:
+    """
+    Finalize JSON Lines files left as `.part` by a crashed run, keeping every complete record in
+    them. Other `.part` files, e.g. indented JSON cut short, are left alone.
+    :param directory: to look for `.part` files in
+    :return: [path] of recovered files
+    """
+    recovered = []
+    for fp in Path(directory).glob(f'*{part_suffix}'):
+        final = fp.with_name(fp.name[:-len(part_suffix)])
+        if not final.name.endswith(formats):
+            continue
+        os.replace(fp, final)
+        recovered.append(final)
+    return recovered
+
+
+# ========================================== WRITERS =============================================
+class JsonLinesWriter:
+    def __init__(self, directory, name: str, extension: str = 'jsonl',
+                 max_bytes: int = default_max_bytes):
+        """
+        Append records to `<directory>/<name>.<extension>`, rotating to `<name>_1.<extension>`,
+        `<name>_2.<extension>`, ... once a file grows past `max_bytes`.
+        :param directory: to write files in
+        :param name: file name without extension
+        :param extension: one of `formats`
+        :param max_bytes: uncompressed size after which a new file is started
+        """
+        if extension not in formats:
+            raise ValueError(f"Invalid format: {extension}, expected one of {formats}")
+        self.directory = Path(directory)
+        self.name = name
+        self.extension = extension
+        self.max_bytes = max_bytes
+        self.paths = []
+        self._file = None
+        self._part = None
+        self._size = 0
+
+    def _open(self) -> None:
+        index = len(self.paths)
+        name = self.name if index == 0 else f'{self.name}_{index}'
+        path = self.directory.joinpath(f'{name}.{self.extension}')
+        self._part = path.with_name(path.name + part_suffix)
+        self._file = open_compressed(self._part, 'wb')
+        self._size = 0
+        self.paths.append(path)
+
+    def _finish(self) -> None:
+        self._file.close()
+        os.replace(self._part, self.paths[-1])
+        self._file = None
+
+    def write(self, record: dict) -> None:
+        """ Append a record, flushing it to disk """
+        if self._file is None:
+            self._open()
+        line = json.dumps(record).encode('utf-8') + b'\n'
+        self._file.write(line)
+        self._file.flush()
+        self._size += len(line)
+        if self._size >= self.max_bytes:
+            self._finish()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._finish()
+
+    def abandon(self) -> None:
+        """ Close without finalizing, leaving the file being written as `.part` """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self) -> None:
+        """ Close and delete every file written, finished or not """
+        self.abandon()
+        for path in self.paths:
+            for fp in (path, path.with_name(path.name + part_suffix)):
+                if fp.exists():
+                    fp.unlink()
+        self.paths = []
+
+
+class JsonLinesSink:
+    def __init__(self, directory, timestamp: str, extension: str = 'jsonl',
+                 max_bytes: int = default_max_bytes, recover: bool = True):
+        """
+        Write the posts of one city to `<timestamp>_OVERVIEW.<extension>` and
+        `<timestamp>_DETAIL.<extension>` in the given directory. Used as a context manager, the
+        files are only finalized if the block succeeds, and are left as `.part` otherwise, like
+        those of a crash.
+        :param directory: to write files in
+        :param timestamp: prefix of file names
+        :param extension: one of `formats`
+        :param max_bytes: uncompressed size after which a new file is started
+        :param recover: finalize the `.part` files left in directory by a crash. Only safe if
+            no other sink is writing to the same directory.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        if recover:
+            recover_parts(directory)
+        self.overviews = JsonLinesWriter(directory, f'{timestamp}_OVERVIEW', extension, max_bytes)
+        self.details = JsonLinesWriter(directory, f'{timestamp}_DETAIL', extension, max_bytes)
+
+    def write_overviews(self, post_overviews: list) -> None:
+        for post in post_overviews:
+            self.overviews.write(post)
+
+    def write_details(self, post_detail: dict) -> None:
+        self.details.write(post_detail)
+
+    def close(self) -> None:
+        self.overviews.close()
+        self.details.close()
+
+    def abandon(self) -> None:
+        """ Close, leaving the files being written as `.part`, see `JsonLinesWriter.abandon` """
+        self.overviews.abandon()
+        self.details.abandon()
+
+    def discard(self) -> None:
+        """ Close and delete every file written, see `JsonLinesWriter.discard` """
+        self.overviews.discard()
+        self.details.discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abandon()
@@ -0,0 +1,238 @@
+"""
+Retry, backoff and per-host rate control for HTTP requests.
+
+Failed requests (connection errors, timeouts, 429 and 5xx responses) are retried with jittered
+exponential backoff, waiting at least as long as the server's Retry-After header asks. Each host
+gets an adaptive rate limit: the allowed request rate grows slowly while responses are healthy,
+and is cut in half whenever the host throttles us (additive increase, multiplicative decrease).
+Requests of a run share one session, see `make_session`, whose connection pool is bounded too.
+"""
+import asyncio
+import email.utils
+import random
+import time
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+
+import aiohttp
+import requests
+
+from src import metrics
+
+# ========================================== CONSTANTS ===========================================
+# number of times a request is retried before giving up
+max_retries = 4
+
+# backoff before retry number `n` is random between 0 and min(backoff_max, backoff_base * 2**n)
+backoff_base = 0.5
+backoff_max = 30.0
+
+# responses that are retried
+retry_statuses = {429, 500, 502, 503, 504}
+
+# responses that mean the host is throttling us
+throttle_statuses = {429, 503}
+
+# errors that are retried
+retry_errors = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+# requests per second allowed to a single host
+initial_rate = 20.0
+min_rate = 0.5
+max_rate = 200.0
+
+# requests per second added to a host's rate, per second of healthy responses
+rate_increase = 5.0
+
+# seconds after cutting a host's rate during which further throttled responses do not cut it
+# again, since requests already in flight when the host started throttling will fail too
+decrease_cooldown = 1.0
+
+# connection pool shared by every request in a run
+default_connection_limit = 100  # open sockets across all hosts
+default_limit_per_host = 8      # open sockets to a single craigslist site
+dns_cache_ttl = 300             # seconds to cache DNS lookups
+keepalive_timeout = 30          # seconds to keep an idle connection open for reuse
+
+# {host: HostThrottle}
+_throttles = {}
+
+
+# ========================================== HELPERS =============================================
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header.
+    :param value: number of seconds, or an HTTP date
+    :return: seconds to wait, or None if not given or invalid
+    """
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def backoff_delay(attempt: int, retry_after: float = None) -> float:
+    """
+    Seconds to wait before retrying.
+    :param attempt: number of the retry, starting at 0
+    :param retry_after: seconds the server asked us to wait, if any
+    :return: delay
+    """
+    delay = random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class HostThrottle:
+    """ Adaptive rate limit for requests to a single host """
+    def __init__(self, rate: float = initial_rate):
+        self.rate = rate
+        # earliest time the next request may start
+        self._next = 0.0
+        # waiting requests queue up here, so rate changes apply to all of them immediately. A lock
+        # belongs to the event loop it is first used in, and throttles outlive loops (each
+        # `asyncio.run` has its own), so the lock is made on first use in each loop.
+        self._lock = None
+        self._loop = None
+        # last time the rate was cut
+        self._decreased_at = float('-inf')
+
+    async def acquire(self) -> None:
+        """ Wait until the next request to this host may start """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._lock, self._loop = asyncio.Lock(), loop
+        async with self._lock:
+            delay = self._next - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next = time.monotonic() + 1 / self.rate
+
+    def on_success(self) -> None:
+        """ Speed up by `rate_increase` requests per second, every second """
+        self.rate = min(max_rate, self.rate + rate_increase / self.rate)
+
+    def on_throttle(self, retry_after: float = None) -> None:
+        """ Halve the rate, and pause all requests for `retry_after` seconds if given """
+        now = time.monotonic()
+        if now - self._decreased_at >= decrease_cooldown:
+            self.rate = max(min_rate, self.rate / 2)
+            self._decreased_at = now
+        if retry_after:
+            self._next = max(self._next, now + retry_after)
+
+
+def get_throttle(url: str) -> HostThrottle:
+    """ Get the rate limit for the host of a URL """
+    host = urlparse(url).netloc
+    throttle = _throttles.get(host)
+    if throttle is None:
+        throttle = _throttles[host] = HostThrottle()
+    return throttle
+
+
+# ============================================ API ===============================================
+def make_session(limit: int = default_connection_limit,
+                 limit_per_host: int = default_limit_per_host) -> aiohttp.ClientSession:
+    """
+    Create the HTTP session shared by every request in a run. Requests beyond the connection
+    limits wait for a free connection instead of opening new sockets, and idle connections are
+    kept alive so later requests to the same host skip the TCP/TLS handshake.
+    :param limit: max number of open connections across all hosts, 0 for no limit
+    :param limit_per_host: max number of open connections to a single host, 0 for no limit
+    :return: session, to be used as an async context manager
+    """
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host,
+                                     ttl_dns_cache=dns_cache_ttl,
+                                     keepalive_timeout=keepalive_timeout)
+    return aiohttp.ClientSession(connector=connector, trace_configs=metrics.trace_configs())
+
+
+def set_rate(host: str, rate: float) -> HostThrottle:
+    """
+    Set the request rate of a host, e.g. to start a known burst of requests at `max_rate`. The
+    rate keeps adapting to the responses of the host afterwards.
+    :param host: e.g. reno.craigslist.org, as in `urlparse(url).netloc`
+    :param rate: requests per second, between `min_rate` and `max_rate`
+    :return: the rate limit of the host
+    """
+    if not min_rate <= rate <= max_rate:
+        raise ValueError(f"Rate must be between {min_rate} and {max_rate}, got: {rate}")
+    throttle = _throttles.setdefault(host, HostThrottle(rate))
+    throttle.rate = rate
+    return throttle
+
+
+async def get(url: str, session: aiohttp.ClientSession, headers: dict = None,
+              allow_redirects: bool = True) -> Tuple[int, dict, bytes]:
+    """
+    GET a URL, retrying failures and respecting the host's rate limit.
+    :raises aiohttp.ClientResponseError if the last attempt has a 4xx/5xx status
+    :raises aiohttp.ClientError, asyncio.TimeoutError if the last attempt fails to connect
+    :param url: to download
+    :param session: HTTP session to use
+    :param headers: request headers
+    :param allow_redirects: follow redirects. If False, a redirect is returned as is, with its
+        Location header.
+    :return: (status, response headers, body)
+    """
+    throttle = get_throttle(url)
+    for attempt in range(max_retries + 1):
+        with metrics.timer('throttle_wait_seconds'):
+            await throttle.acquire()
+        try:
+            with metrics.timer('http_request_seconds'):
+                async with session.get(url, headers=headers,
+                                       allow_redirects=allow_redirects) as response:
+                    body = await response.read()
+        except retry_errors as e:
+            metrics.inc('http_errors_total', error=type(e).__name__)
+            if attempt == max_retries:
+                raise
+            metrics.inc('http_retries_total', reason=type(e).__name__)
+            await asyncio.sleep(backoff_delay(attempt))
+            continue
+        metrics.inc('http_requests_total', status=response.status)
+        metrics.inc('http_response_bytes_total', len(body))
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if response.status in throttle_statuses:
+            throttle.on_throttle(retry_after)
+        else:
+            throttle.on_success()
+        if response.status in retry_statuses and attempt < max_retries:
+            metrics.inc('http_retries_total', reason=response.status)
+            await asyncio.sleep(backoff_delay(attempt, retry_after))
+            continue
+        response.raise_for_status()
+        return response.status, response.headers, body
+
+
+def get_sync(url: str, headers: dict = None) -> requests.Response:
+    """
+    Blocking version of `get`, without the adaptive rate limit.
+    :raises requests.HTTPError if the last attempt has a 4xx/5xx status
+    :raises requests.ConnectionError, requests.Timeout if the last attempt fails to connect
+    :param url: to download
+    :param headers: request headers
+    :return: response
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            response = requests.get(url, headers=headers)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff_delay(attempt))
+            continue
+        if response.status_code in retry_statuses and attempt < max_retries:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            time.sleep(backoff_delay(attempt, retry_after))
+            continue
+        response.raise_for_status()
+        return response
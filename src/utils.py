@@ -1,9 +1,13 @@
+import asyncio
+import logging
 import re
 import unicodedata
 import datetime
-import requests
+from typing import Awaitable, Callable, Iterable, Tuple
+from urllib.parse import urlparse
 from bs4 import BeautifulSoup
 from pathlib import Path
+from src.http_cache import fetch_sync
 
 
 def get_project_root() -> Path:
@@ -41,11 +45,58 @@ def update_dict(base: dict, **kwargs) -> dict:
     return base_cpy
 
 
+def split_site_url(url: str) -> Tuple[str, str]:
+    """
+    Split the URL of a city into its site and subarea. Sites of the city map may be given without
+    scheme, and some cities are a subarea of a larger site.
+    :param url: e.g. "https://reno.craigslist.org" or "//newyork.craigslist.org/fct/"
+    :return: ( site, subarea ), e.g. ( "https://newyork.craigslist.org", "fct" ), subarea being
+        empty for a whole site
+    """
+    parts = urlparse(url if '//' in url else '//' + url)
+    return f"{parts.scheme or 'https'}://{parts.netloc}", parts.path.strip('/')
+
+
+async def run_bounded(items: Iterable, handle: Callable[..., Awaitable], concurrency: int,
+                      describe: Callable[..., str] = str) -> None:
+    """
+    Handle every item, a fixed number at a time. Items are fed through a bounded queue to
+    `concurrency` workers, so only the items being handled are pulled from `items`, however many
+    there are. An item that fails is logged, and does not stop the others.
+    :param items: e.g. an iterator over a directory tree
+    :param handle: async function of an item
+    :param concurrency: number of items handled at the same time
+    :param describe: names an item in error logs
+    """
+    if concurrency < 1:
+        raise ValueError(f"Concurrency must be at least 1, got: {concurrency}")
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            try:
+                await handle(item)
+            except Exception:
+                logging.error(f"Error for {describe(item)}", exc_info=True)
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        # Feed items to the workers. Blocks while the queue is full.
+        for item in items:
+            await queue.put(item)
+        await queue.join()
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
 def make_soup(url):
     """ Download URL, package as Soup """
-    response = requests.get(url)
-    response.raise_for_status()
-    soup = BeautifulSoup(response.content, 'lxml')
+    soup = BeautifulSoup(fetch_sync(url), 'lxml')
     return soup
 
 
@@ -0,0 +1,70 @@
+"""
+Polling schedule for watch mode.
+
+Instead of re-scraping every city from cron, `category_scrape.watch_category` keeps polling the
+search page of each city and scrapes only the posts newer than the newest pid it has seen. Each
+city gets a `PollSchedule` that tracks how fast new posts appear there, so busy cities are polled
+every few seconds and quiet ones every few minutes.
+"""
+import asyncio
+import time
+
+# ========================================== CONSTANTS ===========================================
+# seconds between polls of a city
+min_interval = 15.0
+max_interval = 900.0
+initial_interval = 60.0
+
+# number of new posts a poll should find on average. Lower means lower latency, and more polls
+# that find nothing.
+target_new_posts = 1.0
+
+# weight of the latest poll in the estimated rate of new posts, between 0 and 1
+rate_smoothing = 0.3
+
+
+# ========================================== SCHEDULE ============================================
+class PollSchedule:
+    def __init__(self, min_interval: float = min_interval, max_interval: float = max_interval,
+                 interval: float = initial_interval):
+        """
+        Adaptive poll interval of a single city.
+        :param min_interval: shortest number of seconds between polls
+        :param max_interval: longest number of seconds between polls
+        :param interval: seconds until the second poll, before any rate is known
+        """
+        if not 0 < min_interval <= max_interval:
+            raise ValueError(f"Invalid poll interval bounds: {min_interval}, {max_interval}")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min(max_interval, max(min_interval, interval))
+        # estimated new posts per second, None until the second poll
+        self.rate = None
+        # time of the last poll, and of the next one
+        self._last = None
+        self._next = time.monotonic()
+
+    def update(self, new_posts: int) -> float:
+        """
+        Record the result of a poll and schedule the next one.
+        :param new_posts: number of new posts found by the poll
+        :return: seconds until the next poll
+        """
+        now = time.monotonic()
+        if self._last is not None:
+            rate = new_posts / max(now - self._last, 1e-3)
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate = rate_smoothing * rate + (1 - rate_smoothing) * self.rate
+            interval = target_new_posts / self.rate if self.rate > 0 else self.max_interval
+            self.interval = min(self.max_interval, max(self.min_interval, interval))
+        self._last = now
+        self._next = now + self.interval
+        return self.interval
+
+    async def wait(self) -> None:
+        """ Wait until the next poll is due """
+        delay = self._next - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
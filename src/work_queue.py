@@ -0,0 +1,314 @@
+"""
+Work queue with leases, to split a crawl across processes and machines.
+
+Items are JSON objects with a unique key. A worker leases an item for a visibility timeout and
+must complete it, or extend the lease, before the timeout ends. Otherwise, e.g. if the worker
+crashed, the item becomes visible again and is leased to another worker. Each lease counts as an
+attempt, and an item that fails or times out `max_attempts` times is marked failed.
+
+Backends share the async interface of `SQLiteQueue`: put, lease, extend, complete, fail, stats,
+failures and close. `SQLiteQueue` keeps the queue in a local database file, which any number of
+processes on one machine can share. To reach workers on other machines, the coordinator serves its
+queue over HTTP with `serve`, and workers open it as `http://<host>:<port>` with `HTTPQueue`. Other
+backends, e.g. Redis, register their URL scheme in `backends`.
+"""
+import asyncio
+import contextlib
+import hmac
+import json
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+from aiohttp import web
+
+from src.utils import get_project_root
+
+# ========================================== CONSTANTS ===========================================
+# default queue database
+default_queue_path = get_project_root().joinpath('data/work_queue.db')
+
+# seconds a leased item stays invisible to other workers
+default_visibility_timeout = 300
+
+# number of leases of an item before it is marked failed
+default_max_attempts = 3
+
+# default host and port the coordinator serves its queue on. Only local workers can reach it
+# unless another host, e.g. 0.0.0.0, is given.
+default_host = '127.0.0.1'
+default_port = 8899
+
+# environment variable holding the token shared by the coordinator and its workers, and the
+# header it is sent in
+token_env = 'WORK_QUEUE_TOKEN'
+token_header = 'X-Queue-Token'
+
+# status of items
+statuses = ('pending', 'leased', 'done', 'failed')
+
+schema = '''
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    item TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    token TEXT,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS items_status ON items (status, lease_until);
+'''
+
+
+class Lease(NamedTuple):
+    id: int
+    token: str      # identifies this lease, so a worker whose lease expired cannot complete it
+    item: dict
+    attempts: int   # number of leases of the item so far, including this one
+
+
+# ========================================== BACKENDS ============================================
+class SQLiteQueue:
+    def __init__(self, path=default_queue_path, max_attempts: int = default_max_attempts):
+        """
+        Queue kept in a SQLite database, shared by the processes that open the same file.
+        Database calls run in a thread of their own, as they may wait for another process's
+        write lock, which must not stall the event loop.
+        :param path: database file, created if missing
+        :param max_attempts: number of leases of an item before it is marked failed
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Other processes may hold the write lock for a moment, so wait for it.
+        self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.executescript(schema)
+        self.max_attempts = max_attempts
+        # a single thread, so calls run one at a time and in order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='work_queue')
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Takes the write lock up front, so two workers never lease the same item.
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def _put(self, items: list) -> int:
+        with self._transaction():
+            cursor = self.conn.executemany('INSERT OR IGNORE INTO items (key, item) VALUES (?, ?)',
+                                           [(key, json.dumps(item)) for key, item in items])
+        return cursor.rowcount
+
+    async def put(self, items: list) -> int:
+        """
+        Add items, skipping those whose key is already in the queue.
+        :param items: [(key, item)]
+        :return: number of items added
+        """
+        return await self._run(self._put, items)
+
+    def _lease(self, worker: str, visibility_timeout: float) -> Optional[Lease]:
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self._transaction():
+            # Items whose last attempt timed out are given up on.
+            self.conn.execute(
+                "UPDATE items SET status = 'failed', error = 'lease expired' "
+                "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, self.max_attempts))
+            row = self.conn.execute(
+                "SELECT id, item, attempts FROM items WHERE status = 'pending' "
+                "OR status = 'leased' AND lease_until < ? ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE items SET status = 'leased', token = ?, worker = ?, lease_until = ?, "
+                    "attempts = attempts + 1 WHERE id = ?",
+                    (token, worker, now + visibility_timeout, row[0]))
+        if row is None:
+            return None
+        return Lease(row[0], token, json.loads(row[1]), row[2] + 1)
+
+    async def lease(self, worker: str,
+                    visibility_timeout: float = default_visibility_timeout) -> Optional[Lease]:
+        """
+        Lease the oldest item that is pending, or whose lease expired.
+        :param worker: name of the worker, for `stats`
+        :param visibility_timeout: seconds before the item is leased again unless completed
+        :return: lease, or None if no item is available
+        """
+        return await self._run(self._lease, worker, visibility_timeout)
+
+    def _update(self, lease: Lease, sql: str, args: tuple) -> bool:
+        cursor = self.conn.execute(
+            f"UPDATE items SET {sql} WHERE id = ? AND token = ? AND status = 'leased'",
+            args + (lease.id, lease.token))
+        return cursor.rowcount == 1
+
+    async def extend(self, lease: Lease,
+                     visibility_timeout: float = default_visibility_timeout) -> bool:
+        """
+        Keep an item invisible to other workers for another visibility timeout.
+        :return: False if the lease was lost, i.e. the item was leased to another worker
+        """
+        return await self._run(self._update, lease, 'lease_until = ?',
+                               (time.time() + visibility_timeout,))
+
+    async def complete(self, lease: Lease) -> bool:
+        """
+        Mark an item done.
+        :return: False if the lease was lost, i.e. the item was leased to another worker
+        """
+        return await self._run(self._update, lease, "status = 'done', error = NULL", ())
+
+    async def fail(self, lease: Lease, error: str) -> None:
+        """ Give an item back to be retried, or mark it failed after `max_attempts` """
+        status = 'failed' if lease.attempts >= self.max_attempts else 'pending'
+        await self._run(self._update, lease, 'status = ?, error = ?', (status, error))
+
+    def _stats(self) -> dict:
+        counts = dict.fromkeys(statuses, 0)
+        rows = self.conn.execute(
+            "SELECT CASE WHEN status = 'leased' AND lease_until < ? THEN 'pending' "
+            "ELSE status END, COUNT(*) FROM items GROUP BY 1", (time.time(),))
+        counts.update(rows)
+        return counts
+
+    async def stats(self) -> dict:
+        """
+        :return: {status: number of items}, leased items whose lease expired counting as
+            pending
+        """
+        return await self._run(self._stats)
+
+    def _failures(self) -> list:
+        return self.conn.execute(
+            "SELECT key, error FROM items WHERE status = 'failed' ORDER BY id").fetchall()
+
+    async def failures(self) -> list:
+        """ :return: [(key, error)] of failed items """
+        return await self._run(self._failures)
+
+    async def close(self) -> None:
+        await self._run(self.conn.close)
+        self._executor.shutdown()
+
+
+class HTTPQueue:
+    def __init__(self, url: str, token: str = None):
+        """
+        Queue served by a coordinator with `serve`.
+        :param url: of the coordinator, e.g. http://10.0.0.5:8899
+        :param token: shared with the coordinator. Defaults to the `token_env` variable.
+        """
+        self.url = url.rstrip('/')
+        self.token = token or os.environ.get(token_env)
+        self._session = None
+
+    async def _call(self, method: str, **params):
+        if self._session is None:
+            headers = {token_header: self.token} if self.token else None
+            self._session = aiohttp.ClientSession(headers=headers, raise_for_status=True)
+        async with self._session.post(f'{self.url}/{method}', json=params) as response:
+            return await response.json()
+
+    async def put(self, items: list) -> int:
+        return await self._call('put', items=items)
+
+    async def lease(self, worker: str,
+                    visibility_timeout: float = default_visibility_timeout) -> Optional[Lease]:
+        lease = await self._call('lease', worker=worker, visibility_timeout=visibility_timeout)
+        return Lease(*lease) if lease else None
+
+    async def extend(self, lease: Lease,
+                     visibility_timeout: float = default_visibility_timeout) -> bool:
+        return await self._call('extend', lease=lease, visibility_timeout=visibility_timeout)
+
+    async def complete(self, lease: Lease) -> bool:
+        return await self._call('complete', lease=lease)
+
+    async def fail(self, lease: Lease, error: str) -> None:
+        await self._call('fail', lease=lease, error=error)
+
+    async def stats(self) -> dict:
+        return await self._call('stats')
+
+    async def failures(self) -> list:
+        return await self._call('failures')
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+
+# {URL scheme: backend}, each backend being created from the URL and the shared token, if any
+backends = {
+    'sqlite': lambda url, token: SQLiteQueue(urlparse(url).path),
+    'http': HTTPQueue,
+    'https': HTTPQueue,
+}
+
+
+# ============================================ API ===============================================
+def open_queue(url, token: str = None):
+    """
+    Open a queue.
+    :param url: e.g. http://10.0.0.5:8899, sqlite:///data/work_queue.db, or a database path
+    :param token: shared with the coordinator serving the queue, see `serve`
+    :return: backend, see `backends`
+    """
+    scheme = urlparse(str(url)).scheme
+    if scheme in backends:
+        return backends[scheme](str(url), token)
+    return SQLiteQueue(url)
+
+
+async def serve(queue, port: int = default_port, host: str = default_host,
+                token: str = None) -> web.AppRunner:
+    """
+    Serve a queue over HTTP to workers on other machines, on the running event loop.
+    :param queue: backend to serve, e.g. `SQLiteQueue`
+    :param port: to listen on
+    :param host: to listen on, only the local one by default
+    :param token: if given, requests without it in their `token_header` are rejected. Required to
+        listen on another host than the local one, as anyone reaching the queue could lease,
+        complete or add items. Defaults to the `token_env` variable.
+    :return: runner, to stop serving with `await runner.cleanup()`
+    """
+    token = token or os.environ.get(token_env)
+    if not token and host not in ('127.0.0.1', 'localhost', '::1'):
+        raise ValueError(f"A token is required to serve the queue on: {host}, see {token_env}")
+
+    async def call(request):
+        if token and not hmac.compare_digest(request.headers.get(token_header, ''), token):
+            raise web.HTTPUnauthorized()
+        params = await request.json() if request.can_read_body else {}
+        method = request.match_info['method']
+        if 'lease' in params and method != 'lease':
+            params['lease'] = Lease(*params['lease'])
+        return web.json_response(await getattr(queue, method)(**params))
+
+    app = web.Application()
+    methods = ('put', 'lease', 'extend', 'complete', 'fail', 'stats', 'failures')
+    app.router.add_post('/{method:' + '|'.join(methods) + '}', call)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner